@@ -0,0 +1,589 @@
+#/usr/bin/python2
+# jon klein, jtklein@alaska.edu
+# numpy implementation of the cuda_bayes fitting engine for machines without a GPU
+# BayesCPU mirrors calc_bayes, find_peaks, and process_peaks from cuda_bayes.py
+# and fills the same outputs as BayesGPU, so it can be dropped into CudaProcessPulse
+# mit license
+
+import numpy as np
+from timecube import cube_cache, make_enginecube, make_enginetables, symmetric_freqs
+from spaleta_error import phase_fit_error
+
+C = 299792458.
+FWHM_TO_SIGMA = 2.355 # conversion of fwhm to std deviation, assuming gaussian
+LAMBDA_FIT = 1
+SIGMA_FIT = 2
+
+PI = np.float32(3.141592) # same truncated pi as the cuda kernels, keeps fitted signals identical
+HALF_LOG = .30103 # -log10(.5), P_f drop for the fwhm walk
+SPOT_WIDTH = 3
+ALF_CHUNK = 32 # number of alphas evaluated per batch of matrix products, bounds temporary memory
+COARSE_RES = 64 # default size of the coarse grid for the coarse-to-fine search
+COARSE_CANDIDATES = 4 # default number of coarse cells refined for each pulse
+
+class BayesCPU:
+    # search is 'full' to evaluate every point of the grid, or 'coarse' to evaluate a coarse_res x coarse_res grid
+    # and refine the neighbourhoods of the best candidates cells for each pulse at full resolution
+    # stream evaluates the full grid a chunk of alphas at a time without storing P_f, keeping only the running
+    # max for each pulse and P_f along the alpha and freq axes through the peak
+    # separable stores cos/sin [time][freq] and envelope [alf][time] tables instead of the ce/se cubes
+    # symmetric only stores the upper half of the cubes (or tables) if freqs are symmetric about zero,
+    # r_f and i_f for the mirrored frequencies are made from the same partial sums
+    # cs_f of each lag mask pattern is cached in mask_cache for the life of the engine (one pulse sequence)
+    def __init__(self, lags, freqs, alfs, npulses, env_model, search = 'full', coarse_res = COARSE_RES, candidates = COARSE_CANDIDATES, stream = False, separable = False, symmetric = True):
+        self.lags = np.float32(np.array(lags))
+        self.freqs = np.float32(np.array(freqs))
+        self.alfs = np.float32(np.array(alfs))
+
+        self.npulses = npulses
+        self.nlags = np.int32(len(self.lags))
+        self.nalfs = np.int32(len(self.alfs))
+        self.nfreqs = np.int32(len(self.freqs))
+
+        self.env_model = np.float32(env_model)
+
+        if self.npulses <= 1:
+            print 'ERROR: number of pulses must be at least 2'
+
+        if not search in ['full', 'coarse']:
+            raise ValueError('unknown search mode: ' + str(search))
+        self.search = search
+        self.stream = stream
+        self.separable = separable
+        self.symmetric = symmetric and symmetric_freqs(freqs)
+        self.nhalf = self.nfreqs // 2 # the stored upper half starts at freqs[nhalf]
+
+        # create matricies for processing, stored [alf][time][freq] like the matricies on the GPU
+        # or, ce_matrix[alf][time][freq] = envelope[alf][time] * c_matrix[time][freq] (and the same for se_matrix)
+        # the (read-only) matricies come from the cube cache, so engines rebuilt for a pulse sequence seen before reuse them
+        if self.separable:
+            self.c_matrix, self.s_matrix, self.envelope = cube_cache.get(make_enginetables, lags, freqs, alfs, env_model, self.symmetric)
+            self.ce_matrix = None
+            self.se_matrix = None
+        else:
+            self.ce_matrix, self.se_matrix = cube_cache.get(make_enginecube, lags, freqs, alfs, env_model, self.symmetric)
+
+        # squared envelope used for cs_f, [alf][time]
+        # same expression as calc_bayes/calc_amp on the GPU (overflows to inf for sigma fits, like the GPU)
+        with np.errstate(over='ignore'):
+            self.env2 = np.exp((-np.outer(self.alfs, self.lags)) ** self.env_model) ** 2
+
+        self.mask_cache = MaskCache()
+
+        self.ce_points = None
+        if self.search == 'coarse':
+            self._init_coarse(int(coarse_res), int(candidates))
+        else:
+            self._alloc_P_f()
+
+        self.peaks = np.int32(np.zeros(self.npulses))
+        self.alf_fwhm = np.int32(np.zeros(self.npulses))
+        self.freq_fwhm = np.int32(np.zeros(self.npulses))
+        self.amplitudes = np.float64(np.zeros(self.npulses))
+        self.dbar2 = np.float64(np.zeros(self.npulses))
+        self.snr = np.float32(np.zeros(self.npulses))
+        self.snr_peak = np.float32(np.zeros(self.npulses))
+        self.n_good_lags = np.int32(np.zeros(self.npulses))
+
+    # P_f[pulse][alpha][freq] is by far the largest buffer, engines that don't store it override this
+    def _alloc_P_f(self):
+        if self.stream:
+            self.P_f = None
+        else:
+            self.P_f = np.float64(np.zeros([self.npulses, self.nalfs, self.nfreqs]))
+
+    # pick evenly spaced coarse grid points, centered in cells of stride x stride grid points
+    # the cube sampled at the coarse points is kept in the same [alf][time][freq] layout,
+    # the refinement gathers scattered points so it uses a copy of the cube stored [alf][freq][time]
+    def _init_coarse(self, coarse_res, candidates):
+        self.P_f = None
+        self.alf_stride = max(1, self.nalfs // coarse_res)
+        self.freq_stride = max(1, self.nfreqs // coarse_res)
+        self.coarse_alfs = np.arange(self.alf_stride // 2, self.nalfs, self.alf_stride)
+        self.coarse_freqs = np.arange(self.freq_stride // 2, self.nfreqs, self.freq_stride)
+        self.candidates = min(candidates, len(self.coarse_alfs) * len(self.coarse_freqs))
+
+        ce, se = self._cube_rows(self.coarse_alfs)
+        self.ce_coarse = np.ascontiguousarray(ce[:,:,self.coarse_freqs])
+        self.se_coarse = np.ascontiguousarray(se[:,:,self.coarse_freqs])
+
+        # points are cheap to gather from the separable tables
+        if not self.separable:
+            self.ce_points = np.ascontiguousarray(np.swapaxes(self.ce_matrix, 1, 2))
+            self.se_points = np.ascontiguousarray(np.swapaxes(self.se_matrix, 1, 2))
+
+    # ce and se for the alphas in alfidx, [alfidx...][time][freq]
+    def _cube_rows(self, alfidx):
+        if self.separable:
+            envelope = self.envelope[alfidx][...,np.newaxis]
+            ce, se = envelope * self.c_matrix, envelope * self.s_matrix
+        else:
+            ce, se = self.ce_matrix[alfidx], self.se_matrix[alfidx]
+
+        if self.symmetric:
+            return self._mirror(ce, ce), self._mirror(se, -se)
+        return ce, se
+
+    # ce and se for the freqs in freqidx, [alf][time][freqidx...]
+    def _cube_cols(self, freqidx):
+        freqidx, sign = self._half_freqs(freqidx)
+        if self.separable:
+            envelope = self.envelope[:,:,np.newaxis]
+            return envelope * self.c_matrix[:,freqidx], envelope * self.s_matrix[:,freqidx] * sign
+        return self.ce_matrix[:,:,freqidx], self.se_matrix[:,:,freqidx] * sign
+
+    # ce and se at points of the grid, alfidx and freqidx are broadcast against eachother, [points...][time]
+    # uses the [alf][freq][time] copy of the cube if there is one, gathering from ce_matrix is slow for many points
+    def _cube_points(self, alfidx, freqidx):
+        freqidx, sign = self._half_freqs(freqidx)
+        sign = sign[...,np.newaxis]
+        if self.separable:
+            envelope = self.envelope[alfidx]
+            return envelope * self.c_matrix.T[freqidx], envelope * self.s_matrix.T[freqidx] * sign
+        if self.ce_points is None:
+            return self.ce_matrix[alfidx,:,freqidx], self.se_matrix[alfidx,:,freqidx] * sign
+        return self.ce_points[alfidx,freqidx], self.se_points[alfidx,freqidx] * sign
+
+    # index into the stored cubes and sign of se for freqidx, se is odd in frequency
+    def _half_freqs(self, freqidx):
+        freqidx = np.array(freqidx)
+        if not self.symmetric:
+            return freqidx, np.ones(freqidx.shape, dtype=np.float32)
+
+        upper = freqidx >= self.nhalf
+        halfidx = np.where(upper, freqidx, self.nfreqs - 1 - freqidx) - self.nhalf
+        return halfidx, np.float32(np.where(upper, 1, -1))
+
+    # build the full grid [...][freq] of a symmetric grid from its upper half and its value on the mirrored freqs
+    def _mirror(self, upper, lower):
+        return np.concatenate((lower[...,::-1][...,:self.nhalf], upper), axis=-1)
+
+    def run_bayesfit(self, samples, lagmask, copy_samples = True):
+        if copy_samples:
+            self.lagmask = np.int32(lagmask)
+            self.samples = samples
+            # working copy of the samples, the fitted signal is subtracted from it after each pass
+            # (like samples_gpu on the GPU)
+            self.samples_fit = np.float32(np.array(samples)).reshape(self.npulses, 2 * self.nlags)
+            self._group_masks()
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.search == 'coarse':
+                self._coarse_search()
+                return
+
+            if self.P_f is None:
+                self._stream_bayes()
+                return
+
+            self._calc_bayes()
+            self._find_peaks()
+            self._process_peaks()
+
+    def process_bayesfit(self, tfreq, noise):
+        calc_fitparams(self, tfreq, noise)
+
+    # group pulses by lag mask pattern, then look up (or add) each pattern in the mask cache
+    # sets pattern_idx[pulse] and pattern_cs_f[pattern][alpha], so cs_f is only summed once for each pattern
+    def _group_masks(self):
+        goodmask = (self.lagmask != 0)
+        keys = np.packbits(goodmask, axis=1)
+        keys, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        self.pattern_idx = inverse.ravel()
+        npulses = np.bincount(self.pattern_idx, minlength=len(keys))
+
+        self.pattern_cs_f = np.zeros([len(keys), self.nalfs], dtype=np.float32)
+        for (i, key) in enumerate(keys):
+            cs_f = self.mask_cache.get(key.tobytes(), npulses[i])
+            if cs_f is None:
+                # summed over lags in order in float32, like s_cs_f on the GPU (nan where env2 overflows)
+                cs_f = np.zeros(self.nalfs, dtype=np.float32)
+                with np.errstate(invalid='ignore'):
+                    for t in xrange(self.nlags):
+                        cs_f += self.env2[:,t] * goodmask[first[i],t]
+                self.mask_cache.add(key.tobytes(), cs_f)
+            self.pattern_cs_f[i] = cs_f
+
+    # mask out bad lags, then calculate number of good lags, dbar2, and cs_f[pulse][alpha] for each pulse
+    # returns masked real and imaginary samples [pulse][time]
+    def _calc_stats(self):
+        goodmask = (self.lagmask != 0)
+        s_i = self.samples_fit[:,0::2] * goodmask
+        s_q = self.samples_fit[:,1::2] * goodmask
+
+        n_good = np.sum(goodmask, axis=1)
+        self.n_good_lags[:] = n_good
+        self.dbar2[:] = np.sum(np.float64(s_i) ** 2 + np.float64(s_q) ** 2, axis=1) / (2 * n_good)
+        self.cs_f = self.pattern_cs_f[self.pattern_idx]
+        return s_i, s_q
+
+    # calculate log probability P_f[pulse][alpha][freq], see calc_bayes in cuda_bayes.py
+    def _calc_bayes(self):
+        s_i, s_q = self._calc_stats()
+
+        for a0 in xrange(0, self.nalfs, ALF_CHUNK):
+            a1 = min(a0 + ALF_CHUNK, self.nalfs)
+            self.P_f[:,a0:a1,:] = self._pf_chunk(s_i, s_q, a0, a1)
+
+    # calculate P_f[pulse][alpha][freq] for alphas a0 to a1
+    # R_f and I_f for all range gates are a batch of matrix products against each alpha slice of the cube
+    # with separable tables, the samples are weighted by the envelope of each alpha and multiplied with cos/sin
+    # on a symmetric grid, r_f(+/-f) = a +/- b and i_f(+/-f) = +/-c - d from the products with the upper half
+    def _pf_chunk(self, s_i, s_q, a0, a1):
+        if self.separable:
+            envelope = self.envelope[a0:a1,np.newaxis,:]
+            s_i = s_i * envelope # [alpha][pulse][time]
+            s_q = s_q * envelope
+            ce = self.c_matrix
+            se = self.s_matrix
+        else:
+            ce = self.ce_matrix[a0:a1]
+            se = self.se_matrix[a0:a1]
+
+        a = np.matmul(s_i, ce) # [alpha][pulse][freq]
+        b = np.matmul(s_q, se)
+        c = np.matmul(s_i, se)
+        d = np.matmul(s_q, ce)
+
+        if self.symmetric:
+            r_f = self._mirror(a + b, a - b)
+            i_f = self._mirror(c - d, -c - d)
+        else:
+            r_f = a + b
+            i_f = c - d
+
+        r_f = np.swapaxes(r_f, 0, 1)
+        i_f = np.swapaxes(i_f, 0, 1)
+
+        pulses = np.arange(self.npulses)[:,np.newaxis,np.newaxis]
+        return self._log_prob(r_f, i_f, pulses, self.cs_f[:,a0:a1,np.newaxis])
+
+    # fused calc_bayes and find_peaks, P_f is evaluated a chunk of alphas at a time and only the running max
+    # and the alpha row holding it are kept, then P_f along the freq axis through the peak and the spot are evaluated
+    def _stream_bayes(self):
+        s_i, s_q = self._calc_stats()
+        pulses = np.arange(self.npulses)
+        pfmax = np.ones(self.npulses) * -np.inf
+        alfidx = np.zeros(self.npulses, dtype=np.int64)
+        freqidx = np.zeros(self.npulses, dtype=np.int64)
+        freq_profile = np.zeros([self.npulses, self.nfreqs])
+
+        for a0 in xrange(0, self.nalfs, ALF_CHUNK):
+            a1 = min(a0 + ALF_CHUNK, self.nalfs)
+            pf = self._pf_chunk(s_i, s_q, a0, a1)
+            chunkmax = np.argmax(np.where(np.isnan(pf), -np.inf, pf).reshape(self.npulses, -1), axis=1)
+            chunkalf = chunkmax // self.nfreqs
+            chunkfreq = chunkmax % self.nfreqs
+
+            # strictly greater, so ties keep the first peak in P_f like argmax over the whole grid
+            better = pf[pulses, chunkalf, chunkfreq] > pfmax
+            pfmax[better] = pf[pulses, chunkalf, chunkfreq][better]
+            alfidx[better] = a0 + chunkalf[better]
+            freqidx[better] = chunkfreq[better]
+            freq_profile[better] = pf[pulses, chunkalf][better]
+
+        self.peaks[:] = pulses * (self.nalfs * self.nfreqs) + alfidx * self.nfreqs + freqidx
+
+        apex = freq_profile[pulses, freqidx]
+        alf_profile = self._profiles(s_i, s_q, alfidx, freqidx)[1]
+        spot = self._spot(alfidx, freqidx, s_i, s_q)
+        self._peak_params(apex, alf_profile, freq_profile, spot, alfidx, freqidx)
+
+    # log probability from r_f and i_f, with cs_f and the good lag statistics of each point's pulse
+    def _log_prob(self, r_f, i_f, pulses, cs_f):
+        n_good = np.float64(self.n_good_lags[pulses])
+        cs_f = np.float64(cs_f)
+        hbar2 = (np.float64(r_f) ** 2 + np.float64(i_f) ** 2) / cs_f
+        return np.log10(2 * n_good * self.dbar2[pulses] - hbar2) * (1 - n_good) - np.log10(cs_f)
+
+    # calculate P_f at scattered points of the grid, pulses, alfidx, and freqidx are broadcast against eachother
+    def _pf_points(self, s_i, s_q, pulses, alfidx, freqidx):
+        pulses, alfidx, freqidx = np.broadcast_arrays(pulses, alfidx, freqidx)
+        ce, se = self._cube_points(alfidx, freqidx) # [points...][time]
+        si = s_i[pulses]
+        sq = s_q[pulses]
+
+        r_f = np.einsum('...t,...t->...', si, ce) + np.einsum('...t,...t->...', sq, se)
+        i_f = np.einsum('...t,...t->...', si, se) - np.einsum('...t,...t->...', sq, ce)
+        return self._log_prob(r_f, i_f, pulses, self.cs_f[pulses, alfidx])
+
+    # calculate P_f at the peak and along the alpha and freq axes through the peak of each pulse
+    def _profiles(self, s_i, s_q, alfidx, freqidx):
+        pulses = np.arange(self.npulses)
+
+        # alpha rows through the peak, [pulse][time][freq]
+        ce, se = self._cube_rows(alfidx)
+        r_f = np.einsum('pt,ptf->pf', s_i, ce) + np.einsum('pt,ptf->pf', s_q, se)
+        i_f = np.einsum('pt,ptf->pf', s_i, se) - np.einsum('pt,ptf->pf', s_q, ce)
+        freq_profile = self._log_prob(r_f, i_f, pulses[:,np.newaxis], self.cs_f[pulses, alfidx][:,np.newaxis])
+
+        # freq columns through the peak, [alpha][time][pulse]
+        ce, se = self._cube_cols(freqidx)
+        r_f = np.einsum('pt,atp->pa', s_i, ce) + np.einsum('pt,atp->pa', s_q, se)
+        i_f = np.einsum('pt,atp->pa', s_i, se) - np.einsum('pt,atp->pa', s_q, ce)
+        alf_profile = self._log_prob(r_f, i_f, pulses[:,np.newaxis], self.cs_f)
+
+        apex = freq_profile[pulses, freqidx]
+        return apex, alf_profile, freq_profile
+
+    # coarse-to-fine search, evaluates P_f on the coarse grid, then refines the best candidate cells for each pulse
+    # the fwhm walks and spot are then calculated from P_f evaluated at full resolution through the refined peak
+    def _coarse_search(self):
+        s_i, s_q = self._calc_stats()
+        pulses = np.arange(self.npulses)
+
+        # P_f on the coarse grid for all pulses, [pulse][alpha][freq]
+        r_f = np.matmul(s_i, self.ce_coarse) + np.matmul(s_q, self.se_coarse)
+        i_f = np.matmul(s_i, self.se_coarse) - np.matmul(s_q, self.ce_coarse)
+        r_f = np.swapaxes(r_f, 0, 1)
+        i_f = np.swapaxes(i_f, 0, 1)
+        cs_f = self.cs_f[:,self.coarse_alfs,np.newaxis]
+        pf = self._log_prob(r_f, i_f, pulses[:,np.newaxis,np.newaxis], cs_f)
+
+        # pick the best candidate cells for each pulse
+        ncoarse_freqs = len(self.coarse_freqs)
+        pf = pf.reshape(self.npulses, -1)
+        pf = np.where(np.isnan(pf), -np.inf, pf)
+        cells = np.argpartition(-pf, self.candidates - 1, axis=1)[:,:self.candidates]
+        cell_alfs = self.coarse_alfs[cells // ncoarse_freqs]
+        cell_freqs = self.coarse_freqs[cells % ncoarse_freqs]
+
+        # refine a patch reaching one stride past the center of each candidate cell, [pulse][candidate][alpha][freq]
+        patch_alfs = np.arange(-self.alf_stride, self.alf_stride + 1)
+        patch_freqs = np.arange(-self.freq_stride, self.freq_stride + 1)
+        patch_alfs = np.clip(cell_alfs[:,:,np.newaxis,np.newaxis] + patch_alfs[:,np.newaxis], 0, self.nalfs - 1)
+        patch_freqs = np.clip(cell_freqs[:,:,np.newaxis,np.newaxis] + patch_freqs, 0, self.nfreqs - 1)
+        pf = self._pf_points(s_i, s_q, pulses[:,np.newaxis,np.newaxis,np.newaxis], patch_alfs, patch_freqs)
+
+        pf = pf.reshape(self.npulses, -1)
+        pf = np.where(np.isnan(pf), -np.inf, pf)
+        best = np.argmax(pf, axis=1)
+        patch_alfs, patch_freqs = np.broadcast_arrays(patch_alfs, patch_freqs)
+        alfidx = patch_alfs.reshape(self.npulses, -1)[pulses, best]
+        freqidx = patch_freqs.reshape(self.npulses, -1)[pulses, best]
+        self.peaks[:] = pulses * (self.nalfs * self.nfreqs) + alfidx * self.nfreqs + freqidx
+
+        # full resolution P_f through the peak for the fwhm walks and the spot moments
+        apex, alf_profile, freq_profile = self._profiles(s_i, s_q, alfidx, freqidx)
+        spot = self._spot(alfidx, freqidx, s_i, s_q)
+
+        self._peak_params(apex, alf_profile, freq_profile, spot, alfidx, freqidx)
+
+    # find index of maximum of P_f for each pulse, indexed into the flattened P_f like find_peaks
+    def _find_peaks(self):
+        pf = self.P_f.reshape(self.npulses, self.nalfs * self.nfreqs)
+        pf = np.where(np.isnan(pf), -np.inf, pf)
+        pulsebase = np.arange(self.npulses) * (self.nalfs * self.nfreqs)
+        self.peaks[:] = np.argmax(pf, axis=1) + pulsebase
+
+    # find fwhm, amplitude, and snr around each peak, then subtract the fitted signal from the samples
+    # see process_peaks, calc_peak, and calc_amp in cuda_bayes.py
+    def _process_peaks(self):
+        pulses = np.arange(self.npulses)
+        peakidx = self.peaks % (self.nalfs * self.nfreqs)
+        alfidx = peakidx // self.nfreqs
+        freqidx = peakidx % self.nfreqs
+
+        apex = self.P_f[pulses, alfidx, freqidx]
+        alf_profile = self.P_f[pulses, :, freqidx]
+        freq_profile = self.P_f[pulses, alfidx, :]
+        spot = self._spot(alfidx, freqidx)
+
+        self._peak_params(apex, alf_profile, freq_profile, spot, alfidx, freqidx)
+
+    # cache a SPOT_WIDTH x SPOT_WIDTH spot of P_f around each peak, nan outside of the grid
+    # without a stored P_f, the spot is evaluated from the masked samples s_i and s_q
+    def _spot(self, alfidx, freqidx, s_i = None, s_q = None):
+        reach = (SPOT_WIDTH - 1) // 2
+        offsets = np.arange(SPOT_WIDTH) - reach
+        spot_alfs = alfidx[:,np.newaxis] + offsets
+        spot_freqs = freqidx[:,np.newaxis] + offsets
+        valid = ((spot_alfs >= 0) & (spot_alfs < self.nalfs))[:,:,np.newaxis] & ((spot_freqs >= 0) & (spot_freqs < self.nfreqs))[:,np.newaxis,:]
+
+        spot_idx = (np.arange(self.npulses)[:,np.newaxis,np.newaxis], \
+                    np.clip(spot_alfs, 0, self.nalfs - 1)[:,:,np.newaxis], \
+                    np.clip(spot_freqs, 0, self.nfreqs - 1)[:,np.newaxis,:])
+
+        if self.P_f is None:
+            spot = self._pf_points(s_i, s_q, *spot_idx)
+        else:
+            spot = self.P_f[spot_idx]
+        spot[~valid] = np.nan
+        return spot
+
+    # given P_f at the peak, P_f along the alpha and freq axes through the peak, and a spot around the peak
+    # calculate fwhm, amplitude, snr, and the residual samples for each pulse
+    def _peak_params(self, apex, alf_profile, freq_profile, spot, alfidx, freqidx):
+        factor = (apex - HALF_LOG)[:,np.newaxis]
+
+        # find alpha fwhm, walks from the peak up and down the alpha axis, counting the peak on each walk
+        above = alf_profile > factor
+        self.alf_fwhm[:] = 1 + _run_length(above, alfidx) + _run_length(above[:,::-1], self.nalfs - 1 - alfidx)
+
+        # find freq fwhm, the walks on the GPU stop before reaching the first frequency bin
+        above = freq_profile > factor
+        above[:,0] = False
+        self.freq_fwhm[:] = 1 + _run_length(above, freqidx) + _run_length(above[:,::-1], self.nfreqs - 1 - freqidx)
+
+        goodmask = (self.lagmask != 0)
+        peakfreq = self.freqs[freqidx]
+        peakalf = self.alfs[alfidx]
+        peakamp = self._calc_amp(alfidx, freqidx)
+
+        # calculate peak SNR and compare to moment SNR
+        envelope = peakamp[:,np.newaxis] * np.exp((-np.outer(peakalf, self.lags)) ** self.env_model)
+        fitted_signal = self._fitted_signal(envelope, peakfreq)
+        residual = self.samples_fit - fitted_signal
+        self.snr_peak[:] = _signal_power(fitted_signal, goodmask) / _signal_power(residual, goodmask)
+
+        # calculate peak freq and alf from normalized moments of the spot around the peak
+        # the GPU spot stops at the first grid edge it hits, so a peak on the lowest alpha or freq has an empty spot
+        reach = (SPOT_WIDTH - 1) // 2
+        spot = np.where(((alfidx >= reach) & (freqidx >= reach))[:,np.newaxis,np.newaxis], spot, np.nan)
+        p_f = 10 ** (spot - np.float32(apex)[:,np.newaxis,np.newaxis])
+        p_f[np.isnan(p_f)] = 0
+        p_f /= np.sum(p_f, axis=(1,2))[:,np.newaxis,np.newaxis]
+        p_f[np.isnan(p_f)] = 0 # empty spots leave the moment freq and alf at zero, like the GPU
+
+        offsets = np.arange(SPOT_WIDTH) - reach
+        spot_alfs = self.alfs[np.clip(alfidx[:,np.newaxis] + offsets, 0, self.nalfs - 1)]
+        spot_freqs = self.freqs[np.clip(freqidx[:,np.newaxis] + offsets, 0, self.nfreqs - 1)]
+        momentfreq = np.sum(p_f * spot_freqs[:,np.newaxis,:], axis=(1,2))
+        momentalf = np.sum(p_f * spot_alfs[:,:,np.newaxis], axis=(1,2))
+
+        self.amplitudes[:] = peakamp
+
+        # calculate fitted signal, fitted signal power, and remaining power
+        # TODO: add in environment model... exp(-peakalf ** 2?)
+        envelope = peakamp[:,np.newaxis] * np.exp(-np.outer(momentalf, self.lags))
+        fitted_signal = self._fitted_signal(envelope, momentfreq)
+        self.samples_fit -= np.float32(fitted_signal)
+        self.snr[:] = _signal_power(fitted_signal, goodmask) / _signal_power(self.samples_fit, goodmask)
+
+    # recalculate r_f and i_f at the peak, then calculate amplitude with the cached cs_f of the pulse's lag mask
+    def _calc_amp(self, alfidx, freqidx):
+        cs_f = self.pattern_cs_f[self.pattern_idx, alfidx]
+        ce, se = self._cube_points(alfidx, freqidx)
+        s_i = self.samples_fit[:,0::2]
+        s_q = self.samples_fit[:,1::2]
+
+        r_f = np.sum(s_i * ce + s_q * se, axis=1)
+        i_f = np.sum(s_i * se - s_q * ce, axis=1)
+        return (r_f + i_f) / cs_f
+
+    # create interleaved fitted samples given an envelope [pulse][time] and frequency for each pulse
+    def _fitted_signal(self, envelope, freq):
+        angle = 2 * PI * np.outer(freq, self.lags)
+        fitted_signal = np.zeros([self.npulses, 2 * self.nlags])
+        fitted_signal[:,0::2] = envelope * np.cos(angle)
+        fitted_signal[:,1::2] = envelope * np.sin(angle)
+        return fitted_signal
+
+    # pickle a pulse for later analysis
+    def pickle_pulse(self, filename='pulse_mcm20140828.p'):
+        import pickle
+        param = {}
+        param['alfs'] = self.alfs
+        param['freqs'] = self.freqs
+        param['samples'] = self.samples
+        param['lagmask'] = self.lagmask
+        param['lags'] = self.lags
+        param['npulses'] = self.npulses
+        param['env_model'] = self.env_model
+        param['tfreq'] = self.tfreq
+        param['noise'] = self.noise
+        pickle.dump(param, open(filename, 'wb'))
+
+# cache of cs_f[alpha] for lag mask patterns, keyed by the packed lagmask bits of a pulse
+# each lookup counts a hit or miss for every pulse using the pattern, the first pulse with a new pattern is the miss
+# the all-zero pattern (the empty lag masks of padding pulses in short batches) isn't counted, so the reuse reflects the data
+class MaskCache:
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, npulses = 1):
+        value = self.entries.get(key)
+        if not key.strip('\x00'):
+            return value
+        if value is None:
+            self.misses += 1
+            self.hits += npulses - 1
+        else:
+            self.hits += npulses
+        return value
+
+    def add(self, key, value):
+        self.entries[key] = value
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.
+
+# compact the good lags of each pulse to the front, returns lag indices [pulse][most good lags of any pulse]
+# rows are padded with bad lags past the number of good lags of the pulse
+def compact_lags(lagmask):
+    good = (np.array(lagmask) != 0)
+    order = np.argsort(~good, axis=1, kind='mergesort')
+    ngood = max(1, np.max(np.sum(good, axis=1)))
+    return np.int32(order[:,:ngood])
+
+# count consecutive true values in each row of above, starting at column start[row]
+def _run_length(above, start):
+    cols = np.arange(above.shape[1])
+    run = np.cumprod(above | (cols < start[:,np.newaxis]), axis=1)
+    return np.sum(run, axis=1) - start
+
+# sum of magnitudes of interleaved samples on good lags
+def _signal_power(samples, goodmask):
+    return np.sum(np.sqrt(samples[:,0::2] ** 2 + samples[:,1::2] ** 2) * goodmask, axis=1)
+
+# convert peaks and fwhms from a fitting engine (BayesGPU or BayesCPU) to velocity, spectral width, and power
+# results are stored on the engine
+# tfreq and noise are scalars, or vectors with a value for each pulse when several records are fit in one batch
+def calc_fitparams(engine, tfreq, noise):
+    engine.tfreq = tfreq
+    engine.noise = noise
+
+    dalpha = engine.alfs[1] - engine.alfs[0]
+    dfreqs = engine.freqs[1] - engine.freqs[0]
+
+    N = 2 * engine.n_good_lags
+
+    w_idx = ((engine.peaks - (engine.peaks % engine.nfreqs)) % (engine.nfreqs * engine.nalfs)) // engine.nfreqs
+    v_idx = engine.peaks % engine.nfreqs
+
+    engine.w = (engine.alfs[w_idx] * C) / (2. * np.pi * (tfreq * 1e3))
+    engine.w_std = dalpha * (((C * engine.alf_fwhm) / (2. * np.pi * (tfreq * 1e3))) / FWHM_TO_SIGMA)
+    engine.w_e = engine.w_std / np.sqrt(N)
+
+    engine.v = (engine.freqs[v_idx] * C) / (2 * tfreq * 1e3)
+    engine.v_std = dfreqs * ((((engine.freq_fwhm) * C) / (2 * tfreq * 1e3)) / FWHM_TO_SIGMA)
+    engine.v_e = engine.v_std / np.sqrt(N)
+
+    engine.p = engine.amplitudes / noise
+    engine.p[engine.p <= 0] = np.nan
+    engine.p = 10 * np.log10(engine.p)
+
+    # raw freq/decay for debugging
+    engine.vfreq = (engine.freqs[v_idx])
+    engine.walf = (engine.alfs[w_idx])
+
+    engine.phi_sigma = np.zeros(engine.npulses)
+    engine.v_sigma = np.zeros(engine.npulses)
+    engine.slope_sigma = np.zeros(engine.npulses)
+    tfreqs = tfreq * np.ones(engine.npulses)
+
+    # calculate mse for phase, amplitude, and overall signal for fitacf comparison
+    for (r, mask) in enumerate(engine.lagmask):
+        goodmask = (mask == 1)
+        lagtimes = engine.lags[goodmask]
+        samples_i = engine.samples[r][0::2][goodmask]
+        samples_q = engine.samples[r][1::2][goodmask]
+        signal = samples_i + 1j * samples_q
+        # we want unwrapped phase, right? otherwise we get artifacts at +/- 2 pi
+        phi_sigma,slope_sigma,v_sigma = phase_fit_error(signal, lagtimes, tfreqs[r] * 1000, engine.v[r])
+        engine.phi_sigma[r] = phi_sigma
+        engine.slope_sigma[r] = slope_sigma
+        engine.v_sigma[r] = v_sigma
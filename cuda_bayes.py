@@ -4,8 +4,8 @@ import pycuda.compiler
 import pycuda.autoinit
 import numpy as np
 from itertools import chain, izip
-from timecube import make_spacecube
-from spaleta_error import phase_fit_error
+from timecube import make_spacecube, make_enginecube, cube_cache
+from cpu_bayes import calc_fitparams
 # debugging imports
 import pdb
 import matplotlib.pyplot as plt
@@ -18,7 +18,7 @@ FWHM_TO_SIGMA = 2.355 # conversion of fwhm to std deviation, assuming gaussian
 LAMBDA_FIT = 1
 SIGMA_FIT = 2
 
-mod = pycuda.compiler.SourceModule("""
+kernels = """
 #include <stdio.h>
 #include <stdint.h>
 
@@ -30,6 +30,13 @@ mod = pycuda.compiler.SourceModule("""
 #define PI (3.141592)
 #define SPOT_WIDTH 3
 
+// in streaming mode P_f is never stored, process_peaks reads P_f through the peak from the profiles made by calc_profiles
+#ifdef STREAM_PF
+#define PF(P_f, idx, peakidx, nalphas, nfreqs) stream_pf(P_f, idx, peakidx, nalphas, nfreqs)
+#else
+#define PF(P_f, idx, peakidx, nalphas, nfreqs) P_f[idx]
+#endif
+
 typedef struct 
 {
     float freq, alf, amp;
@@ -37,6 +44,7 @@ typedef struct
 
 __device__ peak calc_peak(int32_t peakidx, int32_t freqidx, int32_t alfidx, int32_t nalfs, int32_t nlags, int32_t nfreqs, double *P_f, float *freqs, float *alfs, float *ce_matrix, float *se_matrix, int32_t *lagmask, float *s_times, float *samples, float env_model);
 __device__ float calc_amp(float alf, float env_model, int32_t alfidx, int32_t freqidx, float *ce_matrix, float *se_matrix,  int32_t *lagmask, float *s_times, float *samples, int32_t nlags, int32_t nfreqs);
+__device__ double stream_pf(double *profiles, int32_t idx, int32_t peakidx, int32_t nalphas, int32_t nfreqs);
 
 // see generalizing the lomb-scargle periodogram, g. bretthorst
 __global__ void calc_bayes(float *samples, int32_t *lags, float *alphas, float *lag_times, float *ce_matrix, float *se_matrix, double *P_f, float env_model, int32_t nsamples, int32_t nalphas, int32_t *n_good_lags_v)
@@ -173,7 +181,7 @@ __global__ void process_peaks(float *samples, float *ce_matrix, float *se_matrix
     int32_t i;
     float fitpwr = 0;
     float rempwr = 0;
-    double apex = P_f[peakidx];
+    double apex = PF(P_f, peakidx, peakidx, nalphas, nfreqs);
 
     float peakamp;
     float peakfreq;
@@ -202,24 +210,24 @@ __global__ void process_peaks(float *samples, float *ce_matrix, float *se_matrix
     __syncthreads();  
 
     // find alpha fwhm 
-    for(i = peakidx; i < pulse_upperbound && P_f[i] > factor; i+=nfreqs) {
+    for(i = peakidx; i < pulse_upperbound && PF(P_f, i, peakidx, nalphas, nfreqs) > factor; i+=nfreqs) {
         afwhm++; 
     } 
     __syncthreads();  
 
-    for(i = peakidx; i >= pulse_lowerbound && P_f[i] > factor; i-=nfreqs) {
+    for(i = peakidx; i >= pulse_lowerbound && PF(P_f, i, peakidx, nalphas, nfreqs) > factor; i-=nfreqs) {
         afwhm++; 
     }
     __syncthreads();  
 
     // find freq fwhm
     // don't care about fixing edge cases with peak on max or min freq, they are thrown as non-quality fits anyways
-    for(i = peakidx; i % nfreqs != 0 && P_f[i] > factor; i++) {
+    for(i = peakidx; i % nfreqs != 0 && PF(P_f, i, peakidx, nalphas, nfreqs) > factor; i++) {
         ffwhm++; 
     }
     __syncthreads();  
 
-    for(i = peakidx; i % nfreqs != 0 && P_f[i] > factor; i--) {
+    for(i = peakidx; i % nfreqs != 0 && PF(P_f, i, peakidx, nalphas, nfreqs) > factor; i--) {
         ffwhm++; 
     }
     __syncthreads();  // sync threads, they probably diverged during fwhm calculations
@@ -297,14 +305,14 @@ __device__ peak calc_peak(int32_t peakidx, int32_t freqidx, int32_t alfidx, int3
     
     // normalize p_f across spot..
     float p_f[SPOT_WIDTH * SPOT_WIDTH];
-    float p_f_peak = (float) P_f[peakidx];
+    float p_f_peak = (float) PF(P_f, peakidx, peakidx, nalfs, nfreqs);
     float p_f_sum = 0;
 
     // de-log and cache spot around peak
     for(i = 0; (i < SPOT_WIDTH) && (alfidx + i - reach < nalfs) && (alfidx + i - reach >= 0); i++ ) {
         for(j = 0; j < SPOT_WIDTH && (freqidx + j - reach < nfreqs) && (freqidx + j - reach >= 0); j++) {
             int32_t idx = peakidx + (j - reach) + (i - reach) * nalfs;
-            p_f[i*3 + j] = pow((double) 10.0, P_f[idx] - p_f_peak);
+            p_f[i*3 + j] = pow((double) 10.0, PF(P_f, idx, peakidx, nalfs, nfreqs) - p_f_peak);
             p_f_sum += p_f[i*3 + j]; 
         }
     }
@@ -348,7 +356,183 @@ __device__ float calc_amp(float alf, float env_model, int32_t alfidx, int32_t fr
     return (r_f + i_f) / cs_f;
 }
 
-""")
+// cache the masked samples, good lag mask, and cs_f of the pulse for this block in shared memory
+// calculates the number of good lags and returns dbar2, same as the start of calc_bayes
+__device__ double cache_pulse(float *samples, int32_t *lags, float *alphas, float *lag_times, float env_model, int32_t nsamples, int32_t nalphas, float *s_samples, int32_t *s_lags, float *s_cs_f, int32_t *n_good_samples)
+{
+    int32_t i, sample_offset, samplebase;
+    double dbar2 = 0;
+    float alpha;
+
+    samplebase = blockIdx.x * nsamples; 
+    for(i = 0; i < nsamples / blockDim.x + 1; i++) {
+        sample_offset = threadIdx.x + i * blockDim.x;
+        if(sample_offset < nsamples) {
+            s_lags[sample_offset] = (lags[samplebase + sample_offset] != 0);
+        }
+    }
+    __syncthreads(); 
+
+    samplebase = blockIdx.x * nsamples * 2; 
+    for(i = 0; i < 2 * nsamples / blockDim.x + 1; i++) {
+        sample_offset = threadIdx.x + i * blockDim.x;
+        if(sample_offset < nsamples * 2) {
+            s_samples[sample_offset] = samples[samplebase + sample_offset] * (s_lags[sample_offset >> 1] != 0);
+        }
+    }
+    __syncthreads(); 
+    
+    *n_good_samples = 0;
+    for(i = 0; i < nsamples; i++) {
+        if(s_lags[i]) {
+            (*n_good_samples)++;
+        }
+    }
+    
+    if(threadIdx.x < nalphas) {
+        s_cs_f[threadIdx.x] = 0;
+        alpha = alphas[threadIdx.x];
+        for(i = 0; i < nsamples; i++) {
+            s_cs_f[threadIdx.x] += pow(exp(pow(-alpha * lag_times[i], env_model)),2) * (s_lags[i] != 0);
+        }
+    }
+    __syncthreads(); 
+
+    for(i = 0; i < 2*nsamples; i+=2) {
+        dbar2 += (pow(s_samples[i + REAL],2) + pow(s_samples[i + IMAG],2)) * s_lags[i >> 1];
+    }
+    dbar2 /= 2 * (*n_good_samples);
+    __syncthreads(); 
+
+    return dbar2;
+}
+
+// calculate P_f at one alpha and freq from the cached pulse, same arithmetic as the inner loop of calc_bayes
+__device__ double calc_pf(int32_t alfidx, int32_t freqidx, int32_t nfreqs, int32_t nsamples, float *ce_matrix, float *se_matrix, float *s_samples, float *s_cs_f, int32_t n_good_samples, double dbar2)
+{
+    int32_t t;
+    float r_f = 0;
+    float i_f = 0;
+    double hbar2;
+
+    for(t = 0; t < nsamples; t++) {
+        int32_t CS_offset = (alfidx * nfreqs * nsamples) + (t * nfreqs) + freqidx;
+        int32_t sample_offset = 2*t;
+
+        r_f += s_samples[sample_offset + REAL] * ce_matrix[CS_offset] + \
+               s_samples[sample_offset + IMAG] * se_matrix[CS_offset];
+        i_f += s_samples[sample_offset + REAL] * se_matrix[CS_offset] - \
+               s_samples[sample_offset + IMAG] * ce_matrix[CS_offset];
+    }
+
+    hbar2 = ((pow(r_f, 2) / s_cs_f[alfidx]) + (pow(i_f, 2) / s_cs_f[alfidx]));
+    return log10(n_good_samples * 2 * dbar2 - hbar2) * (1 - ((double) n_good_samples)) - log10(s_cs_f[alfidx]);
+}
+
+// fused calc_bayes and find_peaks for the streaming mode, P_f is never stored
+// thread for each freq keeps its running max along alpha, then the maximums are reduced like find_peaks
+__global__ void calc_bayes_stream(float *samples, int32_t *lags, float *alphas, float *lag_times, float *ce_matrix, float *se_matrix, int32_t *peaks, float env_model, int32_t nsamples, int32_t nalphas, int32_t *n_good_lags_v)
+{
+    int32_t i;
+    int32_t n_good_samples;
+    double dbar2, pf;
+
+    __shared__ float s_samples[MAX_SAMPLES * 2];
+    __shared__ int32_t s_lags[MAX_SAMPLES];
+    __shared__ float s_cs_f[MAX_ALPHAS];
+    __shared__ int32_t maxidx[MAX_FREQS];
+    __shared__ double maxval[MAX_FREQS];
+
+    dbar2 = cache_pulse(samples, lags, alphas, lag_times, env_model, nsamples, nalphas, s_samples, s_lags, s_cs_f, &n_good_samples);
+
+    maxidx[threadIdx.x] = 0;
+    maxval[threadIdx.x] = -1e6;
+
+    for(i = 0; i < nalphas; i++) {
+        pf = calc_pf(i, threadIdx.x, blockDim.x, nsamples, ce_matrix, se_matrix, s_samples, s_cs_f, n_good_samples, dbar2);
+
+        if (pf > maxval[threadIdx.x]) { 
+            maxidx[threadIdx.x] = (blockIdx.x * blockDim.x * nalphas) + (i * blockDim.x) + threadIdx.x;
+            maxval[threadIdx.x] = pf;
+        }
+    }
+
+    __syncthreads();
+    // parallel reduce maximum
+    for(i = blockDim.x/2; i > 0; i >>=1) {
+        if(threadIdx.x < i) {
+           if(maxval[threadIdx.x + i] > maxval[threadIdx.x]) {
+              maxval[threadIdx.x] = maxval[threadIdx.x + i];
+              maxidx[threadIdx.x] = maxidx[threadIdx.x + i];
+           }
+        }
+        __syncthreads();
+    }
+
+    if(threadIdx.x == 0) {
+        peaks[blockIdx.x] = maxidx[threadIdx.x];
+        n_good_lags_v[blockIdx.x] = n_good_samples;
+    }
+}
+
+// calculate P_f through the peak of each pulse for the streaming mode, thread for each freq, block across pulses
+// profiles[pulse] holds P_f along the freq axis (nfreqs), along the alpha axis (nalphas), then the spot around the peak
+__global__ void calc_profiles(float *samples, int32_t *lags, float *alphas, float *lag_times, float *ce_matrix, float *se_matrix, int32_t *peaks, double *profiles, float env_model, int32_t nsamples, int32_t nalphas)
+{
+    int32_t n_good_samples;
+    int32_t reach = (SPOT_WIDTH-1)/2;
+    int32_t nfreqs = blockDim.x;
+    int32_t peakidx = peaks[blockIdx.x];
+    int32_t alfidx = ((peakidx - (peakidx % nfreqs)) % (nfreqs * nalphas)) / nfreqs;
+    int32_t freqidx = peakidx % nfreqs;
+    double *profile = profiles + blockIdx.x * (nfreqs + nalphas + SPOT_WIDTH * SPOT_WIDTH);
+    double dbar2;
+
+    __shared__ float s_samples[MAX_SAMPLES * 2];
+    __shared__ int32_t s_lags[MAX_SAMPLES];
+    __shared__ float s_cs_f[MAX_ALPHAS];
+
+    dbar2 = cache_pulse(samples, lags, alphas, lag_times, env_model, nsamples, nalphas, s_samples, s_lags, s_cs_f, &n_good_samples);
+
+    profile[threadIdx.x] = calc_pf(alfidx, threadIdx.x, nfreqs, nsamples, ce_matrix, se_matrix, s_samples, s_cs_f, n_good_samples, dbar2);
+
+    if(threadIdx.x < nalphas) {
+        profile[nfreqs + threadIdx.x] = calc_pf(threadIdx.x, freqidx, nfreqs, nsamples, ce_matrix, se_matrix, s_samples, s_cs_f, n_good_samples, dbar2);
+    }
+
+    if(threadIdx.x < SPOT_WIDTH * SPOT_WIDTH) {
+        int32_t spot_alf = alfidx + threadIdx.x / SPOT_WIDTH - reach;
+        int32_t spot_freq = freqidx + threadIdx.x % SPOT_WIDTH - reach;
+        if(spot_alf >= 0 && spot_alf < nalphas && spot_freq >= 0 && spot_freq < nfreqs) {
+            profile[nfreqs + nalphas + threadIdx.x] = calc_pf(spot_alf, spot_freq, nfreqs, nsamples, ce_matrix, se_matrix, s_samples, s_cs_f, n_good_samples, dbar2);
+        }
+    }
+}
+
+// look up P_f[idx] from the profiles of the pulse on this thread, idx must be on the alpha or freq axis through the peak or in the spot
+// returns P_f like the value in the full P_f, so process_peaks and calc_peak are unchanged apart from the lookup
+__device__ double stream_pf(double *profiles, int32_t idx, int32_t peakidx, int32_t nalphas, int32_t nfreqs)
+{
+    int32_t reach = (SPOT_WIDTH-1)/2;
+    int32_t alfidx = ((idx - (idx % nfreqs)) % (nfreqs * nalphas)) / nfreqs;
+    int32_t freqidx = idx % nfreqs;
+    int32_t peakalf = ((peakidx - (peakidx % nfreqs)) % (nfreqs * nalphas)) / nfreqs;
+    int32_t peakfreq = peakidx % nfreqs;
+    double *profile = profiles + threadIdx.x * (nfreqs + nalphas + SPOT_WIDTH * SPOT_WIDTH);
+
+    if(alfidx == peakalf) {
+        return profile[freqidx];
+    }
+    if(freqidx == peakfreq) {
+        return profile[nfreqs + alfidx];
+    }
+    return profile[nfreqs + nalphas + (alfidx - peakalf + reach) * SPOT_WIDTH + (freqidx - peakfreq + reach)];
+}
+
+"""
+
+mod = pycuda.compiler.SourceModule(kernels)
+stream_mod = None # compiled with STREAM_PF when the first streaming engine is created
 
 # function to calculate P_f on CPU to check GPU calculations
 def calculate_bayes(s, t, f, alfs, env_model):
@@ -367,7 +551,11 @@ def calculate_bayes(s, t, f, alfs, env_model):
     return R_f, I_f, hbar2, P_f
 
 class BayesGPU:
-    def __init__(self, lags, freqs, alfs, npulses, env_model):
+    MAX_PULSES = 1024 # process_peaks runs a thread for each pulse in one block
+
+    # stream fuses calc_bayes and find_peaks so P_f is never stored on the GPU,
+    # only P_f along the alpha and freq axes through each peak is calculated for process_peaks
+    def __init__(self, lags, freqs, alfs, npulses, env_model, stream = False):
         self.lags = np.float32(np.array(lags))
         self.freqs = np.float32(np.array(freqs))
         self.alfs = np.float32(np.array(alfs))
@@ -378,6 +566,7 @@ class BayesGPU:
         self.nfreqs = np.int32(len(self.freqs))
       
         self.env_model = np.float32(env_model)
+        self.stream = stream
 
         # do some sanity checks on the input parameters..
         if np.log2(self.nfreqs) != int(np.log2(self.nfreqs)):
@@ -389,22 +578,26 @@ class BayesGPU:
         if self.nfreqs > 1024:
             print 'ERROR: number of frequencies exceeds maximum thread size'
          
-        if self.npulses > 1024:
+        if self.npulses > self.MAX_PULSES:
             print 'ERROR: number of pulses exceeds maximum thread size'
          
         if self.npulses <= 1:
             print 'ERROR: number of pulses must be at least 2'
 
-        # create matricies for processing
-        ce_matrix, se_matrix, CS_f = make_spacecube(lags, freqs, alfs, env_model)
-        ce_matrix_g = np.float32(np.swapaxes(ce_matrix,0,2)).flatten()
-        se_matrix_g = np.float32(np.swapaxes(se_matrix,0,2)).flatten()
+        # create matricies for processing, [alf][time][freq] from the cube cache
+        ce_matrix, se_matrix = cube_cache.get(make_enginecube, lags, freqs, alfs, env_model)
+        ce_matrix_g = ce_matrix.ravel()
+        se_matrix_g = se_matrix.ravel()
          
         # create dummy matricies to allocate on GPU
         lagmask = np.int32(np.zeros([self.npulses, self.nlags]))
         samples = np.float32(np.zeros([self.npulses, 2 * self.nlags]))
 
-        self.P_f = np.float64(np.zeros([self.npulses, self.nalfs, self.nfreqs]))
+        if self.stream:
+            self.P_f = None
+            self.profiles = np.float64(np.zeros([self.npulses, self.nfreqs + self.nalfs + 9])) # 9 is SPOT_WIDTH ** 2
+        else:
+            self.P_f = np.float64(np.zeros([self.npulses, self.nalfs, self.nfreqs]))
         self.peaks = np.int32(np.zeros(self.npulses))
         self.alf_fwhm = np.int32(np.zeros(self.npulses))
         self.freq_fwhm = np.int32(np.zeros(self.npulses))
@@ -419,7 +612,10 @@ class BayesGPU:
         self.lagmask_gpu = cuda.mem_alloc(lagmask.nbytes)
         self.ce_gpu = cuda.mem_alloc(ce_matrix_g.nbytes)
         self.se_gpu = cuda.mem_alloc(se_matrix_g.nbytes)
-        self.P_f_gpu = cuda.mem_alloc(self.P_f.nbytes) # 450 mb
+        if self.stream:
+            self.profiles_gpu = cuda.mem_alloc(self.profiles.nbytes)
+        else:
+            self.P_f_gpu = cuda.mem_alloc(self.P_f.nbytes) # 450 mb
         self.peaks_gpu = cuda.mem_alloc(self.peaks.nbytes)
         self.alf_fwhm_gpu = cuda.mem_alloc(self.alf_fwhm.nbytes)
         self.freq_fwhm_gpu = cuda.mem_alloc(self.freq_fwhm.nbytes)
@@ -443,9 +639,17 @@ class BayesGPU:
         cuda.memcpy_htod(self.alfs_gpu, self.alfs)
 
         # get cuda source modules
-        self.calc_bayes = mod.get_function('calc_bayes')
-        self.find_peaks = mod.get_function('find_peaks')
-        self.process_peaks = mod.get_function('process_peaks')
+        if self.stream:
+            global stream_mod
+            if stream_mod == None:
+                stream_mod = pycuda.compiler.SourceModule(kernels, options = ['-DSTREAM_PF'])
+            self.calc_bayes_stream = stream_mod.get_function('calc_bayes_stream')
+            self.calc_profiles = stream_mod.get_function('calc_profiles')
+            self.process_peaks = stream_mod.get_function('process_peaks')
+        else:
+            self.calc_bayes = mod.get_function('calc_bayes')
+            self.find_peaks = mod.get_function('find_peaks')
+            self.process_peaks = mod.get_function('process_peaks')
 
     def run_bayesfit(self, samples, lagmask, copy_samples = True):
         if copy_samples:
@@ -454,6 +658,12 @@ class BayesGPU:
             cuda.memcpy_htod(self.samples_gpu, self.samples)
             cuda.memcpy_htod(self.lagmask_gpu, self.lagmask)
     
+        if self.stream:
+            self.calc_bayes_stream(self.samples_gpu, self.lagmask_gpu, self.alfs_gpu, self.lag_times_gpu, self.ce_gpu, self.se_gpu, self.peaks_gpu, self.env_model, self.nlags, self.nalfs, self.n_good_lags_gpu, block = (int(self.nfreqs),1,1), grid = (int(self.npulses),1,1))
+            self.calc_profiles(self.samples_gpu, self.lagmask_gpu, self.alfs_gpu, self.lag_times_gpu, self.ce_gpu, self.se_gpu, self.peaks_gpu, self.profiles_gpu, self.env_model, self.nlags, self.nalfs, block = (int(self.nfreqs),1,1), grid = (int(self.npulses),1,1))
+            self.process_peaks(self.samples_gpu, self.ce_gpu, self.se_gpu, self.lag_times_gpu, self.freqs_gpu, self.alfs_gpu, self.profiles_gpu, self.snr_gpu, self.snr_peak_gpu, self.lagmask_gpu, self.n_good_lags_gpu, self.peaks_gpu, self.env_model, self.nfreqs, self.nalfs, self.nlags, self.alf_fwhm_gpu, self.freq_fwhm_gpu, self.amplitudes_gpu, block = (int(self.npulses),1,1))
+            return
+
         # about 90% of the time is spent on calc_bayes
         self.calc_bayes(self.samples_gpu, self.lagmask_gpu, self.alfs_gpu, self.lag_times_gpu, self.ce_gpu, self.se_gpu, self.P_f_gpu, self.env_model, self.nlags, self.nalfs, self.n_good_lags_gpu, block = (int(self.nfreqs),1,1), grid = (int(self.npulses),1,1))
         self.find_peaks(self.P_f_gpu, self.peaks_gpu, self.nalfs, block = (int(self.nfreqs),1,1), grid = (int(self.npulses),1))
@@ -461,9 +671,6 @@ class BayesGPU:
 
     
     def process_bayesfit(self, tfreq, noise):
-        self.tfreq = tfreq
-        self.noise = noise
-
         cuda.memcpy_dtoh(self.amplitudes, self.amplitudes_gpu)
         cuda.memcpy_dtoh(self.alf_fwhm, self.alf_fwhm_gpu)
         cuda.memcpy_dtoh(self.freq_fwhm, self.freq_fwhm_gpu)
@@ -472,55 +679,7 @@ class BayesGPU:
         cuda.memcpy_dtoh(self.snr, self.snr_gpu)
         cuda.memcpy_dtoh(self.snr_peak, self.snr_peak_gpu)
 
-        dalpha = self.alfs[1] - self.alfs[0]
-        dfreqs = self.freqs[1] - self.freqs[0]
-        
-        N = 2 * self.n_good_lags
-        
-        w_idx = ((self.peaks - (self.peaks % self.nfreqs)) % (self.nfreqs * self.nalfs)) / self.nfreqs
-        v_idx = self.peaks % self.nfreqs
-
-        self.w = (self.alfs[w_idx] * C) / (2. * np.pi * (tfreq * 1e3))
-        self.w_std = dalpha * (((C * self.alf_fwhm) / (2. * np.pi * (tfreq * 1e3))) / FWHM_TO_SIGMA)
-        self.w_e = self.w_std / np.sqrt(N)
-        
-        self.v = (self.freqs[v_idx] * C) / (2 * tfreq * 1e3)
-        self.v_std = dfreqs * ((((self.freq_fwhm) * C) / (2 * tfreq * 1e3)) / FWHM_TO_SIGMA)
-        self.v_e = self.v_std / np.sqrt(N)
-        
-        self.p = self.amplitudes / noise
-        self.p[self.p <= 0] = np.nan
-        self.p = 10 * np.log10(self.p)
-         
-        # raw freq/decay for debugging
-        self.vfreq = (self.freqs[v_idx])
-        self.walf = (self.alfs[w_idx])
-        
-        #self.phase_mse = np.zeros(self.npulses) # mse of fitted phase to sample phase for good lags
-        #self.envelope_mse = np.zeros(self.npulses) # mse of fitted envelope magnitude to sample good lag magnitudes 
-    
-        self.phi_sigma = np.zeros(self.npulses)
-        self.v_sigma = np.zeros(self.npulses)
-        self.slope_sigma = np.zeros(self.npulses)
-        # calculate mse for phase, amplitude, and overall signal for fitacf comparison
-        for (r, mask) in enumerate(self.lagmask):
-            goodmask = (mask == 1)
-            lagtimes = self.lags[goodmask]
-            samples_i = self.samples[r][0::2][goodmask]
-            samples_q = self.samples[r][1::2][goodmask]
-            signal = samples_i + 1j * samples_q
-            #fitted_envelope = self.amplitudes[r] * np.exp(-self.walf[r] * lagtimes)
-            #fitted_angle = 2 * np.pi * self.vfreq[r] * lagtimes
-            # we want unwrapped phase, right? otherwise we get artifacts at +/- 2 pi
-            #samples_angle = np.angle(samples_i + 1j * samples_q)
-            #samples_envelope = np.sqrt((samples_i ** 2) + (samples_q ** 2))
-            #self.phase_mse[r] = metrics.mean_squared_error(samples_angle, fitted_angle)
-            #self.envelope_mse[r] = metrics.mean_squared_error(samples_envelope, fitted_envelope)
-            phi_sigma,slope_sigma,v_sigma = phase_fit_error(signal, lagtimes, self.tfreq * 1000, self.v[r])
-            self.phi_sigma[r] = phi_sigma
-            self.slope_sigma[r] = slope_sigma
-            self.v_sigma[r] = v_sigma
-            #self.envelope_mse[r] = metrics.mean_squared_error(samples_envelope, fitted_envelope)
+        calc_fitparams(self, tfreq, noise)
 
 
     # pickle a pulse for later analysis
@@ -14,6 +14,7 @@ import time
 import getpass
 import pdb
 import os
+import lombtable
 
 MAX_LOMBDEPTH = 1
 DATADIR = '/home/radar/fitlomb/'
@@ -90,19 +91,23 @@ def getParam(lombfit, beam, param, starttime, endtime,  maskparam = False, blank
         return times, ranges, []
 
     rtiparam = np.ones([len(times), max(rgates), MAX_LOMBDEPTH])
+    values = lombtable.read_records(pulses, param)
+    if maskparam:
+        masks = lombtable.read_records(pulses, maskparam)
     
     for (t,pulse) in enumerate(pulses):
 
         zeropad = np.zeros([max(rgates) - pulse.attrs['nrang'], MAX_LOMBDEPTH])
         print param
         if maskparam:
-            rtiparam[t,:,:] = np.vstack((pulse[param][:] * pulse[maskparam][:], zeropad))
-            rtiparam[t,:,:] += (np.vstack((pulse[maskparam][:], zeropad)) == 0) * blank 
+            rtiparam[t,:,:] = np.vstack((values[t] * masks[t], zeropad))
+            rtiparam[t,:,:] += (np.vstack((masks[t], zeropad)) == 0) * blank 
         else:
-            rtiparam[t,:,:] = np.vstack((pulse[param][:], zeropad))
+            rtiparam[t,:,:] = np.vstack((values[t], zeropad))
     return times, ranges, rtiparam 
 
 # creates a file with all data from a radar in a folder using soft links
+# record groups of version 3 files are linked one at a time, version 4 files are linked as a whole (readers select their beams)
 def createMergefile(radar, starttime, endtime, datadir, beams = None):
     # for each day between starttime and endtime
     # loop, adding 1 day to starttime until delta between starttime and endtime is <= 1 day
@@ -117,6 +122,11 @@ def createMergefile(radar, starttime, endtime, datadir, beams = None):
         for h5f in hdf5files:
             try:
                 f = h5py.File(h5f, 'r')
+                if lombtable.layout_version(f) == lombtable.LAYOUT_VERSION:
+                    mergefile[os.path.basename(h5f)] = h5py.ExternalLink('../../../' + h5f, '/')
+                    f.close()
+                    continue
+
                 for pulse in f['/']:
                     if beams == None or f[pulse].attrs['bmnum'] in beams:
                         dset = pulse
@@ -158,13 +168,20 @@ def dt2epoch(dt):
 
 # returns a time sorted list of pulses 
 # beams is a list of beam numbers
+# pulses of version 3 files are record groups, pulses of version 4 files are lombtable.LombRecords
 def getPulses(lombfit, beams, starttime, endtime):
+    if lombtable.layout_version(lombfit) == lombtable.LAYOUT_VERSION:
+        return lombtable.table_records(lombfit, beams, dt2epoch(starttime), dt2epoch(endtime))
+
     # grap all pulses from a path (for example, a beam number)0
     pulses = []
     group_path =  '/'
     for t in lombfit[group_path]:
         pulse = lombfit[group_path + t]
-        if pulse.attrs['epoch.time'] >= dt2epoch(starttime) \
+        # version 4 files linked into a merge file
+        if lombtable.layout_version(pulse) == lombtable.LAYOUT_VERSION:
+            pulses += lombtable.table_records(pulse, beams, dt2epoch(starttime), dt2epoch(endtime))
+        elif pulse.attrs['epoch.time'] >= dt2epoch(starttime) \
                 and pulse.attrs['epoch.time'] <= dt2epoch(endtime)\
                 and pulse.attrs['bmnum'] in [int(b) for b in beams]:
             pulses.append(pulse)
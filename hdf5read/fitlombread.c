@@ -61,19 +61,40 @@ int RadarParmSetOriginCommand(struct RadarParm *ptr,char *str);
 int RadarParmSetCombf(struct RadarParm *ptr,char *str);
 void RadarParmFree(struct RadarParm *ptr);
 
+// version 3 files have a group for each record, version 4 files have a row for each record in the prm table
+// and in a dataset for each parameter, they are marked with a fitlomb.layout attribute on the root group
 int32_t LombFitOpen(struct LombFile *lombfile, char *filename)
 {
     H5G_info_t ginfo;
+    int8_t layout = 3;
     lombfile->file_id = H5Fopen(filename, H5F_ACC_RDONLY, H5P_DEFAULT);
     lombfile->root_group = H5Gopen(lombfile->file_id, "/", H5P_DEFAULT);
+    lombfile->pulseidx = 0;
+
+    if (H5Aexists(lombfile->root_group, "fitlomb.layout") > 0) {
+        LombFitReadAttr(lombfile, "/", "fitlomb.layout", &layout);
+    }
+    lombfile->layout = layout;
+
+    if (lombfile->layout == 4) {
+        hid_t prmspace;
+        lombfile->prm = H5Dopen(lombfile->file_id, "prm", H5P_DEFAULT);
+        prmspace = H5Dget_space(lombfile->prm);
+        H5Sget_simple_extent_dims(prmspace, &lombfile->nrecords, NULL);
+        lombfile->status = H5Sclose(prmspace);
+        return lombfile->status;
+    }
+
     lombfile->status = H5Gget_info (lombfile->root_group, &ginfo);
     lombfile->nrecords = ginfo.nlinks;
-    lombfile->pulseidx = 0;
     return lombfile->status;
 }
 
 int32_t LombFitClose(struct LombFile *lombfile)
 {
+    if (lombfile->layout == 4) {
+        H5Dclose(lombfile->prm);
+    }
     lombfile->status = H5Gclose(lombfile->root_group);
     lombfile->status = H5Fclose(lombfile->file_id);
     return lombfile->status;
@@ -140,11 +161,125 @@ void * LombFitReadVector(hid_t recordgroup, char *dsetname)
 }
 
 
+// read count values of a column of the prm table of a version 4 file, starting at record start
+// scalars that aren't in the prm table (the same for every record) are read from attributes of the root group
+herr_t LombFitReadField(struct LombFile *lombfile, char *fieldname, hsize_t start, hsize_t count, void *fielddata)
+{
+    hid_t filetype, membertype, fieldtype, memtype, filespace, memspace;
+    herr_t status;
+
+    if (H5Aexists(lombfile->root_group, fieldname) > 0) {
+        return LombFitReadAttr(lombfile, "/", fieldname, fielddata);
+    }
+
+    // read the field into a compound type with only that member, in native byte order
+    filetype = H5Dget_type(lombfile->prm);
+    membertype = H5Tget_member_type(filetype, H5Tget_member_index(filetype, fieldname));
+    fieldtype = H5Tget_native_type(membertype, H5T_DIR_ASCEND);
+    memtype = H5Tcreate(H5T_COMPOUND, H5Tget_size(fieldtype));
+    H5Tinsert(memtype, fieldname, 0, fieldtype);
+
+    filespace = H5Dget_space(lombfile->prm);
+    H5Sselect_hyperslab(filespace, H5S_SELECT_SET, &start, NULL, &count, NULL);
+    memspace = H5Screate_simple(1, &count, NULL);
+
+    status = H5Dread(lombfile->prm, memtype, memspace, filespace, H5P_DEFAULT, fielddata);
+
+    H5Sclose(memspace);
+    H5Sclose(filespace);
+    H5Tclose(memtype);
+    H5Tclose(fieldtype);
+    H5Tclose(membertype);
+    H5Tclose(filetype);
+    return status;
+}
+
+// read the row of the current record from a parameter dataset of a version 4 file, including padding past nrang
+// rows are converted to memtype (e.g H5T_NATIVE_DOUBLE for parameters stored as float32), so unlike LombFitReadVector they aren't swapped
+// bit packed flags (datasets with a packed attribute, 8 range gates to a byte) are unpacked
+// returns NULL if the file doesn't have the parameter (e.g sigma fits were disabled)
+void * LombFitReadRow(struct LombFile *lombfile, char *dsetname, hid_t memtype)
+{
+    hid_t dset, filespace, memspace;
+    hsize_t dims[3];
+    hsize_t start[3] = {0, 0, 0};
+    hsize_t count[3];
+    size_t rowlen = 1;
+    size_t passes = 1;
+    int rank, i;
+    htri_t packed;
+    uint8_t *rowdata;
+
+    if (H5Lexists(lombfile->root_group, dsetname, H5P_DEFAULT) <= 0) {
+        return NULL;
+    }
+
+    dset = H5Dopen(lombfile->file_id, dsetname, H5P_DEFAULT);
+    filespace = H5Dget_space(dset);
+    rank = H5Sget_simple_extent_dims(filespace, dims, NULL);
+    packed = H5Aexists(dset, "packed");
+
+    start[0] = lombfile->pulseidx;
+    count[0] = 1;
+    for (i = 1; i < rank; i++) {
+        count[i] = dims[i];
+        rowlen *= dims[i];
+    }
+    if (rank > 2) {
+        passes = dims[2];
+    }
+
+    H5Sselect_hyperslab(filespace, H5S_SELECT_SET, start, NULL, count, NULL);
+    memspace = H5Screate_simple(rank, count, NULL);
+
+    if (packed > 0) {
+        // unpack [byte][pass] to [range gate][pass] bytes in place from the end, then convert to memtype
+        size_t bit;
+        rowdata = malloc(8 * rowlen * (H5Tget_size(memtype) > 1 ? H5Tget_size(memtype) : 1));
+        H5Dread(dset, H5T_NATIVE_UINT8, memspace, filespace, H5P_DEFAULT, rowdata);
+
+        for (bit = 8 * rowlen; bit-- > 0;) {
+            size_t gate = bit / passes;
+            size_t pass = bit % passes;
+            rowdata[bit] = (rowdata[(gate / 8) * passes + pass] >> (7 - gate % 8)) & 1;
+        }
+        H5Tconvert(H5T_NATIVE_UINT8, memtype, 8 * rowlen, rowdata, NULL, H5P_DEFAULT);
+    }
+    else {
+        rowdata = malloc(rowlen * H5Tget_size(memtype));
+        H5Dread(dset, memtype, memspace, filespace, H5P_DEFAULT, rowdata);
+    }
+
+    H5Sclose(memspace);
+    H5Sclose(filespace);
+    H5Dclose(dset);
+    return rowdata;
+}
+
+// read a scalar of the current record, from its group (version 3) or its row of the prm table (version 4)
+herr_t LombFitReadScalar(struct LombFile *lombfile, char *groupname, char *name, void *data)
+{
+    if (lombfile->layout == 4) {
+        return LombFitReadField(lombfile, name, lombfile->pulseidx, 1, data);
+    }
+    return LombFitReadAttr(lombfile, groupname, name, data);
+}
+
+// read a vector of the current record, from its group (version 3) or its row of a parameter dataset (version 4)
+// rows of version 4 files are read as memtype, vectors of version 3 files as the type they were written with
+void * LombFitReadRecordVector(struct LombFile *lombfile, hid_t recordgroup, char *dsetname, hid_t memtype)
+{
+    if (lombfile->layout == 4) {
+        return LombFitReadRow(lombfile, dsetname, memtype);
+    }
+    return LombFitReadVector(recordgroup, dsetname);
+}
+
 int LombFitRead(struct LombFile *lombfile, struct RadarParm *rprm, struct FitData *fit)
 {
-    char *groupname;
+    char *groupname = NULL;
     ssize_t groupnamesize;
-    hid_t recordgroup;
+    hid_t recordgroup = -1;
 
     
     // return zero if no pulses remain to be read 
@@ -153,10 +288,13 @@ int LombFitRead(struct LombFile *lombfile, struct RadarParm *rprm, struct FitDat
     }
 
     // get name of next record (get name size, allocate space, grab name)
-    groupnamesize = 1 + H5Lget_name_by_idx (lombfile->root_group, ".", H5_INDEX_NAME, H5_ITER_INC, lombfile->pulseidx, NULL, 0, H5P_DEFAULT);
-    groupname = (char *) malloc (groupnamesize);
-    groupnamesize = H5Lget_name_by_idx (lombfile->root_group, ".", H5_INDEX_NAME, H5_ITER_INC, lombfile->pulseidx, groupname, (size_t) groupnamesize, H5P_DEFAULT);
-    recordgroup = H5Gopen(lombfile->file_id, groupname, H5P_DEFAULT);
+    // version 4 files are read by row, see LombFitReadScalar and LombFitReadRecordVector
+    if (lombfile->layout != 4) {
+        groupnamesize = 1 + H5Lget_name_by_idx (lombfile->root_group, ".", H5_INDEX_NAME, H5_ITER_INC, lombfile->pulseidx, NULL, 0, H5P_DEFAULT);
+        groupname = (char *) malloc (groupnamesize);
+        groupnamesize = H5Lget_name_by_idx (lombfile->root_group, ".", H5_INDEX_NAME, H5_ITER_INC, lombfile->pulseidx, groupname, (size_t) groupnamesize, H5P_DEFAULT);
+        recordgroup = H5Gopen(lombfile->file_id, groupname, H5P_DEFAULT);
+    }
     
     // read record information into RadarParm and FitData structures
     fit->revision.major = REV_MAJOR;
@@ -168,7 +306,7 @@ int LombFitRead(struct LombFile *lombfile, struct RadarParm *rprm, struct FitDat
     // read in noise information
     fit->noise.vel = 0; // not currently produced by fitlomb 
     fit->noise.skynoise = 0; // not current produced by fitlomb
-    LombFitReadAttr(lombfile, groupname, "noise.lag0", &fit->noise.lag0);
+    LombFitReadScalar(lombfile, groupname, "noise.lag0", &fit->noise.lag0);
     // populate rprm origin struct
     //rprm->origin.time = // char *
     
@@ -182,62 +320,62 @@ int LombFitRead(struct LombFile *lombfile, struct RadarParm *rprm, struct FitDat
     origin_time = gmtime(&origin_time_raw);
     RadarParmSetOriginTime(rprm, asctime(origin_time));
 
-    LombFitReadAttr(lombfile, groupname, "stid", &rprm->stid);
-    LombFitReadAttr(lombfile, groupname, "cp", &rprm->cp);
+    LombFitReadScalar(lombfile, groupname, "stid", &rprm->stid);
+    LombFitReadScalar(lombfile, groupname, "cp", &rprm->cp);
     // populate rprm time struct (int16)
-    LombFitReadAttr(lombfile, groupname, "time.yr", &rprm->time.yr);
-    LombFitReadAttr(lombfile, groupname, "time.mo", &rprm->time.mo);
-    LombFitReadAttr(lombfile, groupname, "time.dy", &rprm->time.dy);
-    LombFitReadAttr(lombfile, groupname, "time.hr", &rprm->time.hr);
-    LombFitReadAttr(lombfile, groupname, "time.mt", &rprm->time.mt);
-    LombFitReadAttr(lombfile, groupname, "time.sc", &rprm->time.sc);
-    LombFitReadAttr(lombfile, groupname, "time.us", &rprm->time.us);
-
-    LombFitReadAttr(lombfile, groupname, "txpow", &rprm->txpow);
-    LombFitReadAttr(lombfile, groupname, "nave", &rprm->nave);
-    LombFitReadAttr(lombfile, groupname, "atten", &rprm->atten);
-    LombFitReadAttr(lombfile, groupname, "lagfr", &rprm->lagfr); 
-    LombFitReadAttr(lombfile, groupname, "smsep", &rprm->smsep);
-    LombFitReadAttr(lombfile, groupname, "ercod", &rprm->ercod);
+    LombFitReadScalar(lombfile, groupname, "time.yr", &rprm->time.yr);
+    LombFitReadScalar(lombfile, groupname, "time.mo", &rprm->time.mo);
+    LombFitReadScalar(lombfile, groupname, "time.dy", &rprm->time.dy);
+    LombFitReadScalar(lombfile, groupname, "time.hr", &rprm->time.hr);
+    LombFitReadScalar(lombfile, groupname, "time.mt", &rprm->time.mt);
+    LombFitReadScalar(lombfile, groupname, "time.sc", &rprm->time.sc);
+    LombFitReadScalar(lombfile, groupname, "time.us", &rprm->time.us);
+
+    LombFitReadScalar(lombfile, groupname, "txpow", &rprm->txpow);
+    LombFitReadScalar(lombfile, groupname, "nave", &rprm->nave);
+    LombFitReadScalar(lombfile, groupname, "atten", &rprm->atten);
+    LombFitReadScalar(lombfile, groupname, "lagfr", &rprm->lagfr); 
+    LombFitReadScalar(lombfile, groupname, "smsep", &rprm->smsep);
+    LombFitReadScalar(lombfile, groupname, "ercod", &rprm->ercod);
     
     // populate stat struct (int16)
-    //LombFitReadAttr(lombfile, groupname, "stat.agc", &rprm->stat.agc);
-    //LombFitReadAttr(lombfile, groupname, "stat.lopwr", &rprm->stat.lopwr);
+    //LombFitReadScalar(lombfile, groupname, "stat.agc", &rprm->stat.agc);
+    //LombFitReadScalar(lombfile, groupname, "stat.lopwr", &rprm->stat.lopwr);
     
     // populate noise struct (float)
-    LombFitReadAttr(lombfile, groupname, "noise.search", &rprm->noise.search);
-    LombFitReadAttr(lombfile, groupname, "noise.mean", &rprm->noise.mean);
+    LombFitReadScalar(lombfile, groupname, "noise.search", &rprm->noise.search);
+    LombFitReadScalar(lombfile, groupname, "noise.mean", &rprm->noise.mean);
     
-    LombFitReadAttr(lombfile, groupname, "channel", &rprm->channel);
-    LombFitReadAttr(lombfile, groupname, "bmnum", &rprm->bmnum);
-    LombFitReadAttr(lombfile, groupname, "bmazm", &rprm->bmazm);
-    LombFitReadAttr(lombfile, groupname, "scan", &rprm->scan);
-    LombFitReadAttr(lombfile, groupname, "rxrise", &rprm->rxrise);
+    LombFitReadScalar(lombfile, groupname, "channel", &rprm->channel);
+    LombFitReadScalar(lombfile, groupname, "bmnum", &rprm->bmnum);
+    LombFitReadScalar(lombfile, groupname, "bmazm", &rprm->bmazm);
+    LombFitReadScalar(lombfile, groupname, "scan", &rprm->scan);
+    LombFitReadScalar(lombfile, groupname, "rxrise", &rprm->rxrise);
 
     // populate intt structure
-    LombFitReadAttr(lombfile, groupname, "intt.sc", &rprm->intt.sc);
-    LombFitReadAttr(lombfile, groupname, "intt.us", &rprm->intt.us);
+    LombFitReadScalar(lombfile, groupname, "intt.sc", &rprm->intt.sc);
+    LombFitReadScalar(lombfile, groupname, "intt.us", &rprm->intt.us);
     
-    LombFitReadAttr(lombfile, groupname, "txpl", &rprm->txpl);
-    LombFitReadAttr(lombfile, groupname, "mpinc", &rprm->mpinc);
-    LombFitReadAttr(lombfile, groupname, "mppul", &rprm->mppul);
-    LombFitReadAttr(lombfile, groupname, "mplgs", &rprm->mplgs);
-    //LombFitReadAttr(lombfile, groupname, "", &rprm->mplgexs);
-    LombFitReadAttr(lombfile, groupname, "nrang", &rprm->nrang);
-    LombFitReadAttr(lombfile, groupname, "frang", &rprm->frang);
-    LombFitReadAttr(lombfile, groupname, "rsep", &rprm->rsep);
-    LombFitReadAttr(lombfile, groupname, "xcf", &rprm->xcf);
-    LombFitReadAttr(lombfile, groupname, "tfreq", &rprm->tfreq);
-    LombFitReadAttr(lombfile, groupname, "offset", &rprm->offset);
-    //    LombFitReadAttr(lombfile, groupname, "ifmode", &rprm->ifmode);
-
-    LombFitReadAttr(lombfile, groupname, "mxpwr", &rprm->mxpwr);
-    LombFitReadAttr(lombfile, groupname, "lvmax", &rprm->lvmax);
+    LombFitReadScalar(lombfile, groupname, "txpl", &rprm->txpl);
+    LombFitReadScalar(lombfile, groupname, "mpinc", &rprm->mpinc);
+    LombFitReadScalar(lombfile, groupname, "mppul", &rprm->mppul);
+    LombFitReadScalar(lombfile, groupname, "mplgs", &rprm->mplgs);
+    //LombFitReadScalar(lombfile, groupname, "", &rprm->mplgexs);
+    LombFitReadScalar(lombfile, groupname, "nrang", &rprm->nrang);
+    LombFitReadScalar(lombfile, groupname, "frang", &rprm->frang);
+    LombFitReadScalar(lombfile, groupname, "rsep", &rprm->rsep);
+    LombFitReadScalar(lombfile, groupname, "xcf", &rprm->xcf);
+    LombFitReadScalar(lombfile, groupname, "tfreq", &rprm->tfreq);
+    LombFitReadScalar(lombfile, groupname, "offset", &rprm->offset);
+    //    LombFitReadScalar(lombfile, groupname, "ifmode", &rprm->ifmode);
+
+    LombFitReadScalar(lombfile, groupname, "mxpwr", &rprm->mxpwr);
+    LombFitReadScalar(lombfile, groupname, "lvmax", &rprm->lvmax);
 
     // copy pulse and lag vectors
     int16_t *ltab, *ptab;
-    ltab = LombFitReadVector(recordgroup, "ltab");
-    ptab = LombFitReadVector(recordgroup, "ptab");
+    ltab = LombFitReadRecordVector(lombfile, recordgroup, "ltab", H5T_NATIVE_INT16);
+    ptab = LombFitReadRecordVector(lombfile, recordgroup, "ptab", H5T_NATIVE_INT16);
     RadarParmSetPulse(rprm, rprm->mppul, ptab);
     RadarParmSetLag(rprm, rprm->mplgs, ltab);
 
@@ -249,26 +387,26 @@ int LombFitRead(struct LombFile *lombfile, struct RadarParm *rprm, struct FitDat
     uint16_t nrang = 0;
     uint16_t i;
     uint16_t lomb_iterations = 0;
-    LombFitReadAttr(lombfile, groupname, "nrang", &nrang);
-    LombFitReadAttr(lombfile, groupname, "fitlomb.bayes.iterations", &lomb_iterations);
+    LombFitReadScalar(lombfile, groupname, "nrang", &nrang);
+    LombFitReadScalar(lombfile, groupname, "fitlomb.bayes.iterations", &lomb_iterations);
     FitSetRng(fit, nrang); 
 
-    v = LombFitReadVector(recordgroup, "v");
-    v_err = LombFitReadVector(recordgroup, "v_e");
+    v = LombFitReadRecordVector(lombfile, recordgroup, "v", H5T_NATIVE_DOUBLE);
+    v_err = LombFitReadRecordVector(lombfile, recordgroup, "v_e", H5T_NATIVE_DOUBLE);
     p_0 = NULL;
-    p_l = LombFitReadVector(recordgroup, "p_l");
-    p_l_err = LombFitReadVector(recordgroup, "p_l_e");
-    w_l = LombFitReadVector(recordgroup, "w_l");
-    w_l_err = LombFitReadVector(recordgroup, "w_l_e");
-    w_s = LombFitReadVector(recordgroup, "w_s");
-    w_s_err = LombFitReadVector(recordgroup, "w_s_e");
+    p_l = LombFitReadRecordVector(lombfile, recordgroup, "p_l", H5T_NATIVE_DOUBLE);
+    p_l_err = LombFitReadRecordVector(lombfile, recordgroup, "p_l_e", H5T_NATIVE_DOUBLE);
+    w_l = LombFitReadRecordVector(lombfile, recordgroup, "w_l", H5T_NATIVE_DOUBLE);
+    w_l_err = LombFitReadRecordVector(lombfile, recordgroup, "w_l_e", H5T_NATIVE_DOUBLE);
+    w_s = LombFitReadRecordVector(lombfile, recordgroup, "w_s", H5T_NATIVE_DOUBLE);
+    w_s_err = LombFitReadRecordVector(lombfile, recordgroup, "w_s_e", H5T_NATIVE_DOUBLE);
     phi0 = NULL; // not produced by fitlomb
     phi0_err = NULL; // not produced by fitlomb
-    sdev_l = LombFitReadVector(recordgroup, "v_l_std");
-    sdev_s = LombFitReadVector(recordgroup, "v_s_std");
+    sdev_l = LombFitReadRecordVector(lombfile, recordgroup, "v_l_std", H5T_NATIVE_DOUBLE);
+    sdev_s = LombFitReadRecordVector(lombfile, recordgroup, "v_s_std", H5T_NATIVE_DOUBLE);
     sdev_phi = NULL; // not produced by fitlomb
 
-    qflg = LombFitReadVector(recordgroup, "qflg");
+    qflg = LombFitReadRecordVector(lombfile, recordgroup, "qflg", H5T_NATIVE_INT32);
     gsct =  NULL; // not produced by fitlomb
     nump = NULL; // not produced by fitlomb
     
@@ -284,10 +422,12 @@ int LombFitRead(struct LombFile *lombfile, struct RadarParm *rprm, struct FitDat
         fit->rng[i].p_l_err = p_l_err[idx];
         fit->rng[i].w_l = w_l[idx];
         fit->rng[i].w_l_err = w_l_err[idx];
-        fit->rng[i].w_s = w_s[idx];
-        fit->rng[i].w_s_err = w_s_err[idx];
         fit->rng[i].sdev_l = sdev_l[idx];
-        fit->rng[i].sdev_s = sdev_s[idx];
+
+        // sigma fits are optional in version 4 files 
+        fit->rng[i].w_s = w_s ? w_s[idx] : -1;
+        fit->rng[i].w_s_err = w_s_err ? w_s_err[idx] : -1;
+        fit->rng[i].sdev_s = sdev_s ? sdev_s[idx] : -1;
 
         // int32
         fit->rng[i].qflg = (int)qflg[idx];
@@ -321,7 +461,9 @@ int LombFitRead(struct LombFile *lombfile, struct RadarParm *rprm, struct FitDat
     free(ptab);
 
     lombfile->pulseidx++;
-    lombfile->status = H5Gclose(recordgroup);
+    if (lombfile->layout != 4) {
+        lombfile->status = H5Gclose(recordgroup);
+    }
     return 1;
 }
 
@@ -347,6 +489,28 @@ int LombFitSeek(struct LombFile *lombfile, int yr,int mo,int dy,int hr,int mt,in
     *atme = 0;   
     lombfile->pulseidx = 0;
 
+    // version 4 files have the epoch time of every record in one column of the prm table
+    if (lombfile->layout == 4) {
+        int64_t *recordtimes = malloc(sizeof(int64_t) * lombfile->nrecords);
+        hsize_t r;
+        LombFitReadField(lombfile, "epoch.time", 0, lombfile->nrecords, recordtimes);
+
+        for(r = 0; r < lombfile->nrecords; r++) {
+            if (recordtimes[r] > seektime) {
+                int32_t time_us;
+                lombfile->pulseidx = r - 1;
+
+                LombFitReadField(lombfile, "time.us", r, 1, &time_us);
+                *atme = (double) recordtimes[r] + ((double) time_us) / 1e6;
+                retval = lombfile->pulseidx;
+                break;
+            }
+        }
+
+        free(recordtimes);
+        return retval;
+    }
+
     // check epoch time on records, compare against given time
     for(i = 0; i < lombfile->nrecords; i++) {
         char *groupname;
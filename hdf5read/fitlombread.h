@@ -4,6 +4,8 @@ struct LombFile {
     herr_t status; /* status of last HDF5 command */
     hsize_t nrecords; /* number of pulses in file */
     hsize_t pulseidx; /* index of current pulse in array */
+    int32_t layout; /* file layout version, 3 (group per record) or 4 (dataset per parameter) */
+    hid_t prm; /* prm table of a version 4 file */
 };
 
 
@@ -11,6 +13,10 @@ int32_t LombFitOpen(struct LombFile *lombfile, char *filename);
 int32_t LombFitClose(struct LombFile *lombfile);
 herr_t LombFitReadAttr(struct LombFile *lombfile, char *groupname, char *attrname, void *attrdata);
 void * LombFitReadVector(hid_t recordgroup, char *dsetname);
+herr_t LombFitReadField(struct LombFile *lombfile, char *fieldname, hsize_t start, hsize_t count, void *fielddata);
+void * LombFitReadRow(struct LombFile *lombfile, char *dsetname, hid_t memtype);
+herr_t LombFitReadScalar(struct LombFile *lombfile, char *groupname, char *name, void *data);
+void * LombFitReadRecordVector(struct LombFile *lombfile, hid_t recordgroup, char *dsetname, hid_t memtype);
 int LombFitRead(struct LombFile *lombfile, struct RadarParm *rprm, struct FitData *fit);
 int LombFitSeek(struct LombFile *lombfile, int yr,int mo,int dy,int hr,int mt,int sc,double *atme);
 
@@ -0,0 +1,156 @@
+#/usr/bin/python2
+# jon klein, jtklein@alaska.edu
+# multi-frequency bayesian fit over line of sight velocity, critical frequency, and decay
+# for frequency hopping or multi-tfreq sequences, where each sample has its own transmit frequency
+# the phase of each sample depends on Vlos through the refractive index at its tfreq (see timecube.make_hypertables),
+# so the fit searches a (Vlos, fcrit, alpha) grid instead of the (freq, alpha) grid of BayesCPU
+# the 4-D cubes of make_hyperspacecube are never built: cos/sin tiles are made for a chunk of velocities at a time
+# (or a chunk of critical frequencies of one velocity, for large grids), sized so the tiles and the posterior of the chunk
+# fit in maxbytes, and only the running max of each range gate is kept
+# BayesHyper only finds the peak (Vlos, fcrit, alpha) of each range gate, it isn't one of the get_engine backends:
+# rawacf records have one tfreq, so Vlos and fcrit can't be separated, and it has no fwhm/error outputs for WriteLSSFit
+# mit license
+
+import numpy as np
+import time
+from timecube import make_hypertables, make_hyperenvelope
+
+HYPER_CHUNK_BYTES = 256 * 2 ** 20 # default memory cap for evaluating one chunk of velocities
+HYPER_TEMPS = 8 # float64 [pulse][fcrit][alpha] temporaries held for each velocity in a chunk
+
+class BayesHyper:
+    # tfreqs and times are the transmit frequency (hz) and time (s) of each sample
+    # fcrits, vlos, and alfs are the critical frequency (hz), velocity (m/s), and decay grids to search
+    def __init__(self, tfreqs, times, fcrits, vlos, alfs, npulses, env_model, maxbytes = HYPER_CHUNK_BYTES):
+        self.tfreqs = np.float64(np.array(tfreqs))
+        self.times = np.float64(np.array(times))
+        self.fcrits = np.float64(np.array(fcrits))
+        self.vlos = np.float64(np.array(vlos))
+        self.alfs = np.float64(np.array(alfs))
+
+        self.npulses = npulses
+        self.nlags = len(self.times)
+        self.nfcrits = len(self.fcrits)
+        self.nvlos = len(self.vlos)
+        self.nalfs = len(self.alfs)
+        self.env_model = env_model
+
+        if len(self.tfreqs) != self.nlags:
+            raise ValueError('tfreqs and times must be the same length')
+
+        self.envelope = make_hyperenvelope(self.times, self.alfs, env_model) # [alpha][time]
+
+        # grid points per chunk, from the bytes of the cos/sin tiles [time] and posterior temporaries [pulse][alpha] of a (Vlos, fcrit) point,
+        # after the envelope weighted samples [pulse][time][alpha] held for the whole fit
+        # a chunk is vchunk velocities, or fchunk critical frequencies of one velocity if a whole velocity doesn't fit
+        pointbytes = 8 * (2 * self.nlags + HYPER_TEMPS * self.npulses * self.nalfs)
+        budget = maxbytes - 8 * 2 * self.npulses * self.nlags * self.nalfs
+        if budget < pointbytes:
+            raise ValueError('maxbytes of ' + str(maxbytes) + ' is too small for one grid point, at least ' + str(maxbytes - budget + pointbytes) + ' bytes are needed')
+        self.vchunk = int(max(1, min(self.nvlos, budget // (pointbytes * self.nfcrits))))
+        self.fchunk = int(min(self.nfcrits, budget // pointbytes))
+
+        self.peaks = np.zeros(npulses, dtype=np.int64) # flat index into [vlos][fcrit][alpha]
+        self.pfmax = np.zeros(npulses)
+        self.amplitudes = np.zeros(npulses)
+        self.vlos_fit = np.zeros(npulses)
+        self.fcrit_fit = np.zeros(npulses)
+        self.alf_fit = np.zeros(npulses)
+
+    # samples are [pulse][2 * time] interleaved i/q and lagmask is [pulse][time], like the other engines
+    def run_bayesfit(self, samples, lagmask):
+        goodmask = (np.array(lagmask) != 0)
+        samples = np.float64(np.array(samples)).reshape(self.npulses, 2 * self.nlags)
+        s_i = samples[:,0::2] * goodmask
+        s_q = samples[:,1::2] * goodmask
+
+        n_good = np.sum(goodmask, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dbar2 = np.sum(s_i ** 2 + s_q ** 2, axis=1) / (2 * n_good)
+        cs_f = np.dot(goodmask, (self.envelope ** 2).T) # [pulse][alpha]
+
+        # samples weighted by the envelope of each alpha [pulse][time][alpha], so each chunk is four matrix products
+        s_ie = s_i[:,:,np.newaxis] * self.envelope.T
+        s_qe = s_q[:,:,np.newaxis] * self.envelope.T
+
+        pulses = np.arange(self.npulses)
+        pfmax = np.ones(self.npulses) * -np.inf
+        peaks = np.zeros(self.npulses, dtype=np.int64)
+        amplitudes = np.zeros(self.npulses)
+
+        # chunks in the order of the flat [vlos][fcrit][alpha] index
+        chunks = [(v0, min(v0 + self.vchunk, self.nvlos), f0, min(f0 + self.fchunk, self.nfcrits)) for v0 in xrange(0, self.nvlos, self.vchunk) for f0 in xrange(0, self.nfcrits, self.fchunk)]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for (v0, v1, f0, f1) in chunks:
+                c_matrix, s_matrix = make_hypertables(self.tfreqs, self.times, self.fcrits[f0:f1], self.vlos[v0:v1])
+                c_matrix = c_matrix.reshape(-1, self.nlags) # [vlos * fcrit][time]
+                s_matrix = s_matrix.reshape(-1, self.nlags)
+
+                r_f = np.matmul(c_matrix, s_ie) + np.matmul(s_matrix, s_qe) # [pulse][vlos * fcrit][alpha]
+                i_f = np.matmul(s_matrix, s_ie) - np.matmul(c_matrix, s_qe)
+                hbar2 = (r_f ** 2 + i_f ** 2) / cs_f[:,np.newaxis,:]
+                pf = np.log10(2 * (n_good * dbar2)[:,np.newaxis,np.newaxis] - hbar2) * (1 - n_good)[:,np.newaxis,np.newaxis] - np.log10(cs_f)[:,np.newaxis,:]
+
+                # nan where fcrit is above a tfreq or a gate has no good lags
+                pf = np.where(np.isnan(pf), -np.inf, pf).reshape(self.npulses, -1)
+                chunkmax = np.argmax(pf, axis=1)
+
+                # strictly greater, so ties keep the first peak like argmax over the whole grid
+                better = pf[pulses, chunkmax] > pfmax
+                pfmax[better] = pf[pulses, chunkmax][better]
+                vidx, fidx, aidx = np.unravel_index(chunkmax, (v1 - v0, f1 - f0, self.nalfs))
+                peaks[better] = (((v0 + vidx) * self.nfcrits + f0 + fidx) * self.nalfs + aidx)[better]
+
+                hbar2 = hbar2.reshape(self.npulses, -1)[pulses, chunkmax]
+                amplitudes[better] = np.sqrt(hbar2 / cs_f[pulses, chunkmax % self.nalfs])[better]
+
+        self.peaks[:] = peaks
+        self.pfmax[:] = pfmax
+        self.amplitudes[:] = amplitudes
+        self.vlos_fit[:] = self.vlos[peaks // (self.nfcrits * self.nalfs)]
+        self.fcrit_fit[:] = self.fcrits[(peaks // self.nalfs) % self.nfcrits]
+        self.alf_fit[:] = self.alfs[peaks % self.nalfs]
+
+        # range gates without a finite posterior anywhere on the grid have no fit
+        nofit = np.isinf(pfmax)
+        self.vlos_fit[nofit] = np.nan
+        self.fcrit_fit[nofit] = np.nan
+        self.alf_fit[nofit] = np.nan
+        self.amplitudes[nofit] = np.nan
+
+# fit a synthetic two frequency sequence with chunks of critical frequencies, of single velocities, and of many velocities
+def main(npulses = 75, nlags = 24, resolution = 64):
+    C = 299792458.
+    tfreqs = np.where(np.arange(nlags) % 2, 14.1e6, 10.3e6)
+    times = np.arange(nlags) * 2.4e-3
+    vlos = np.linspace(-1000, 1000, 2 * resolution)
+    fcrits = np.linspace(0, 9e6, resolution // 4)
+    alfs = np.linspace(0, 200, resolution)
+
+    np.random.seed(0)
+    V = np.random.uniform(-800, 800, npulses)
+    FC = np.random.uniform(0, 8e6, npulses)
+    U = np.random.uniform(10, 150, npulses)
+    ns = np.sqrt(1 - FC[:,np.newaxis] ** 2 / tfreqs ** 2)
+    theta = 2 * np.pi * 2 * tfreqs * ns * V[:,np.newaxis] / C * times
+    signal = np.exp(1j * theta - np.outer(U, times)) * 100
+    signal += 10 * (np.random.randn(npulses, nlags) + 1j * np.random.randn(npulses, nlags))
+    lagmask = np.int8(np.random.rand(npulses, nlags) > .2)
+    samples = np.zeros([npulses, 2 * nlags], dtype=np.float32)
+    samples[:,0::2] = np.real(signal) * lagmask
+    samples[:,1::2] = np.imag(signal) * lagmask
+
+    fits = []
+    for maxbytes in [3 * 2 ** 20, 8 * 2 ** 20, HYPER_CHUNK_BYTES]:
+        fitter = BayesHyper(tfreqs, times, fcrits, vlos, alfs, npulses, 1, maxbytes)
+        t0 = time.time()
+        fitter.run_bayesfit(samples, lagmask)
+        dt = time.time() - t0
+        fits.append(fitter.peaks.copy())
+        print str(maxbytes / 2 ** 20) + ' MB cap: ' + str(fitter.vchunk) + ' velocities and ' + str(fitter.fchunk) + ' critical frequencies per chunk, ' + str(dt) + ' s, median velocity error ' + str(np.median(abs(fitter.vlos_fit - V))) + ' m/s'
+
+    print 'peaks identical for every chunk size: ' + str(np.array_equal(fits[0], fits[2]) and np.array_equal(fits[1], fits[2]))
+
+if __name__ == '__main__':
+    main()
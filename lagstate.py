@@ -1,7 +1,9 @@
 import numpy as np
 import pdb
+from collections import OrderedDict
 
 OVERLAP_THRESH = .20
+SEQUENCE_CACHE_SIZE = 16 # number of pulse sequences kept in the sequence cache of each worker
 
 # TODO: handle case with lag 0 - if lag 0 is bad, use alternate lag zero (if it exists..)
 # (regenerate behavior for rawacf...)
@@ -142,26 +144,124 @@ def fitacf_more_badlags(w,good_lags,prm,noise_lev=0.0):
 
   return good_lags
 
-# code from jef to simulate fitacf badlags
-def fitacf_good_lags(prm,pwr0,acfd):
-  #print "Acfd:",acfd.shape
-  good_lags_tx=np.ones((prm.nrang,prm.mplgs),dtype='bool')
-  good_lags_range=np.ones((prm.nrang,prm.mplgs),dtype='bool')
-  good_lags_fluct=np.ones((prm.nrang,prm.mplgs),dtype='bool')
-# Transmit samples
-  ptimes_usec=[]
+# fitacf_more_badlags for all range gates at once, w is lag power [range][lag]
+# the scan advances one lag at a time over vectors of the per range gate state (fluct, fluct_old, k_old)
+# the latching badflag_2 is disabled in fitacf_more_badlags, so it is left out here
+def fitacf_more_badlags_batch(w,prm,noise_lev=0.0):
+  nrang=w.shape[0]
+  rbins=np.arange(nrang)
+  good_lags=np.ones((nrang,prm.mplgs),dtype='bool')
+  # self correlated lag0 noise
+  fluct0 =  w[:,0]/np.sqrt(2.0*prm.nave)
+  # allowable lag power contaminated with noise
+  fluct =  w[:,0] + 2.0*noise_lev+fluct0
+  fluct_old = fluct.copy()
+  k_old = np.zeros(nrang,dtype='int')
+  small_thresh = w[:,0]/np.sqrt(prm.nave)
+  for k in xrange(prm.mplgs):
+    # lag pwr too small compared to lag0
+    checked = ~(w[:,k] <= small_thresh)
+    good_lags[:,k] = checked
+
+    # lag power larger than reasonable considering noise_lev input, with the same pairwise comparison to the next lag
+    toobig = checked & (w[:,k] > fluct)
+    good_lags[toobig,k] = False
+    if (k < (prm.mplgs - 1)):
+      swap = toobig & (w[:,k] < fluct_old) & (w[:,k+1] > fluct) & (w[:,k+1] < w[:,k])
+      good_lags[rbins[swap],k_old[swap]] = False
+      good_lags[swap,k] = True
+
+    fluct_old[checked] = fluct[checked]
+    fluct[checked] = 2.0*noise_lev + w[checked,k] + fluct0[checked]
+    k_old[good_lags[:,k]] = k
+
+  return good_lags
+
+# transmit sample ranges [pulse][start, end] used by the fitacf tx check
+def fitacf_tx_samples(prm):
   psamples=[]
-  psamples_offsetted=[]
-  smpoff=prm.lagfr/prm.smsep
   for pulse in prm.ptab:
        t1 =pulse *prm.mpinc-prm.txpl/2.
        t2 = t1 + 3*prm.txpl/2. + 100
-       ptimes_usec.append([t1,t2])
        psamples.append([int(t1/prm.smsep),int(t2/prm.smsep)])
-       psamples_offsetted.append([int(t1/prm.smsep)+smpoff,int(t2/prm.smsep)+smpoff])
-  #nprint "Psamples:",psamples_offsetted
+  return np.array(psamples)
+
+# mask out lag-ranges with a sample during a transmit pulse, for all range gates at once
+# samples are broadcast over [range][lag][pulse] against the transmit sample ranges
+def fitacf_good_lags_tx(prm):
+  psamples=fitacf_tx_samples(prm)
+  smpoff=prm.lagfr/prm.smsep
+  ltab=np.array(prm.ltab[0:prm.mplgs])
+  rbins=np.arange(prm.nrang)[:,np.newaxis]
+
+  bad=np.zeros((prm.nrang,prm.mplgs),dtype='bool')
+  for i in xrange(2):
+    sam = ltab[:,i]*(prm.mpinc/prm.smsep) + rbins +smpoff # [range][lag]
+    sam = sam[:,:,np.newaxis]
+    bad |= np.any((sam >= psamples[:,0]) & (sam <= psamples[:,1]), axis=2)
+  return ~bad
+
+# tables for the fitacf range overlap check, these only depend on the pulse sequence
+# returns the range gate checked against each range gate for each pair of pulses [range][ck_pulse][pulse] (clipped to the
+# range gates), a mask of the valid checks, and a mask of the pulses used by each lag [lag][pulse]
+def fitacf_range_tables(prm):
+  range_overlap=[]
+  for ck_pulse in xrange(prm.mppul):
+    overlap=[]
+    for pulse in xrange(prm.mppul):
+      diff_pulse = prm.ptab[ck_pulse] - prm.ptab[pulse]
+      overlap.append(diff_pulse * prm.mpinc/prm.smsep)
+    range_overlap.append(overlap)
+
+  rbins=np.arange(prm.nrang)
+  ck_range=np.array(range_overlap)[np.newaxis,:,:] + rbins[:,np.newaxis,np.newaxis]
+  valid=~np.eye(prm.mppul,dtype='bool') & (0 <= ck_range) & (ck_range < prm.nrang)
+
+  ltab=np.array(prm.ltab[0:prm.mplgs])
+  ptab=np.array(prm.ptab)
+  lag_pulses=(ltab[:,0,np.newaxis] == ptab) | (ltab[:,1,np.newaxis] == ptab)
+  return (np.clip(ck_range,0,prm.nrang-1),valid,lag_pulses)
+
+# mask out lag-ranges using a pulse whose return overlaps a stronger return from another pulse, for all range gates at once
+# the checks are broadcast over [range][ck_pulse][pulse], then pulses are mapped to lags through the lag table
+def fitacf_good_lags_range(prm,pwr0,tables=None):
+  if tables is None:
+    tables=fitacf_range_tables(prm)
+  ck_range,valid,lag_pulses=tables
+
+  pwr0=np.array(pwr0)
+  pwr_ratio = 1;  #pwr_ratio = (long) (nave * MIN_PWR_RATIO);
+  min_pwr = pwr_ratio * pwr0[0:prm.nrang]
+  bad_pulse = np.any(valid & (min_pwr[:,np.newaxis,np.newaxis] < pwr0[ck_range]), axis=2) # [range][pulse]
+  return ~np.any(bad_pulse[:,np.newaxis,:] & lag_pulses, axis=2)
+
+# code from jef to simulate fitacf badlags
+# sequence is an entry from a SequenceCache, the tx mask and range overlap tables are shared by records with the same sequence
+def fitacf_good_lags(prm,pwr0,acfd,sequence=None):
+  #print "Acfd:",acfd.shape
+# Transmit samples
+  good_lags_tx=sequence_table(sequence,'fitacf_tx',fitacf_good_lags_tx,prm)
+# Range overlap
+  good_lags_range=fitacf_good_lags_range(prm,pwr0,sequence_table(sequence,'fitacf_range',fitacf_range_tables,prm))
+# Lag power fluctuations
+  good_lags_fluct=fitacf_good_lags_fluct(prm,pwr0,acfd)
+
+  tup=(good_lags_tx,good_lags_range,good_lags_fluct)
+  good_lags=good_lags_tx & good_lags_range & good_lags_fluct
+  return (good_lags,tup)
+
+# mask out lags with too little or too much power compared to lag0 and the noise level, for all range gates at once
+def fitacf_good_lags_fluct(prm,pwr0,acfd):
+  w=np.abs(acfd[0:prm.nrang,:,0]+1j*acfd[0:prm.nrang,:,1])
+  noise_lev=1.6*max(1.,np.median(sorted(pwr0)[0:10]))
+  return fitacf_more_badlags_batch(w,prm,noise_lev=noise_lev)
+
+# loop implementations of the fitacf tx, range overlap, and lag power checks, kept as a reference for the array versions
+def fitacf_good_lags_tx_loop(prm):
+  good_lags_tx=np.ones((prm.nrang,prm.mplgs),dtype='bool')
+  psamples=fitacf_tx_samples(prm).tolist()
+  smpoff=prm.lagfr/prm.smsep
   for rbin in xrange(prm.nrang):
-       lag_state=[]
        for l in xrange(prm.mplgs):
             lag=prm.ltab[l]
             sam1 = lag[0]*(prm.mpinc/prm.smsep) + rbin +smpoff
@@ -173,11 +273,11 @@ def fitacf_good_lags(prm,pwr0,acfd):
                 good=False
               if (sam2 >= smrange[0]) and (sam2 <= smrange[1]):
                 good=False
-              if not good:
-                #print "Bad Tx Lag:",rbin,l,lag
-                pass
             good_lags_tx[rbin,l]=good
-# Range overlap
+  return good_lags_tx
+
+def fitacf_good_lags_range_loop(prm,pwr0):
+  good_lags_range=np.ones((prm.nrang,prm.mplgs),dtype='bool')
   range_overlap=[]
   for ck_pulse in xrange(prm.mppul):
     overlap=[]
@@ -197,39 +297,121 @@ def fitacf_good_lags(prm,pwr0,acfd):
           pwr_ratio = 1;  #pwr_ratio = (long) (nave * MIN_PWR_RATIO);
           min_pwr =  pwr_ratio * pwr0[rbin];
           if(min_pwr < pwr0[ck_range]):
-            #print "  :",prm.ptab[pulse],prm.ptab[ck_pulse],np.abs(prm.ptab[pulse]-prm.ptab[ck_pulse]) 
             bad_pulse[ck_pulse]=1
   # mark the bad lags 
-    #print rbin,bad_pulse
     for pulse in xrange(prm.mppul):
       if (bad_pulse[pulse] == 1):
         for lag in xrange(prm.mplgs):
-          #print "Range overlap pulse:",rbin,pulse,prm.ptab[pulse] 
           for i in xrange(2):
             if (prm.ltab[lag][i] == prm.ptab[pulse]):
-              #print "Range overlap lag:",rbin,lag,prm.ltab[lag] 
               good_lags_range[rbin,lag]=False
-              pass
+  return good_lags_range
+
+def fitacf_good_lags_fluct_loop(prm,pwr0,acfd):
+  good_lags_fluct=np.ones((prm.nrang,prm.mplgs),dtype='bool')
+  noise_lev=1.6*max(1.,np.median(sorted(pwr0)[0:10]))
+  for rbin in xrange(prm.nrang):
     w=np.abs(acfd[rbin,:,0]+1j*acfd[rbin,:,1])
-    noise_lev=1.6*max(1.,np.median(sorted(pwr0)[0:10]))
-    #print rbin, " Pwr0:",w[0]," Noise:",noise_lev
     fitacf_more_badlags(w,good_lags_fluct[rbin],prm,noise_lev=noise_lev)
-    #print "  More_bad:",rbin, np.sum(good_lags_fluct[rbin]),good_lags_fluct[rbin]
+  return good_lags_fluct
 
-  tup=(good_lags_tx,good_lags_range,good_lags_fluct)
-  good_lags=good_lags_tx & good_lags_range & good_lags_fluct
-  return (good_lags,tup)
-
-
-def fitacf_bad_lags(prm,pwr0,acfd):
-  glags,tup=fitacf_good_lags(prm,pwr0,acfd)
+def fitacf_bad_lags(prm,pwr0,acfd,sequence=None):
+  glags,tup=fitacf_good_lags(prm,pwr0,acfd,sequence)
   for item in tup:
     item=~item
   return ~glags,tup
 
 #@profile
-def convo_get_bad_lags(prm, txlags = None):
+def convo_get_bad_lags(prm, txlags = None, sequence = None):
     if txlags == None:
-        txlags = convo_good_lags_txsamples(prm)
+        txlags = sequence_table(sequence, 'convo_tx', convo_good_lags_txsamples, prm)
     overlap_lags = convo_good_lags_overlap(prm) 
     return ~txlags | ~overlap_lags
+
+# signature of the parameters that the lag times, tx masks, and range overlap tables depend on
+def sequence_signature(prm):
+    ltab = tuple(tuple(lag) for lag in prm.ltab)
+    return (tuple(prm.ptab), ltab, prm.mplgs, prm.mppul, prm.mpinc, prm.smsep, prm.lagfr, prm.txpl, prm.nrang)
+
+# least recently used cache of data derived from pulse sequences, keyed by sequence_signature
+# each entry is a dict of tables filled in by sequence_table as they are used
+# there is one cache in each worker process (sequence_cache), hits and misses count lookups (one per record)
+class SequenceCache:
+    def __init__(self, maxsize = SEQUENCE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, prm):
+        key = sequence_signature(prm)
+        if key in self.entries:
+            self.hits += 1
+            entry = self.entries.pop(key)
+        else:
+            self.misses += 1
+            entry = {}
+            if len(self.entries) >= self.maxsize:
+                self.entries.popitem(last = False)
+        self.entries[key] = entry
+        return entry
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.
+
+sequence_cache = SequenceCache()
+
+# return the table name from a sequence cache entry, calling fn(*args) to make it on first use
+# cached arrays are shared by records, so they are made read-only
+def sequence_table(sequence, name, fn, *args):
+    if sequence is None:
+        return fn(*args)
+    if not name in sequence:
+        table = fn(*args)
+        for array in (table if isinstance(table, tuple) else (table,)):
+            array.flags.writeable = False
+        sequence[name] = table
+    return sequence[name]
+
+# benchmark the array tx, range overlap, and lag power checks against the loops on katscan sequences
+# checks that the masks are identical for 75, 100, and 225 range gates
+def main(repeats = 10):
+  import time
+  class Prm: pass
+
+  for nrang in [75, 100, 225]:
+    prm = Prm()
+    prm.ptab = [0, 14, 22, 24, 27, 31, 42, 43]
+    prm.ltab = [[0,0],[42,43],[22,24],[24,27],[27,31],[22,27],[24,31],[14,22],[22,31],[14,24],[31,42],[31,43],[14,27],[0,14],[27,42],[27,43],[14,31],[24,42],[24,43],[22,42],[22,43],[0,22],[0,24],[43,43]]
+    prm.mppul = len(prm.ptab)
+    prm.mplgs = len(prm.ltab) - 1
+    prm.nrang = nrang
+    prm.mpinc = 1500
+    prm.txpl = 300
+    prm.smsep = 300 if nrang < 225 else 100
+    prm.lagfr = 1200
+    prm.nave = 30
+    pwr0 = list(10 ** np.random.uniform(1, 4, nrang))
+
+    # decaying lag power with noise, [range][lag][i/q]
+    lags = np.abs(np.array(prm.ltab[0:prm.mplgs])[:,1] - np.array(prm.ltab[0:prm.mplgs])[:,0]) * prm.mpinc * 1e-6
+    acf = np.outer(pwr0, np.ones(prm.mplgs)) * np.exp(-np.outer(np.random.uniform(20, 300, nrang), lags) + 2j * np.pi * np.outer(np.random.uniform(-200, 200, nrang), lags))
+    acf += 30 * (np.random.randn(nrang, prm.mplgs) + 1j * np.random.randn(nrang, prm.mplgs))
+    acfd = np.dstack((np.real(acf), np.imag(acf)))
+
+    for (name, array_fn, loop_fn, args) in [('tx', fitacf_good_lags_tx, fitacf_good_lags_tx_loop, (prm,)), ('range', fitacf_good_lags_range, fitacf_good_lags_range_loop, (prm, pwr0)), ('fluct', fitacf_good_lags_fluct, fitacf_good_lags_fluct_loop, (prm, pwr0, acfd))]:
+      t0 = time.time()
+      for i in xrange(repeats):
+        loop_mask = loop_fn(*args)
+      t1 = time.time()
+      for i in xrange(repeats):
+        array_mask = array_fn(*args)
+      t2 = time.time()
+
+      dt_loop = (t1 - t0) / repeats
+      dt_array = (t2 - t1) / repeats
+      print str(nrang) + ' gates, ' + name + ': loop ' + str(dt_loop * 1e3) + ' ms, array ' + str(dt_array * 1e3) + ' ms (' + str(round(dt_loop / dt_array, 1)) + 'x), identical: ' + str(np.array_equal(loop_mask, array_mask))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,537 @@
+#/usr/bin/python2
+# jon klein, jtklein@alaska.edu
+# columnar (layout version 4) fitlomb files
+# version 3 files store each record as a group with ~50 attributes and ~30 small compact datasets
+# version 4 files store each parameter as one chunked dataset [record][range gate][lomb pass] for the whole file,
+# padded to the largest nrang in the file, and the scalars of each record as a row of the compound prm table
+# row i of the prm table and of every parameter dataset belong to the same record
+# the prm column named by the length attribute of a parameter dataset is the unpadded length of each row
+# records are buffered, then appended to the prm table and every parameter dataset at once
+# rows are in epoch time order, records appended out of order are sorted when the table is closed
+# datasets can be compressed (gzip or lzf, with byte shuffle), velocity/spectral width/power and their errors
+# can be stored as float32, and 0/1 flags can be bit packed along the range gate axis (8 gates per byte)
+# GroupWriter writes version 3 files, also buffering records and writing them in bursts
+# run as a script to convert version 3 files to version 4
+# mit license
+
+import argparse
+import collections
+import datetime
+import h5py
+import numpy as np
+import os
+
+LAYOUT_VERSION = 4
+LAYOUT_ATTR = 'fitlomb.layout' # attribute of the file root, files without it are version 3
+TABLE_BUFFER_RECORDS = 256 # records buffered before they are appended to the file
+TABLE_CHUNK_RECORDS = 64 # records in each chunk of the prm table and parameter datasets
+GROUP_BUFFER_RECORDS = 64 # records buffered by a GroupWriter before they are written
+VLEN_STR = h5py.special_dtype(vlen=str) # strings are variable length attributes, like h5py attrs stores them
+
+# attributes that are the same for every record of a file, stored once as attributes of the file
+FILE_ATTRS = ['readme', 'fitlomb.revision.major', 'fitlomb.revision.minor', 'bayes.vres', 'bayes.wres', 'fitlomb.bayes.iterations', 'origin.code', 'origin.time']
+
+# parameters stored as float32 with single precision storage
+SINGLE_PARAMS = ['v', 'v_e', 'v_l_std', 'p_l', 'p_l_e', 'w_l', 'w_l_e', 'w_l_std', 'v_s', 'v_s_e', 'v_s_std', 'p_s', 'p_s_e', 'w_s', 'w_s_e', 'w_s_std']
+
+# 0/1 flags bit packed with packed flag storage
+FLAG_PARAMS = ['qflg', 'gflg', 'iflg']
+
+# parameters that aren't indexed by range gate, and the prm column holding their length
+LENGTH_COLUMNS = {'ptab' : 'nptab', 'ltab' : 'nltab'}
+
+# columns of the prm table, the scalars of a version 3 record group
+PRM_TYPES = [\
+        ('epoch.time', np.int64),\
+        ('time.yr', np.int16),\
+        ('time.mo', np.int16),\
+        ('time.dy', np.int16),\
+        ('time.hr', np.int16),\
+        ('time.mt', np.int16),\
+        ('time.sc', np.int16),\
+        ('time.us', np.int32),\
+        ('stid', np.int16),\
+        ('cp', np.int16),\
+        ('noise.lag0', np.float64),\
+        ('nptab', np.int16),\
+        ('nltab', np.int16),\
+        ('txpow', np.int16),\
+        ('nave', np.int16),\
+        ('atten', np.int16),\
+        ('lagfr', np.int16),\
+        ('smsep', np.int16),\
+        ('ercod', np.int16),\
+        ('stat.agc', np.int16),\
+        ('stat.lopwr', np.int16),\
+        ('noise.search', np.float32),\
+        ('noisesky', np.float32),\
+        ('noisesearch', np.float32),\
+        ('noise.mean', np.float32),\
+        ('noisemean', np.float32),\
+        ('channel', np.int16),\
+        ('bmnum', np.int16),\
+        ('bmazm', np.float32),\
+        ('scan', np.int16),\
+        ('offset', np.int16),\
+        ('rxrise', np.int16),\
+        ('tfreq', np.int16),\
+        ('mxpwr', np.int32),\
+        ('lvmax', np.int32),\
+        ('combf', 'S128'),\
+        ('intt.sc', np.int16),\
+        ('inttsc', np.int16),\
+        ('intt.us', np.int32),\
+        ('inttus', np.int32),\
+        ('txpl', np.int16),\
+        ('mpinc', np.int16),\
+        ('mppul', np.int16),\
+        ('mplgs', np.int16),\
+        ('mplgexs', np.int16),\
+        ('nrang', np.int16),\
+        ('frang', np.int16),\
+        ('rsep', np.int16),\
+        ('ifmode', np.int16),\
+        ('xcf', np.int8)]
+
+PRM_DTYPE = np.dtype(PRM_TYPES)
+
+# padding for rows shorter than their dataset
+def fill_value(dtype):
+    if dtype.kind == 'f':
+        return np.nan
+    return 0
+
+# layout version of a file or group
+def layout_version(group):
+    return int(group.attrs.get(LAYOUT_ATTR, 3))
+
+# packs a block of 0/1 flags [record][range gate]... to bits along the range gate axis
+def pack_flags(name, block):
+    if np.any((block != 0) * (block != 1)):
+        raise ValueError(name + ' has values other than 0 and 1, so it can not be bit packed')
+    return np.packbits(block != 0, axis = 1)
+
+# unpacks the bit packed rows of a flag dataset along axis, to the type of the flags before packing
+def unpack_flags(dset, data, axis):
+    return np.unpackbits(data, axis = axis).astype(dset.attrs['packed'])
+
+# appends records to a version 4 file, records are buffered and written nbuffer at a time
+# compression is None, 'gzip' (at compression_level), or 'lzf', shuffle reorders the bytes of each chunk before compression
+# single stores SINGLE_PARAMS as float32, packflags bit packs FLAG_PARAMS
+# appending to an existing version 4 file adds rows after its records, existing datasets keep their storage
+class LombTable:
+    def __init__(self, hdf5file, nbuffer = TABLE_BUFFER_RECORDS, compression = None, compression_level = 4, shuffle = False, single = False, packflags = False):
+        self.hdf5file = hdf5file
+        self.nbuffer = nbuffer
+        self.compression = compression
+        self.compression_opts = compression_level if compression == 'gzip' else None
+        self.shuffle = shuffle
+        self.single = single
+        self.packflags = packflags
+        self.origin_time = str(datetime.datetime.now())
+        self.rows = [] # buffered prm rows, as dicts of column -> value
+        self.params = [] # buffered parameters, as dicts of name -> array
+        self.nrecords = 0
+        self.nfailed = 0 # records dropped by failed appends and writes
+
+        if 'prm' in hdf5file:
+            self.nrecords = len(hdf5file['prm'])
+        hdf5file.attrs[LAYOUT_ATTR] = np.int8(LAYOUT_VERSION)
+        self.fileattrs = set(hdf5file.attrs.keys())
+
+    # attrs are the scalars of a record (like the attributes of a version 3 record group), params its vectors
+    # attributes duplicated by a parameter (ptab and ltab) are only stored in the parameter dataset
+    def append(self, attrs, params):
+        row = {}
+        for name in attrs:
+            if name in FILE_ATTRS:
+                if not name in self.fileattrs:
+                    self.hdf5file.attrs[name] = attrs[name]
+                    self.fileattrs.add(name)
+            elif not name in params:
+                if not name in PRM_DTYPE.names:
+                    self.nfailed += 1
+                    raise ValueError('no prm column for record attribute ' + name)
+                row[name] = attrs[name]
+
+        for name in LENGTH_COLUMNS:
+            if name in params:
+                row[LENGTH_COLUMNS[name]] = len(params[name])
+
+        self.rows.append(row)
+        self.params.append(params)
+
+        if len(self.rows) >= self.nbuffer:
+            self.flush()
+
+    # append the buffered records to the file
+    # if the write fails, the rows written for the buffered records are truncated so the file keeps its earlier records,
+    # and the buffered records are dropped and counted in nfailed
+    def flush(self):
+        nrows = len(self.rows)
+        if nrows == 0:
+            return
+
+        start = self.nrecords
+        try:
+            self._write_rows(start)
+        except Exception:
+            self.nrecords = start
+            self.nfailed += nrows
+            for name in self.hdf5file:
+                if len(self.hdf5file[name]) > start:
+                    self.hdf5file[name].resize(start, axis = 0)
+            raise
+        finally:
+            self.rows = []
+            self.params = []
+
+    # writes the buffered records from row start
+    def _write_rows(self, start):
+        nrows = len(self.rows)
+        self.nrecords += nrows
+
+        rows = np.zeros(nrows, dtype=PRM_DTYPE)
+        for (i, row) in enumerate(self.rows):
+            for name in row:
+                rows[name][i] = row[name]
+
+        if not 'prm' in self.hdf5file:
+            self.hdf5file.create_dataset('prm', shape = (0,), maxshape = (None,), chunks = (TABLE_CHUNK_RECORDS,), dtype = PRM_DTYPE, compression = self.compression, compression_opts = self.compression_opts, shuffle = self.shuffle)
+        prm = self.hdf5file['prm']
+        prm.resize((self.nrecords,))
+        prm[start:] = rows
+
+        names = []
+        for params in self.params:
+            names += [name for name in params if not name in names]
+
+        for name in names:
+            arrays = [params.get(name) for params in self.params]
+            first = [a for a in arrays if a is not None][0]
+            width = max([len(a) for a in arrays if a is not None])
+            dtype, packed = self._storage(name, first.dtype)
+
+            block = np.empty((nrows, width) + first.shape[1:], dtype = dtype)
+            block.fill(fill_value(dtype))
+            for (i, a) in enumerate(arrays):
+                if a is not None:
+                    block[i,:len(a)] = a
+
+            if packed:
+                block = pack_flags(name, block)
+
+            dset = self._param_dataset(name, block, dtype, packed)
+            dset[start:,:block.shape[1]] = block
+
+        # records without a parameter are padding in its dataset
+        for name in self.hdf5file:
+            dset = self.hdf5file[name]
+            if 'length' in dset.attrs and len(dset) < self.nrecords:
+                dset.resize(self.nrecords, axis = 0)
+
+    # returns the type a parameter is stored as (before bit packing), and if it is bit packed
+    def _storage(self, name, dtype):
+        if name in self.hdf5file:
+            dset = self.hdf5file[name]
+            if 'packed' in dset.attrs:
+                return np.dtype(dset.attrs['packed']), True
+            return dset.dtype, False
+
+        dtype = dtype.newbyteorder('=')
+        if self.single and name in SINGLE_PARAMS and dtype == np.float64:
+            dtype = np.dtype(np.float32)
+        return dtype, self.packflags and name in FLAG_PARAMS
+
+    # returns the dataset for a parameter, created or resized to hold the rows of block
+    # dtype is the type of the parameter, the packed attribute of bit packed flag datasets
+    def _param_dataset(self, name, block, dtype, packed):
+        if not name in self.hdf5file:
+            fill = fill_value(block.dtype)
+            chunks = (TABLE_CHUNK_RECORDS,) + block.shape[1:]
+            maxshape = (None, None) + block.shape[2:]
+            dset = self.hdf5file.create_dataset(name, shape = (0,) + block.shape[1:], maxshape = maxshape, chunks = chunks, dtype = block.dtype, fillvalue = fill, compression = self.compression, compression_opts = self.compression_opts, shuffle = self.shuffle)
+            dset.attrs['length'] = LENGTH_COLUMNS.get(name, 'nrang')
+            if packed:
+                dset.attrs['packed'] = dtype.str
+
+        dset = self.hdf5file[name]
+        width = max(dset.shape[1], block.shape[1])
+        dset.resize((self.nrecords, width) + dset.shape[2:])
+        return dset
+
+    # sorts the rows of the prm table and every parameter dataset by epoch time, if they aren't already in order
+    # readers (getPulses, LombFitSeek and LombFitRead in fitlombread.c) expect time ordered rows
+    def sort(self):
+        if not 'prm' in self.hdf5file:
+            return
+        times = self.hdf5file['prm']['epoch.time']
+        if np.all(times[1:] >= times[:-1]):
+            return
+
+        order = np.argsort(times, kind = 'mergesort')
+        for name in self.hdf5file:
+            dset = self.hdf5file[name]
+            dset[...] = dset[...][order]
+
+    # the file is sorted and closed even if the last records fail to write
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            try:
+                self.sort()
+            finally:
+                self.hdf5file.close()
+
+# writes records to a version 3 file (a group of attributes and compact datasets for each record), nbuffer at a time
+# parameters are copied into preallocated arrays [record][...] and written from them in one burst with the low level api,
+# reusing the dataspaces, attribute types, and compact dataset creation property list for every record
+class GroupWriter:
+    def __init__(self, hdf5file, nbuffer = GROUP_BUFFER_RECORDS):
+        self.hdf5file = hdf5file
+        self.nbuffer = nbuffer
+        self.origin_time = str(datetime.datetime.now())
+        self.attrs = [] # buffered scalars of each record
+        self.buffers = collections.OrderedDict() # name -> (array [record][...], hdf5 type of the dataset)
+        self.nrecords = 0 # records in the buffers
+        self.nfailed = 0 # records dropped by failed writes
+
+        self.dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+        self.dcpl.set_layout(h5py.h5d.COMPACT)
+        self.spaces = {} # shape -> dataspace
+        self.types = {} # numpy type -> hdf5 type of attributes
+
+    # attrs are the scalars of a record, params its vectors as (name, data, hdf5 type), like CULombFit.FitAttrs and FitParams
+    # the buffers are written and reallocated if the parameters don't match them (e.g nrang changed)
+    # a failed write of the buffered records is raised after the record is buffered, the failed records are counted in nfailed
+    def append(self, attrs, params):
+        error = None
+        if not self._matches(params):
+            try:
+                self.flush()
+            except IOError as e:
+                error = e
+            self.buffers = collections.OrderedDict((name, (np.empty((self.nbuffer,) + data.shape, dtype = data.dtype), dtype)) for (name, data, dtype) in params)
+
+        try:
+            for (name, data, dtype) in params:
+                self.buffers[name][0][self.nrecords] = data
+        except Exception:
+            self.nfailed += 1
+            raise
+
+        self.attrs.append(attrs.items()) # copied, callers may reuse attrs
+        self.nrecords += 1
+
+        if self.nrecords == self.nbuffer:
+            self.flush()
+        if error != None:
+            raise error
+
+    # true if a record has the parameter names, shapes, and types of the buffers
+    def _matches(self, params):
+        if len(params) != len(self.buffers):
+            return False
+
+        for (name, data, dtype) in params:
+            if not name in self.buffers:
+                return False
+            buf, buftype = self.buffers[name]
+            if buf.shape[1:] != data.shape or buf.dtype != data.dtype or buftype != dtype:
+                return False
+
+        return True
+
+    def _space(self, shape):
+        if not shape in self.spaces:
+            if len(shape):
+                self.spaces[shape] = h5py.h5s.create_simple(shape)
+            else:
+                self.spaces[shape] = h5py.h5s.create(h5py.h5s.SCALAR)
+        return self.spaces[shape]
+
+    def _type(self, dtype):
+        if not dtype in self.types:
+            self.types[dtype] = h5py.h5t.py_create(dtype, logical = True)
+        return self.types[dtype]
+
+    # write the buffered records
+    # a record that fails to write (e.g its epoch time group already exists) is dropped without its partial group and counted in nfailed,
+    # the rest of the burst is still written and the failures are raised together as an IOError
+    def flush(self):
+        errors = []
+        try:
+            for i in xrange(self.nrecords):
+                try:
+                    self._write_group(i)
+                except Exception as e:
+                    errors.append(str(dict(self.attrs[i]).get('epoch.time')) + ' (' + str(e) + ')')
+        finally:
+            self.attrs = []
+            self.nrecords = 0
+
+        if len(errors):
+            self.nfailed += len(errors)
+            raise IOError('failed to write ' + str(len(errors)) + ' records, the first at ' + errors[0])
+
+    # writes buffered record i to its group
+    def _write_group(self, i):
+        attrs = self.attrs[i]
+        name = str(dict(attrs)['epoch.time']).encode()
+        grp = h5py.h5g.create(self.hdf5file.id, name)
+
+        try:
+            for (attrname, value) in attrs:
+                if isinstance(value, str):
+                    value = np.array(value, dtype = VLEN_STR)
+                else:
+                    value = np.asarray(value)
+                attr = h5py.h5a.create(grp, attrname.encode(), self._type(value.dtype), self._space(value.shape))
+                attr.write(value)
+
+            for dsetname in self.buffers:
+                data, dtype = self.buffers[dsetname]
+                dset = h5py.h5d.create(grp, dsetname.encode(), dtype, self._space(data.shape[1:]), self.dcpl)
+                dset.write(h5py.h5s.ALL, h5py.h5s.ALL, data[i])
+        except Exception:
+            del self.hdf5file[name]
+            raise
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.hdf5file.close()
+
+# one parameter of a record in a version 4 table, indexed like the dataset of a version 3 record group
+class LombParam:
+    def __init__(self, dset, row, length):
+        self.dset = dset
+        self.row = row
+        self.length = length
+
+    def _read(self):
+        if 'packed' in self.dset.attrs:
+            return unpack_flags(self.dset, self.dset[self.row], 0)[:self.length]
+        return self.dset[self.row,:self.length]
+
+    def __getitem__(self, key):
+        return self._read()[key]
+
+    def __setitem__(self, key, value):
+        data = self._read()
+        data[key] = value
+        if 'packed' in self.dset.attrs:
+            row = self.dset[self.row]
+            row[:(self.length + 7) // 8] = pack_flags(self.dset.name, data[np.newaxis])[0]
+            self.dset[self.row] = row
+        else:
+            self.dset[self.row,:self.length] = data
+
+# one record of a version 4 table, used like a version 3 record group
+# attrs holds the file attributes and the prm row, indexing by parameter name gives its unpadded LombParam
+class LombRecord:
+    def __init__(self, table, row, prm, fileattrs):
+        self.table = table
+        self.row = row
+        self.attrs = dict(fileattrs)
+        self.attrs.update((name, prm[name]) for name in prm.dtype.names)
+
+    def __getitem__(self, name):
+        dset = self.table[name]
+        return LombParam(dset, self.row, self.attrs[dset.attrs['length']])
+
+    def __contains__(self, name):
+        return name in self.table and name != 'prm'
+
+# records of a version 4 table on beams with epoch times between starttime and endtime
+def table_records(table, beams, starttime, endtime):
+    prm = table['prm'][...]
+    fileattrs = dict(table.attrs)
+    mask = (prm['epoch.time'] >= starttime) * (prm['epoch.time'] <= endtime) * np.in1d(prm['bmnum'], [int(b) for b in beams])
+    rows = np.nonzero(mask)[0]
+    rows = rows[np.argsort(prm['epoch.time'][rows], kind = 'mergesort')] # time sorted, even if the rows aren't
+    return [LombRecord(table, row, prm[row], fileattrs) for row in rows]
+
+# reads a parameter of a list of records (version 3 record groups or LombRecords)
+# the records of each version 4 table are read with one hyperslab, from the first to the last row of the records
+def read_records(records, name):
+    values = [None] * len(records)
+    tables = {}
+    for (i, record) in enumerate(records):
+        if isinstance(record, LombRecord):
+            tables.setdefault(record.table, []).append(i)
+        else:
+            values[i] = record[name][...]
+
+    for (table, indices) in tables.items():
+        dset = table[name]
+        length = dset.attrs['length']
+        rows = [records[i].row for i in indices]
+        first = min(rows)
+        block = dset[first:max(rows) + 1]
+        if 'packed' in dset.attrs:
+            block = unpack_flags(dset, block, 1)
+        for i in indices:
+            values[i] = block[records[i].row - first,:records[i].attrs[length]]
+
+    return values
+
+# converts a version 3 file to version 4, records are written in time order
+# storage_args are LombTable keyword arguments (compression, shuffle, single, packflags)
+def convert_file(v3path, v4path, **storage_args):
+    v3file = h5py.File(v3path, 'r')
+    groups = sorted([v3file[name] for name in v3file], key = lambda grp: grp.attrs['epoch.time'])
+    table = LombTable(h5py.File(v4path, 'w'), **storage_args)
+
+    for grp in groups:
+        table.append(dict(grp.attrs), dict((name, grp[name][...]) for name in grp))
+
+    table.close()
+    v3file.close()
+    return len(groups)
+
+# command line options for the storage of version 4 files
+def add_storage_arguments(parser):
+    parser.add_argument("--compression", help="compression filter for version 4 datasets, lzf is faster but only readable by h5py (or with the lzf filter plugin)", choices=['none', 'gzip', 'lzf'], default='none') 
+    parser.add_argument("--compression_level", help="gzip compression level (0-9) with --compression gzip", type=int, default=4) 
+    parser.add_argument("--shuffle", help="shuffle the bytes of version 4 datasets before compression, usually improves compression of floating point parameters", action='store_true', default=False) 
+    parser.add_argument("--single", help="store velocity, spectral width, power, and their errors as float32 in version 4 files", action='store_true', default=False) 
+    parser.add_argument("--packflags", help="bit pack the qflg/gflg/iflg flags of version 4 files", action='store_true', default=False) 
+
+# LombTable keyword arguments from parsed storage options
+def get_storage_args(args):
+    return {\
+        'compression' : None if args.compression == 'none' else args.compression,\
+        'compression_level' : args.compression_level,\
+        'shuffle' : args.shuffle,\
+        'single' : args.single,\
+        'packflags' : args.packflags}
+
+def main():
+    parser = argparse.ArgumentParser(description='Converts version 3 (group per record) fitlomb files to the version 4 columnar layout.')
+    parser.add_argument("files", help="version 3 .fitlomb.hdf5 files", nargs='+')
+    parser.add_argument("--outdir", help="directory for the converted files, defaults to replacing each file", default=None)
+    add_storage_arguments(parser)
+    args = parser.parse_args()
+
+    for v3path in args.files:
+        v3file = h5py.File(v3path, 'r')
+        version = layout_version(v3file)
+        v3file.close()
+        if version == LAYOUT_VERSION:
+            print v3path + ' is already version ' + str(LAYOUT_VERSION) + ', skipping'
+            continue
+
+        v4path = v3path
+        if args.outdir != None:
+            v4path = os.path.join(args.outdir, os.path.basename(v3path))
+
+        # write next to the output, so a failed conversion doesn't leave a partial file in its place
+        nrecords = convert_file(v3path, v4path + '.tmp', **get_storage_args(args))
+        os.rename(v4path + '.tmp', v4path)
+        print 'converted ' + v3path + ' to ' + v4path + ' (' + str(nrecords) + ' records)'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+#/usr/bin/python2
+# jon klein, jtklein@alaska.edu
+# numba compiled, multi-threaded port of the cuda_bayes kernels
+# calc_bayes, find_peaks, and process_peaks are mirrored as jit functions
+# calc_bayes runs one parallel loop over (range gate, alpha) and keeps only the max along frequency,
+# so the P_f[pulse][alpha][freq] cube is never written out. process_peaks recomputes the few P_f
+# values it needs for the fwhm walks and the spot around the peak.
+# on a symmetric frequency grid the cubes only hold the upper half of the freqs (see BayesCPU)
+# the masked samples are compacted to the good lags of each gate, s_i[p,k] is the sample at lag goodlags[p,k]
+# for k < n_good[p], so the loops over lags skip bad lags
+# set NUMBA_NUM_THREADS to limit threads per worker when running a pool of workers
+# mit license
+
+import numpy as np
+import numba
+import math
+import time
+from cpu_bayes import BayesCPU, PI, HALF_LOG, SPOT_WIDTH, compact_lags
+
+# log probability at one alpha/freq given r_f and i_f, see calc_bayes in cuda_bayes.py
+@numba.njit(cache = True)
+def log_prob(r_f, i_f, cs_f, n_good, dbar2):
+    hbar2 = (np.float64(r_f) ** 2 / cs_f) + (np.float64(i_f) ** 2 / cs_f)
+    return math.log10(n_good * 2 * dbar2 - hbar2) * (1 - np.float64(n_good)) - math.log10(cs_f)
+
+# ce and se at one alpha/time/freq, with half cubes the lower freqs mirror the upper freqs (se is odd)
+@numba.njit(cache = True)
+def cube_point(ce_matrix, se_matrix, a, t, f, nfreqs):
+    nhalf = nfreqs - ce_matrix.shape[2]
+    if f >= nhalf:
+        return ce_matrix[a,t,f - nhalf], se_matrix[a,t,f - nhalf]
+    return ce_matrix[a,t,nfreqs - 1 - f - nhalf], -se_matrix[a,t,nfreqs - 1 - f - nhalf]
+
+# recalculate P_f at a single alpha/freq for a pulse
+@numba.njit(cache = True)
+def pf_point(s_i, s_q, goodlags, ce_matrix, se_matrix, cs_f, n_good, dbar2, p, a, f, nfreqs):
+    r_f = np.float32(0)
+    i_f = np.float32(0)
+    for k in range(n_good[p]):
+        ce, se = cube_point(ce_matrix, se_matrix, a, goodlags[p,k], f, nfreqs)
+        r_f += s_i[p,k] * ce + s_q[p,k] * se
+        i_f += s_i[p,k] * se - s_q[p,k] * ce
+    return log_prob(r_f, i_f, cs_f[p,a], n_good[p], dbar2[p])
+
+# calculate P_f for each (pulse, alpha) row, store the max and argmax along frequency
+# with two or more good lags P_f increases with hbar2, so the argmax is found on hbar2 and only the max is de-logged
+# with half cubes, r_f(+/-f) = a +/- b and i_f(+/-f) = +/-c - d are made from partial sums over the upper half
+@numba.njit(parallel = True, cache = True)
+def calc_bayes(s_i, s_q, goodlags, ce_matrix, se_matrix, cs_f, n_good, dbar2, alf_max, alf_argmax, nfreqs):
+    npulses = s_i.shape[0]
+    nalfs, nlags, nstored = ce_matrix.shape
+    nhalf = nfreqs - nstored
+
+    for k in numba.prange(npulses * nalfs):
+        p = k // nalfs
+        a = k - p * nalfs
+        r_f = np.zeros(nfreqs, np.float32)
+        i_f = np.zeros(nfreqs, np.float32)
+
+        if nhalf == 0:
+            for l in range(n_good[p]):
+                sr = s_i[p,l]
+                sq = s_q[p,l]
+                ce = ce_matrix[a,goodlags[p,l]]
+                se = se_matrix[a,goodlags[p,l]]
+                for f in range(nfreqs):
+                    r_f[f] += sr * ce[f] + sq * se[f]
+                    i_f[f] += sr * se[f] - sq * ce[f]
+        else:
+            sum_a = np.zeros(nstored, np.float32)
+            sum_b = np.zeros(nstored, np.float32)
+            sum_c = np.zeros(nstored, np.float32)
+            sum_d = np.zeros(nstored, np.float32)
+            for l in range(n_good[p]):
+                sr = s_i[p,l]
+                sq = s_q[p,l]
+                ce = ce_matrix[a,goodlags[p,l]]
+                se = se_matrix[a,goodlags[p,l]]
+                for f in range(nstored):
+                    sum_a[f] += sr * ce[f]
+                    sum_b[f] += sq * se[f]
+                    sum_c[f] += sr * se[f]
+                    sum_d[f] += sq * ce[f]
+            for f in range(nstored):
+                r_f[nhalf + f] = sum_a[f] + sum_b[f]
+                i_f[nhalf + f] = sum_c[f] - sum_d[f]
+            for f in range(nhalf):
+                m = nfreqs - 1 - f - nhalf
+                r_f[f] = sum_a[m] - sum_b[m]
+                i_f[f] = -sum_c[m] - sum_d[m]
+
+        maxval = -np.inf
+        maxidx = 0
+        if n_good[p] > 1:
+            hmax = -1.
+            ndbar2 = n_good[p] * 2 * dbar2[p]
+            for f in range(nfreqs):
+                hbar2 = (np.float64(r_f[f]) ** 2 / cs_f[p,a]) + (np.float64(i_f[f]) ** 2 / cs_f[p,a])
+                if hbar2 > hmax and hbar2 <= ndbar2:
+                    hmax = hbar2
+                    maxidx = f
+            if hmax >= 0:
+                maxval = log_prob(r_f[maxidx], i_f[maxidx], cs_f[p,a], n_good[p], dbar2[p])
+        else:
+            for f in range(nfreqs):
+                pf = log_prob(r_f[f], i_f[f], cs_f[p,a], n_good[p], dbar2[p])
+                if pf > maxval:
+                    maxval = pf
+                    maxidx = f
+
+        alf_max[p,a] = maxval
+        alf_argmax[p,a] = maxidx
+
+# reduce the per-alpha maximums to a peak index into the flattened P_f for each pulse
+@numba.njit(cache = True)
+def find_peaks(alf_max, alf_argmax, nfreqs, peaks):
+    npulses, nalfs = alf_max.shape
+    for p in range(npulses):
+        maxval = -np.inf
+        maxidx = 0
+        for a in range(nalfs):
+            if alf_max[p,a] > maxval:
+                maxval = alf_max[p,a]
+                maxidx = a * nfreqs + alf_argmax[p,a]
+        peaks[p] = p * nalfs * nfreqs + maxidx
+
+# recalculate r_f and i_f at the peak on the (unmasked) residual samples, then calculate amplitude
+# cs_amp[pulse][alpha] is the cached cs_f of the pulse's lag mask pattern
+@numba.njit(cache = True)
+def calc_amp(samples, lags, ce_matrix, se_matrix, cs_amp, p, alfidx, freqidx, nfreqs):
+    r_f = np.float32(0)
+    i_f = np.float32(0)
+    for t in range(lags.shape[0]):
+        ce, se = cube_point(ce_matrix, se_matrix, alfidx, t, freqidx, nfreqs)
+        r_f += samples[p,2*t] * ce + samples[p,2*t+1] * se
+        i_f += samples[p,2*t] * se - samples[p,2*t+1] * ce
+    return (r_f + i_f) / cs_amp[p,alfidx]
+
+# thread for each pulse, find fwhm and calculate amplitude, then subtract the fitted signal from samples
+@numba.njit(parallel = True, cache = True)
+def process_peaks(samples, s_i, s_q, goodlags, lagmask, lags, freqs, alfs, ce_matrix, se_matrix, cs_f, cs_amp, n_good, dbar2, env_model, peaks, alf_fwhm, freq_fwhm, amplitudes, snr, snr_peak):
+    npulses = s_i.shape[0]
+    nalfs, nlags = ce_matrix.shape[:2]
+    nfreqs = freqs.shape[0]
+    reach = (SPOT_WIDTH - 1) // 2
+
+    for p in numba.prange(npulses):
+        peakidx = peaks[p] % (nalfs * nfreqs)
+        alfidx = peakidx // nfreqs
+        freqidx = peakidx % nfreqs
+        apex = pf_point(s_i, s_q, goodlags, ce_matrix, se_matrix, cs_f, n_good, dbar2, p, alfidx, freqidx, nfreqs)
+        factor = apex - HALF_LOG
+
+        # find alpha fwhm
+        afwhm = 1
+        a = alfidx
+        while a < nalfs and pf_point(s_i, s_q, goodlags, ce_matrix, se_matrix, cs_f, n_good, dbar2, p, a, freqidx, nfreqs) > factor:
+            afwhm += 1
+            a += 1
+        a = alfidx
+        while a >= 0 and pf_point(s_i, s_q, goodlags, ce_matrix, se_matrix, cs_f, n_good, dbar2, p, a, freqidx, nfreqs) > factor:
+            afwhm += 1
+            a -= 1
+
+        # find freq fwhm, the walks stop before reaching the first frequency bin like the GPU
+        ffwhm = 1
+        f = freqidx
+        while f % nfreqs != 0 and pf_point(s_i, s_q, goodlags, ce_matrix, se_matrix, cs_f, n_good, dbar2, p, alfidx, f, nfreqs) > factor:
+            ffwhm += 1
+            f += 1
+        f = freqidx
+        while f % nfreqs != 0 and pf_point(s_i, s_q, goodlags, ce_matrix, se_matrix, cs_f, n_good, dbar2, p, alfidx, f, nfreqs) > factor:
+            ffwhm += 1
+            f -= 1
+
+        peakfreq = freqs[freqidx]
+        peakalf = alfs[alfidx]
+        peakamp = calc_amp(samples, lags, ce_matrix, se_matrix, cs_amp, p, alfidx, freqidx, nfreqs)
+
+        # calculate peak SNR and compare to moment SNR
+        fitpwr = 0.
+        rempwr = 0.
+        for t in range(nlags):
+            envelope = peakamp * math.exp((-peakalf * lags[t]) ** env_model)
+            angle = 2 * PI * peakfreq * lags[t]
+            fit_i = envelope * math.cos(angle)
+            fit_q = envelope * math.sin(angle)
+            rempwr += math.sqrt((samples[p,2*t] - fit_i) ** 2 + (samples[p,2*t+1] - fit_q) ** 2) * lagmask[p,t]
+            fitpwr += math.sqrt(fit_i ** 2 + fit_q ** 2) * lagmask[p,t]
+        snr_peak[p] = fitpwr / rempwr
+
+        # de-log and normalize spot around the peak, calculate average freq/alf (calc_peak)
+        spot = np.zeros((SPOT_WIDTH, SPOT_WIDTH))
+        spot_sum = 0.
+        i = 0
+        while i < SPOT_WIDTH and alfidx + i - reach < nalfs and alfidx + i - reach >= 0:
+            j = 0
+            while j < SPOT_WIDTH and freqidx + j - reach < nfreqs and freqidx + j - reach >= 0:
+                spot[i,j] = 10.0 ** (pf_point(s_i, s_q, goodlags, ce_matrix, se_matrix, cs_f, n_good, dbar2, p, alfidx + i - reach, freqidx + j - reach, nfreqs) - np.float32(apex))
+                spot_sum += spot[i,j]
+                j += 1
+            i += 1
+
+        momentfreq = 0.
+        momentalf = 0.
+        if spot_sum > 0:
+            for i in range(SPOT_WIDTH):
+                for j in range(SPOT_WIDTH):
+                    if spot[i,j] > 0:
+                        momentfreq += spot[i,j] / spot_sum * freqs[freqidx + j - reach]
+                        momentalf += spot[i,j] / spot_sum * alfs[alfidx + i - reach]
+
+        amplitudes[p] = peakamp
+        alf_fwhm[p] = afwhm
+        freq_fwhm[p] = ffwhm
+
+        # calculate fitted signal, fitted signal power, and remaining power
+        fitpwr = 0.
+        rempwr = 0.
+        for t in range(nlags):
+            envelope = peakamp * math.exp(-momentalf * lags[t])
+            angle = 2 * PI * momentfreq * lags[t]
+            fit_i = envelope * math.cos(angle)
+            fit_q = envelope * math.sin(angle)
+            samples[p,2*t] -= fit_i
+            samples[p,2*t+1] -= fit_q
+            rempwr += math.sqrt(samples[p,2*t] ** 2 + samples[p,2*t+1] ** 2) * lagmask[p,t]
+            fitpwr += math.sqrt(fit_i ** 2 + fit_q ** 2) * lagmask[p,t]
+        snr[p] = fitpwr / rempwr
+
+class BayesNumba(BayesCPU):
+    # P_f is never stored, only the max along frequency for each (pulse, alpha)
+    def _alloc_P_f(self):
+        self.P_f = None
+        self.alf_max = np.float64(np.zeros([self.npulses, self.nalfs]))
+        self.alf_argmax = np.int32(np.zeros([self.npulses, self.nalfs]))
+
+    def run_bayesfit(self, samples, lagmask, copy_samples = True):
+        # the coarse-to-fine search only evaluates a small fraction of the grid, so it uses the numpy path
+        # the kernels here index the full cubes, separable tables also use the (streaming) numpy path
+        if self.search == 'coarse' or self.separable:
+            return BayesCPU.run_bayesfit(self, samples, lagmask, copy_samples)
+
+        if copy_samples:
+            self.lagmask = np.int32(lagmask)
+            self.samples = samples
+            self.samples_fit = np.float32(np.array(samples)).reshape(self.npulses, 2 * self.nlags)
+
+            self.goodlags = compact_lags(self.lagmask)
+            self._group_masks()
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s_i, s_q = self._calc_stats()
+
+        # compact the masked samples to the good lags of each gate
+        rows = np.arange(self.npulses)[:,np.newaxis]
+        s_i = np.ascontiguousarray(s_i[rows, self.goodlags])
+        s_q = np.ascontiguousarray(s_q[rows, self.goodlags])
+
+        calc_bayes(s_i, s_q, self.goodlags, self.ce_matrix, self.se_matrix, self.cs_f, self.n_good_lags, self.dbar2, self.alf_max, self.alf_argmax, self.nfreqs)
+        find_peaks(self.alf_max, self.alf_argmax, self.nfreqs, self.peaks)
+        cs_amp = self.pattern_cs_f[self.pattern_idx]
+        process_peaks(self.samples_fit, s_i, s_q, self.goodlags, self.lagmask, self.lags, self.freqs, self.alfs, self.ce_matrix, self.se_matrix, self.cs_f, cs_amp, self.n_good_lags, self.dbar2, self.env_model, self.peaks, self.alf_fwhm, self.freq_fwhm, self.amplitudes, self.snr, self.snr_peak)
+
+# throughput comparison of the numba and numpy engines on a synthetic record
+# 75 range gates, 23 lags, and a 512x512 velocity/spectral width grid by default
+def main(npulses = 75, nlags = 23, resolution = 512, repeats = 3):
+    from pydarncuda_fitlomb import MAX_TFREQ, MAX_V, MAX_W, C, LAMBDA_FIT
+
+    amax = np.ceil((np.pi * 2 * MAX_TFREQ * MAX_W) / C)
+    fmax = np.ceil(MAX_V * 3 * MAX_TFREQ / C)
+    freqs = np.linspace(-fmax, fmax, resolution)
+    alfs = np.linspace(0, amax, resolution)
+    lags = np.arange(nlags) * 1.5e-3
+
+    # decaying sinusoids with noise at each range gate, roughly a third of the lags flagged bad
+    np.random.seed(0)
+    F = np.random.uniform(-fmax / 2, fmax / 2, npulses)
+    U = np.random.uniform(10, amax / 4, npulses)
+    signal = np.exp(1j * 2 * np.pi * np.outer(F, lags) - np.outer(U, lags)) * 100
+    signal += 10 * (np.random.randn(npulses, nlags) + 1j * np.random.randn(npulses, nlags))
+    lagmask = np.int8(np.random.rand(npulses, nlags) > .33)
+    samples = np.zeros([npulses, 2 * nlags], dtype=np.float32)
+    samples[:,0::2] = np.real(signal) * lagmask
+    samples[:,1::2] = np.imag(signal) * lagmask
+
+    for engine in [BayesNumba, BayesCPU]:
+        fitter = engine(lags, freqs, alfs, npulses, LAMBDA_FIT)
+        fitter.run_bayesfit(samples, lagmask) # warm up, includes jit compile for numba
+
+        t0 = time.time()
+        for i in xrange(repeats):
+            fitter.run_bayesfit(samples, lagmask)
+            fitter.process_bayesfit(12000., 1.)
+        dt = (time.time() - t0) / repeats
+
+        print engine.__name__ + ': ' + str(dt) + ' s per record, ' + str(npulses / dt) + ' range gates per second'
+
+if __name__ == '__main__':
+    main()
@@ -19,13 +19,23 @@ import datetime, calendar, time
 import numpy as np
 import h5py
 import lagstate
+import timecube
 import pdb
 import os
 import getpass
 import glob
+import sys
+import threading
+import Queue
+import collections
+import heapq
 import matplotlib.pyplot as plt
-from multiprocessing import Pool, Manager , cpu_count
+from multiprocessing import Pool, Manager , cpu_count, Process
+import multiprocessing
 from bigdipper import cache_data, mount_raid0
+from cpu_bayes import ALF_CHUNK
+from recordring import RecordRing, RING_SLOTS, RING_TIMEOUT
+from lombtable import LombTable, GroupWriter, LAYOUT_VERSION, add_storage_arguments, get_storage_args
 
 FITLOMB_REVISION_MAJOR = 3
 FITLOMB_REVISION_MINOR = 8
@@ -51,6 +61,11 @@ MAX_TFREQ = 16e6
 LOMB_PASSES = 1
 NFREQS = 512 
 NALFS = 512 
+PREFETCH_DEPTH = 4 # records read and prepared ahead of the fit by the reader thread
+WRITE_DEPTH = 0 # fitted records queued for the writer thread, 0 to write inline
+REORDER_RECORDS = 2048 # records a daily writer holds back to write them in time order
+PIPELINE_DEPTH = 16 # records held in each queue between pipeline stages
+PIPELINE_POLL = 1 # seconds between checks for dead pipeline workers
 
 DEBUG = True 
 LAGDEBUG = False 
@@ -112,9 +127,12 @@ class CULombFit:
         self.txpl = self.rawacf.prm.txpl # 
         self.mppul = self.rawacf.prm.mppul # 
         self.smsep = self.rawacf.prm.smsep 
-        acfd = np.array(record.rawacf.acfd)
-        self.acfi = acfd[:,:,I_OFFSET]
-        self.acfq = acfd[:,:,Q_OFFSET]
+        self.acfd = np.array(record.rawacf.acfd) # [range][lag][i/q]
+        self.acfi = self.acfd[:,:,I_OFFSET]
+        self.acfq = self.acfd[:,:,Q_OFFSET]
+        self.isamples = None
+        self.resolution = (NFREQS, NALFS) # (freq, alpha) size of the grid the record is fit on, set by CudaCopyPeaks
+        self.sequence = lagstate.sequence_cache.lookup(self.rawacf.prm) # tables shared by records with this pulse sequence
         self.tfreq = self.rawacf.prm.tfreq # transmit frequency (kHz)
         self.bmnum = self.rawacf.bmnum # beam number
         self.pwr0 = self.rawacf.recordDict['pwr0'] # pwr0
@@ -179,114 +197,172 @@ class CULombFit:
         self.phi_sigma_s = np.zeros([self.nrang, self.maxfreqs])
 
         self.CalcLags()
+
+    # drop the raw record once the samples, bad lags, and noise are calculated, keeping what WriteLSSFit needs
+    # a released fit is small enough to pass between pipeline stages
+    def ReleaseRawacf(self):
+        self.rawacf = RawacfHeader(self.rawacf)
+        self.acfd = None
+        self.acfi = None
+        self.acfq = None
+        self.sequence = None
+
+    # move the engine samples into a slot of a shared memory RecordRing, so they aren't pickled between pipeline stages
+    def PackSamples(self, ring, timeout = None):
+        self.samples_slot = ring.pack({'isamples' : self.isamples, 'lagsmask' : self.lagsmask}, timeout)
+        self.isamples = None
+        self.lagsmask = None
+
+    # restore the engine samples as views of their ring slot, valid until ReleaseSamples
+    def UnpackSamples(self, ring):
+        samples = ring.unpack(self.samples_slot)
+        self.isamples = samples['isamples']
+        self.lagsmask = samples['lagsmask']
+
+    # frees the ring slot of the samples, if the record still holds one
+    def ReleaseSamples(self, ring):
+        if getattr(self, 'samples_slot', None) != None:
+            ring.release(self.samples_slot)
+        self.samples_slot = None
+        self.isamples = None
+        self.lagsmask = None
          
-    # appends a record of the lss fit to an hdf5 file
-    def WriteLSSFit(self, hdf5file, calc_sigma = False):
-        groupname = str(calendar.timegm(self.recordtime.timetuple()))
-        grp = hdf5file.create_group(groupname)
-        # add scalars as attributes to group
+    # scalars of the record, in the order they are written as attributes of a record group
+    def FitAttrs(self, origin_time = None):
+        attrs = collections.OrderedDict()
         for attr in self.rawacf.prm.__dict__.keys():
             if self.rawacf.prm.__dict__[attr] != None:
-                grp.attrs[attr] = GROUP_ATTR_TYPES[attr](self.rawacf.prm.__dict__[attr])
+                attrs[attr] = GROUP_ATTR_TYPES[attr](self.rawacf.prm.__dict__[attr])
 
         # add scalars with changed names on davitpy..
-        grp.attrs['noise.search'] = np.float32(self.rawacf.prm.noisesearch)
-        grp.attrs['noise.mean'] = np.float32(self.rawacf.prm.noisemean)
-        grp.attrs['intt.sc'] = np.int16(self.rawacf.prm.inttsc)
-        grp.attrs['intt.us'] = np.int32(self.rawacf.prm.inttus)
-        grp.attrs['channel'] = np.int16(self.rawacf.channel)
-        grp.attrs['bmnum'] = np.int16(self.rawacf.bmnum)
+        attrs['noise.search'] = np.float32(self.rawacf.prm.noisesearch)
+        attrs['noise.mean'] = np.float32(self.rawacf.prm.noisemean)
+        attrs['intt.sc'] = np.int16(self.rawacf.prm.inttsc)
+        attrs['intt.us'] = np.int32(self.rawacf.prm.inttus)
+        attrs['channel'] = np.int16(self.rawacf.channel)
+        attrs['bmnum'] = np.int16(self.rawacf.bmnum)
 
         # add times..
-        grp.attrs['time.yr'] = np.int16(self.recordtime.year)
-        grp.attrs['time.mo'] = np.int16(self.recordtime.month) 
-        grp.attrs['time.dy'] = np.int16(self.recordtime.day)
-        grp.attrs['time.hr'] = np.int16(self.recordtime.hour) 
-        grp.attrs['time.mt'] = np.int16(self.recordtime.minute)
-        grp.attrs['time.sc'] = np.int16(self.recordtime.second)
-        grp.attrs['time.us'] = np.int32(self.recordtime.microsecond) 
-
-        grp.attrs['readme'] = FITLOMB_README
-        grp.attrs['fitlomb.revision.major'] = np.int8(FITLOMB_REVISION_MAJOR)
-        grp.attrs['fitlomb.revision.minor'] = np.int8(FITLOMB_REVISION_MINOR)
-
-        grp.attrs['bayes.vres'] = np.int16(NFREQS)
-        grp.attrs['bayes.wres'] = np.int16(NALFS)
-
-        grp.attrs['fitlomb.bayes.iterations'] = np.int16(self.maxfreqs)
-        grp.attrs['origin.code'] = ORIGIN_CODE # TODO: ADD ARGUEMENTS
-        grp.attrs['origin.time'] = str(datetime.datetime.now())
-        
-        grp.attrs['stid'] = np.int16(self.rawacf.stid)
-        grp.attrs['cp'] = np.int16(self.rawacf.cp)
+        attrs['time.yr'] = np.int16(self.recordtime.year)
+        attrs['time.mo'] = np.int16(self.recordtime.month) 
+        attrs['time.dy'] = np.int16(self.recordtime.day)
+        attrs['time.hr'] = np.int16(self.recordtime.hour) 
+        attrs['time.mt'] = np.int16(self.recordtime.minute)
+        attrs['time.sc'] = np.int16(self.recordtime.second)
+        attrs['time.us'] = np.int32(self.recordtime.microsecond) 
+
+        attrs['readme'] = FITLOMB_README
+        attrs['fitlomb.revision.major'] = np.int8(FITLOMB_REVISION_MAJOR)
+        attrs['fitlomb.revision.minor'] = np.int8(FITLOMB_REVISION_MINOR)
+
+        attrs['bayes.vres'] = np.int16(self.resolution[0])
+        attrs['bayes.wres'] = np.int16(self.resolution[1])
+
+        attrs['fitlomb.bayes.iterations'] = np.int16(self.maxfreqs)
+        attrs['origin.code'] = ORIGIN_CODE # TODO: ADD ARGUEMENTS
+        attrs['origin.time'] = origin_time if origin_time != None else str(datetime.datetime.now())
         
-        grp.attrs['epoch.time'] = calendar.timegm(self.recordtime.timetuple())
-        grp.attrs['noise.lag0'] = np.float64(self.noise) # lag zero power from noise acf?
+        attrs['stid'] = np.int16(self.rawacf.stid)
+        attrs['cp'] = np.int16(self.rawacf.cp)
         
+        attrs['epoch.time'] = calendar.timegm(self.recordtime.timetuple())
+        attrs['noise.lag0'] = np.float64(self.noise) # lag zero power from noise acf?
+        return attrs
+
+    # vectors of the record as (name, data, hdf5 type of the record group dataset)
+    def FitParams(self, calc_sigma = False):
         # copy over vectors from rawacf
-        add_compact_dset(hdf5file, groupname, 'ptab', np.int16(self.ptab), h5py.h5t.STD_I16BE)
-        add_compact_dset(hdf5file, groupname, 'ltab', np.int16(self.ltab), h5py.h5t.STD_I16BE)
-        add_compact_dset(hdf5file, groupname, 'pwr0', np.int32(self.pwr0), h5py.h5t.STD_I32BE)
+        params = [\
+            ('ptab', np.int16(self.ptab), h5py.h5t.STD_I16BE),\
+            ('ltab', np.int16(self.ltab), h5py.h5t.STD_I16BE),\
+            ('pwr0', np.int32(self.pwr0), h5py.h5t.STD_I32BE)]
         
         # add calculated parameters
-        add_compact_dset(hdf5file, groupname, 'qflg', np.int32(self.qflg), h5py.h5t.STD_I32BE)
-        add_compact_dset(hdf5file, groupname, 'gflg', np.int8(self.gflg), h5py.h5t.STD_I8BE)
-        add_compact_dset(hdf5file, groupname, 'iflg', np.int8(self.iflg), h5py.h5t.STD_I8BE)
-        add_compact_dset(hdf5file, groupname, 'nlag', np.int16(self.nlag), h5py.h5t.STD_I16BE)
+        params += [\
+            ('qflg', np.int32(self.qflg), h5py.h5t.STD_I32BE),\
+            ('gflg', np.int8(self.gflg), h5py.h5t.STD_I8BE),\
+            ('iflg', np.int8(self.iflg), h5py.h5t.STD_I8BE),\
+            ('nlag', np.int16(self.nlag), h5py.h5t.STD_I16BE)]
         
-        add_compact_dset(hdf5file, groupname, 'p_l', np.float64(self.p_l), h5py.h5t.NATIVE_DOUBLE)
-        add_compact_dset(hdf5file, groupname, 'p_l_e', np.float64(self.p_l_e), h5py.h5t.NATIVE_DOUBLE)
-        add_compact_dset(hdf5file, groupname, 'w_l', np.float64(self.w_l), h5py.h5t.NATIVE_DOUBLE)
-        add_compact_dset(hdf5file, groupname, 'w_l_e', np.float64(self.w_l_e), h5py.h5t.NATIVE_DOUBLE)
-        add_compact_dset(hdf5file, groupname, 'w_l_std', np.float64(self.w_l_std), h5py.h5t.NATIVE_DOUBLE)
-        add_compact_dset(hdf5file, groupname, 'v', np.float64(self.v_l), h5py.h5t.NATIVE_DOUBLE)
-        add_compact_dset(hdf5file, groupname, 'v_e', np.float64(self.v_l_e), h5py.h5t.NATIVE_DOUBLE)
-        add_compact_dset(hdf5file, groupname, 'v_l_std', np.float64(self.v_l_std), h5py.h5t.NATIVE_DOUBLE)
-        add_compact_dset(hdf5file, groupname, 'fit_snr_l', np.float64(self.fit_snr_l), h5py.h5t.NATIVE_DOUBLE)
-        add_compact_dset(hdf5file, groupname, 'fit_snr_l_peak', np.float64(self.fit_snr_l), h5py.h5t.NATIVE_DOUBLE)
-        add_compact_dset(hdf5file, groupname, 'v_sigma_l', np.float64(self.v_sigma_l), h5py.h5t.NATIVE_DOUBLE)
-        add_compact_dset(hdf5file, groupname, 'phi_sigma_l', np.float64(self.phi_sigma_l), h5py.h5t.NATIVE_DOUBLE)
-        add_compact_dset(hdf5file, groupname, 'slope_sigma_l', np.float64(self.slope_sigma_l), h5py.h5t.NATIVE_DOUBLE)
+        params += [\
+            ('p_l', np.float64(self.p_l), h5py.h5t.NATIVE_DOUBLE),\
+            ('p_l_e', np.float64(self.p_l_e), h5py.h5t.NATIVE_DOUBLE),\
+            ('w_l', np.float64(self.w_l), h5py.h5t.NATIVE_DOUBLE),\
+            ('w_l_e', np.float64(self.w_l_e), h5py.h5t.NATIVE_DOUBLE),\
+            ('w_l_std', np.float64(self.w_l_std), h5py.h5t.NATIVE_DOUBLE),\
+            ('v', np.float64(self.v_l), h5py.h5t.NATIVE_DOUBLE),\
+            ('v_e', np.float64(self.v_l_e), h5py.h5t.NATIVE_DOUBLE),\
+            ('v_l_std', np.float64(self.v_l_std), h5py.h5t.NATIVE_DOUBLE),\
+            ('fit_snr_l', np.float64(self.fit_snr_l), h5py.h5t.NATIVE_DOUBLE),\
+            ('fit_snr_l_peak', np.float64(self.fit_snr_l), h5py.h5t.NATIVE_DOUBLE),\
+            ('v_sigma_l', np.float64(self.v_sigma_l), h5py.h5t.NATIVE_DOUBLE),\
+            ('phi_sigma_l', np.float64(self.phi_sigma_l), h5py.h5t.NATIVE_DOUBLE),\
+            ('slope_sigma_l', np.float64(self.slope_sigma_l), h5py.h5t.NATIVE_DOUBLE)]
 
         if calc_sigma:
-            add_compact_dset(hdf5file, groupname, 'p_s', np.float64(self.p_s), h5py.h5t.NATIVE_DOUBLE)
-            #add_compact_dset(hdf5file, groupname, 'p_s_e', np.float64(self.p_s_e), h5py.h5t.NATIVE_DOUBLE)
-            add_compact_dset(hdf5file, groupname, 'w_s', np.float64(self.w_s), h5py.h5t.NATIVE_DOUBLE)
-            add_compact_dset(hdf5file, groupname, 'w_s_e', np.float64(self.w_s_e), h5py.h5t.NATIVE_DOUBLE)
-            add_compact_dset(hdf5file, groupname, 'w_s_std', np.float64(self.w_s_std), h5py.h5t.NATIVE_DOUBLE)
-            add_compact_dset(hdf5file, groupname, 'v_s', np.float64(self.v_s), h5py.h5t.NATIVE_DOUBLE)
-            add_compact_dset(hdf5file, groupname, 'v_s_e', np.float64(self.v_s_e), h5py.h5t.NATIVE_DOUBLE)
-            add_compact_dset(hdf5file, groupname, 'v_s_std', np.float64(self.v_s_std), h5py.h5t.NATIVE_DOUBLE)
-            add_compact_dset(hdf5file, groupname, 'fit_snr_s', np.float64(self.fit_snr_s), h5py.h5t.NATIVE_DOUBLE)
-            add_compact_dset(hdf5file, groupname, 'v_sigma_s', np.float64(self.v_sigma_s), h5py.h5t.NATIVE_DOUBLE)
-            add_compact_dset(hdf5file, groupname, 'phi_sigma_s', np.float64(self.phi_sigma_s), h5py.h5t.NATIVE_DOUBLE)
-            add_compact_dset(hdf5file, groupname, 'slope_sigma_s', np.float64(self.slope_sigma_s), h5py.h5t.NATIVE_DOUBLE)
+            params += [\
+                ('p_s', np.float64(self.p_s), h5py.h5t.NATIVE_DOUBLE),\
+                #('p_s_e', np.float64(self.p_s_e), h5py.h5t.NATIVE_DOUBLE),\
+                ('w_s', np.float64(self.w_s), h5py.h5t.NATIVE_DOUBLE),\
+                ('w_s_e', np.float64(self.w_s_e), h5py.h5t.NATIVE_DOUBLE),\
+                ('w_s_std', np.float64(self.w_s_std), h5py.h5t.NATIVE_DOUBLE),\
+                ('v_s', np.float64(self.v_s), h5py.h5t.NATIVE_DOUBLE),\
+                ('v_s_e', np.float64(self.v_s_e), h5py.h5t.NATIVE_DOUBLE),\
+                ('v_s_std', np.float64(self.v_s_std), h5py.h5t.NATIVE_DOUBLE),\
+                ('fit_snr_s', np.float64(self.fit_snr_s), h5py.h5t.NATIVE_DOUBLE),\
+                ('v_sigma_s', np.float64(self.v_sigma_s), h5py.h5t.NATIVE_DOUBLE),\
+                ('phi_sigma_s', np.float64(self.phi_sigma_s), h5py.h5t.NATIVE_DOUBLE),\
+                ('slope_sigma_s', np.float64(self.slope_sigma_s), h5py.h5t.NATIVE_DOUBLE)]
+
+        return params
+
+    # appends a record of the lss fit to an hdf5 file, as a group (version 3) or a row of a LombTable (version 4)
+    def WriteLSSFit(self, hdf5file, calc_sigma = False):
+        params = self.FitParams(calc_sigma)
+        # buffered writers stamp every record with the time the file was opened
+        if isinstance(hdf5file, (LombTable, GroupWriter, RecordWriter, DailyQueue)):
+            append_record(hdf5file, self.FitAttrs(hdf5file.origin_time), params)
+            return
+
+        groupname = str(calendar.timegm(self.recordtime.timetuple()))
+        grp = hdf5file.create_group(groupname)
+        # add scalars as attributes to group
+        for (attr, value) in self.FitAttrs().items():
+            grp.attrs[attr] = value
+
+        for (name, data, dtype) in params:
+            add_compact_dset(hdf5file, groupname, name, data, dtype)
 
    
     #@profile 
     def CudaProcessPulse(self, gpu, copy_samples = True):
-        lagsmask = []
-        isamples = np.zeros([len(self.ranges), 2 * gpu.nlags])
-
-        # about 15% of execution time spent here
-        for r in self.ranges:
-            times, samples = self._CalcSamples(r)
-            lmask = [l in times for l in gpu.lags]
-            lagsmask.append(lmask)
-            # create interleaved samples array (todo: don't calculate bad samples for ~2x speedup)
-            i = 0
-            for (j,l) in enumerate(lmask):
-                if l:
-                    isamples[r,2*j] = np.real(samples[i])
-                    isamples[r,2*j+1] = np.imag(samples[i])
-                    i = i + 1
-
-        
-        lagsmask = np.int8(np.array(lagsmask))
-        self.isamples = np.float32(np.array(isamples))
-        gpu.run_bayesfit(self.isamples, lagsmask, copy_samples = copy_samples)
+        self.CalcSamplesBlock(gpu.lags)
+        gpu.run_bayesfit(self.isamples, self.lagsmask, copy_samples = copy_samples)
         gpu.process_bayesfit(self.tfreq, self.noise)
 
+    # create interleaved samples [range][2 * lag] and lag mask [range][lag] for a fitting engine
+    # a lag is good if its lag time is one of the good lag times of the range gate, the good samples fill the good lags in order
+    # acfd [range][lag][i/q] is already interleaved, so the samples are a float32 copy of acfd with bad lags zeroed
+    # the samples are kept until the bad lags change, so the lambda and sigma engines share them
+    def CalcSamplesBlock(self, lags):
+        lags = np.float32(lags)
+        if self.isamples is not None and np.array_equal(lags, self.samples_lags):
+            return
+
+        good = (self.bad_lags == 0)
+        lagsmask = np.any(good[:,np.newaxis,:] & (lags[:,np.newaxis] == self.lags)[np.newaxis,:,:], axis=2)
+
+        isamples = np.float32(self.acfd)
+        if not np.array_equal(lags, self.lags):
+            rows = np.arange(self.nrang)[:,np.newaxis]
+            order = np.argsort(~good, axis=1, kind='mergesort')
+            isamples = isamples[rows, order[rows, np.maximum(np.cumsum(lagsmask, axis=1) - 1, 0)]]
+        isamples[~lagsmask] = 0
+
+        self.samples_lags = lags
+        self.lagsmask = np.int8(lagsmask)
+        self.isamples = isamples.reshape(self.nrang, 2 * len(lags))
+
 
     # get time and good complex samples for a range gate
     def _CalcSamples(self, rgate):
@@ -305,23 +381,29 @@ class CULombFit:
         return t, samples # t is good sample times, samples are good samples at times t
 
     def CalcLags(self):
-        self.lags = np.float32(np.array(map(lambda x : abs(x[1]-x[0]), self.ltab[0:self.mplgs])) * (self.mpinc / 1e6))
+        calc_lags = lambda : np.float32(np.array(map(lambda x : abs(x[1]-x[0]), self.ltab[0:self.mplgs])) * (self.mpinc / 1e6))
+        self.lags = lagstate.sequence_table(self.sequence, 'lags', calc_lags)
+
+    # copy fitted parameters from an engine, rslice selects this record's range gates in a batched engine
+    def CudaCopyPeaks(self, gpu, itr = 0, rslice = None):
+        if rslice == None:
+            rslice = slice(0, self.nrang)
+        self.resolution = (int(gpu.nfreqs), int(gpu.nalfs))
 
-    def CudaCopyPeaks(self, gpu, itr = 0):
         if gpu.env_model == LAMBDA_FIT:
 
-            self.w_l[:,itr] = gpu.w 
+            self.w_l[:,itr] = gpu.w[rslice] 
 
-            self.w_l_std[:,itr] = gpu.w_std
-            self.w_l_e[:,itr] = gpu.w_e
+            self.w_l_std[:,itr] = gpu.w_std[rslice]
+            self.w_l_e[:,itr] = gpu.w_e[rslice]
  
-            self.v_l[:,itr] = gpu.v 
-            self.v_l_std[:,itr] = gpu.v_std
-            self.v_l_e[:,itr] = gpu.v_e
+            self.v_l[:,itr] = gpu.v[rslice] 
+            self.v_l_std[:,itr] = gpu.v_std[rslice]
+            self.v_l_e[:,itr] = gpu.v_e[rslice]
 
-            self.p_l[:,itr] = gpu.p
-            self.fit_snr_l[:,itr] = gpu.snr # record ratio of power in signal versus power in fitted signal
-            self.fit_snr_l_peak[:,itr] = gpu.snr_peak # record ratio of power in signal versus power in fitted signal
+            self.p_l[:,itr] = gpu.p[rslice]
+            self.fit_snr_l[:,itr] = gpu.snr[rslice] # record ratio of power in signal versus power in fitted signal
+            self.fit_snr_l_peak[:,itr] = gpu.snr_peak[rslice] # record ratio of power in signal versus power in fitted signal
             
             iflg = (abs(self.v_l) - (self.v_thresh - (self.v_thresh / self.w_thresh) * abs(self.w_l)) > 0) 
             self.iflg[:,itr][iflg[:,0]] = 1
@@ -336,24 +418,24 @@ class CULombFit:
 
             self.qflg[:,itr][qflg[:,0]] = 1
 
-            self.phi_sigma_l[:,itr] = gpu.phi_sigma
-            self.v_sigma_l[:,itr] = gpu.v_sigma
-            self.slope_sigma_l[:,itr] = gpu.slope_sigma
+            self.phi_sigma_l[:,itr] = gpu.phi_sigma[rslice]
+            self.v_sigma_l[:,itr] = gpu.v_sigma[rslice]
+            self.slope_sigma_l[:,itr] = gpu.slope_sigma[rslice]
 
         elif gpu.env_model == SIGMA_FIT:
-            self.w_s[:, itr] = gpu.w 
-            self.w_s_std[:,itr] = gpu.w_std
-            self.w_s_e[:,itr] = gpu.w_e
+            self.w_s[:, itr] = gpu.w[rslice] 
+            self.w_s_std[:,itr] = gpu.w_std[rslice]
+            self.w_s_e[:,itr] = gpu.w_e[rslice]
  
-            self.v_s[:,itr] = gpu.v 
-            self.v_s_std[:,itr] = gpu.v_std
-            self.v_s_e[:,itr] = gpu.v_e
+            self.v_s[:,itr] = gpu.v[rslice] 
+            self.v_s_std[:,itr] = gpu.v_std[rslice]
+            self.v_s_e[:,itr] = gpu.v_e[rslice]
 
-            self.p_s[:,itr] = gpu.p
-            self.fit_snr_s[:,itr] = gpu.snr
-            self.phi_sigma_s[:,itr] = gpu.phi_sigma
-            self.v_sigma_s[:,itr] = gpu.v_sigma
-            self.slope_sigma_s[:,itr] = gpu.slope_sigma
+            self.p_s[:,itr] = gpu.p[rslice]
+            self.fit_snr_s[:,itr] = gpu.snr[rslice]
+            self.phi_sigma_s[:,itr] = gpu.phi_sigma[rslice]
+            self.v_sigma_s[:,itr] = gpu.v_sigma[rslice]
+            self.slope_sigma_s[:,itr] = gpu.slope_sigma[rslice]
 
         else:
             print 'error - unknown environment model'
@@ -411,20 +493,30 @@ class CULombFit:
     
     # calculate and store bad lags
     #@profile
-    def SetBadlags(self, txlag_cache = None, fitacf_style = True):
+    def SetBadlags(self, fitacf_style = True):
         # use jef's fitacf-style badlags detection
         if fitacf_style:
-            self.bad_lags, tup = lagstate.fitacf_bad_lags(self.rawacf.prm, self.pwr0, np.array(self.rawacf.rawacf.acfd))
+            self.bad_lags, tup = lagstate.fitacf_bad_lags(self.rawacf.prm, self.pwr0, self.acfd, self.sequence)
 
         # set tx lags as bad, and convolute pulse sequence with lag0 power to estimate cross range interference 
         else:
             print 'using convo'
-            self.bad_lags = lagstate.convo_get_bad_lags(self)
+            self.bad_lags = lagstate.convo_get_bad_lags(self, sequence = self.sequence)
 
         self.nlag[:,0] = self.mplgs - sum(self.bad_lags.T)
+        self.isamples = None
         self.CalcNoise()
 
 
+# the parts of a davitpy rawacf record written with a fit
+class RawacfHeader:
+    def __init__(self, record):
+        self.prm = record.prm
+        self.channel = record.channel
+        self.bmnum = record.bmnum
+        self.stid = record.stid
+        self.cp = record.cp
+
 # create a COMPACT type h5py dataset using low level API...
 def add_compact_dset(hdf5file, group, dsetname, data, dtype, mask = []):
     dsetname = (group + '/' + dsetname).encode()
@@ -441,27 +533,359 @@ def add_compact_dset(hdf5file, group, dsetname, data, dtype, mask = []):
     dset = h5py.h5d.create(hdf5file.id, dsetname, dtype, space_id, dcpl)
     dset.write(h5py.h5s.ALL, h5py.h5s.ALL, data)
 
+# reads records and prepares their CULombFits (with bad lags set) in a reader thread, up to depth records ahead of the fit
+# iterating yields the fits in record order, errors in the reader are raised in the iterating thread
+# with depth 0, each record is read and prepared inline when it is needed
+# starved is the time the fit spent waiting on the reader (reading is the bottleneck),
+# blocked is the time the reader spent waiting on a full queue (fitting is the bottleneck)
+class RecordPrefetcher:
+    def __init__(self, myPtr, drec, depth = PREFETCH_DEPTH):
+        self.myPtr = myPtr
+        self.drec = drec
+        self.depth = depth
+        self.nrecords = 0
+        self.starved = 0.
+        self.blocked = 0.
+        self.t0 = time.time()
+
+    def _prepare(self):
+        drec = self.drec
+        while drec != None:
+            fit = CULombFit(drec) # ~ 30% of the time is spent here
+            fit.SetBadlags()
+            yield fit
+            drec = sdio.radDataReadRec(self.myPtr) # ~ 10% of the time is spent here
+
+    def _reader(self):
+        try:
+            for fit in self._prepare():
+                t0 = time.time()
+                self.queue.put((fit, None))
+                self.blocked += time.time() - t0
+            self.queue.put((None, None))
+        except Exception:
+            self.queue.put((None, sys.exc_info()))
+
+    def __iter__(self):
+        if self.depth < 1:
+            for fit in self._prepare():
+                self.nrecords += 1
+                yield fit
+            return
+
+        self.queue = Queue.Queue(self.depth)
+        reader = threading.Thread(target = self._reader)
+        reader.daemon = True # don't hold up the worker if the fit fails with the reader blocked on a full queue
+        reader.start()
+
+        while True:
+            t0 = time.time()
+            fit, error = self.queue.get()
+            self.starved += time.time() - t0
+
+            if error != None:
+                raise error[0], error[1], error[2]
+            if fit == None:
+                break
+
+            self.nrecords += 1
+            yield fit
+
+        reader.join()
+
+    def report(self):
+        elapsed = time.time() - self.t0
+        print 'prefetch: ' + str(self.nrecords) + ' records in ' + str(round(elapsed, 1)) + ' s, fit waited ' + str(round(self.starved, 1)) + ' s on the reader, reader waited ' + str(round(self.blocked, 1)) + ' s on the fit (queue depth ' + str(self.depth) + ')'
+
+# appends the scalars and (name, data, hdf5 type) vectors of a fitted record to a LombTable, GroupWriter, RecordWriter, or DailyQueue
+def append_record(hdf5file, attrs, params):
+    if isinstance(hdf5file, LombTable):
+        hdf5file.append(attrs, collections.OrderedDict((name, data) for (name, data, dtype) in params))
+    else:
+        hdf5file.append(attrs, params)
+
+# writes fitted records to a LombTable or GroupWriter from a writer thread, so the fit doesn't wait on hdf5 (e.g on the sshfs mounted raid)
+# the fit queues the scalars and vectors of each record, at most depth records wait for the writer
+# close() waits for the queue to drain before closing the file, an error in the writer is raised in the fit on the next append or close
+# the queue high-water mark and time the fit spent blocked on a full queue are reported to size the queue
+class RecordWriter:
+    def __init__(self, hdf5file, depth = WRITE_DEPTH):
+        self.hdf5file = hdf5file
+        self.origin_time = hdf5file.origin_time
+        self.depth = depth
+        self.nrecords = 0
+        self.highwater = 0
+        self.blocked = 0.
+        self.error = None # exception info of the first failed write, later records are dropped
+        self.raised = False
+        self.closed = False
+        self.t0 = time.time()
+
+        self.queue = Queue.Queue(depth)
+        self.writer = threading.Thread(target = self._writer)
+        self.writer.daemon = True # don't hold up the worker if the fit fails with records still queued
+        self.writer.start()
+
+    def _writer(self):
+        while True:
+            record = self.queue.get()
+            if record == None:
+                break
+            # keep draining the queue after an error so the fit doesn't block
+            if self.error == None:
+                try:
+                    append_record(self.hdf5file, record[0], record[1])
+                except Exception:
+                    self.error = sys.exc_info()
+
+    # raise a failed write once in the fit
+    def _raise(self):
+        if self.error != None and not self.raised:
+            self.raised = True
+            raise self.error[0], self.error[1], self.error[2]
+
+    def append(self, attrs, params):
+        self._raise()
+        t0 = time.time()
+        self.queue.put((attrs, params))
+        self.blocked += time.time() - t0
+        self.highwater = max(self.highwater, self.queue.qsize())
+        self.nrecords += 1
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.writer.join()
+        self.hdf5file.close()
+        self._raise()
+
+    def report(self):
+        elapsed = time.time() - self.t0
+        print 'writer: ' + str(self.nrecords) + ' records in ' + str(round(elapsed, 1)) + ' s, fit waited ' + str(round(self.blocked, 1)) + ' s on a full queue, queue high-water mark ' + str(self.highwater) + ' (queue depth ' + str(self.depth) + ')'
+
+# returns the fitting engine class for a backend
+# engines are imported here so cpu-only nodes don't need pycuda (or numba)
+# auto picks the first engine that loads, trying cuda, then numba, then numpy
+# auto skips cuda if the engine options are only implemented by the cpu engines
+def get_engine(backend, cpu_only = False):
+    if backend == 'auto':
+        backends = ['numba'] if cpu_only else ['cuda', 'numba']
+        for backend in backends:
+            try:
+                return get_engine(backend)
+            except Exception as e:
+                print 'unable to load ' + backend + ' fitting engine (' + str(e) + '), trying next engine'
+        backend = 'numpy'
+
+    if backend == 'cuda':
+        from cuda_bayes import BayesGPU
+        return BayesGPU
+    elif backend == 'numba':
+        from numba_bayes import BayesNumba
+        return BayesNumba
+    elif backend == 'numpy':
+        from cpu_bayes import BayesCPU
+        return BayesCPU
+    else:
+        raise ValueError('unknown fitting backend: ' + str(backend))
+
+# true if the engine options need a cpu engine (BayesCPU or BayesNumba)
+# the coarse-to-fine search and separable tables are not implemented on the GPU
+def cpu_only(engine_args):
+    return engine_args.get('search', 'full') != 'full' or engine_args.get('separable', False)
+
+# print reuse of the lag mask patterns cached by an engine (the cpu engines cache cs_f for each pattern)
+def print_mask_cache(engine):
+    if hasattr(engine, 'mask_cache'):
+        cache = engine.mask_cache
+        print 'lag mask cache: ' + str(len(cache.entries)) + ' patterns, ' + str(cache.hits) + ' hits, ' + str(cache.misses) + ' misses (' + str(round(100 * cache.hit_rate(), 1)) + '% reuse)'
+
+# pick the number of records to fit in each engine call
+# auto sizes batches so the P_f buffers of the engines fit in batchmem megabytes
+# streaming engines only hold P_f for a chunk of alphas at a time
+# resolution is the (freq, alpha) size of the grid, defaulting to NFREQS x NALFS
+def get_batchsize(batchsize, batchmem, nrang, engine, calc_sigma, stream = False, resolution = None):
+    nfreqs, nalfs = resolution or (NFREQS, NALFS)
+    if batchsize == 'auto':
+        nengines = 2 if calc_sigma else 1
+        gatebytes = nengines * nfreqs * nalfs * 8 # P_f is float64 [pulse][alpha][freq]
+        if stream:
+            gatebytes = nengines * nfreqs * ALF_CHUNK * 8
+        nbatch = int(batchmem * 2 ** 20 / (gatebytes * nrang))
+    else:
+        nbatch = int(batchsize)
+
+    # the GPU engine processes peaks with a thread for each pulse, so batches are limited by the block size
+    if hasattr(engine, 'MAX_PULSES'):
+        nbatch = min(nbatch, engine.MAX_PULSES / nrang)
+
+    return max(nbatch, 1)
+
+# fit a batch of records with the same pulse sequence in one engine call
+# each record occupies nrang consecutive pulses in the engine, short batches are padded with empty range gates
+def CudaProcessBatch(fits, gpu, copy_samples = True):
+    nrang = fits[0].nrang
+    tfreq = np.ones(gpu.npulses) * fits[0].tfreq
+    noise = np.ones(gpu.npulses)
+    samples = None
+    lagmask = None
+
+    if copy_samples:
+        samples = np.zeros([gpu.npulses, 2 * gpu.nlags], dtype=np.float32)
+        lagmask = np.zeros([gpu.npulses, gpu.nlags], dtype=np.int8)
+
+    for (i, fit) in enumerate(fits):
+        rslice = slice(i * nrang, (i + 1) * nrang)
+        if copy_samples:
+            fit.CalcSamplesBlock(gpu.lags)
+            samples[rslice] = fit.isamples
+            lagmask[rslice] = fit.lagsmask
+        tfreq[rslice] = fit.tfreq
+        noise[rslice] = fit.noise
+
+    gpu.run_bayesfit(samples, lagmask, copy_samples = copy_samples)
+    gpu.process_bayesfit(tfreq, noise)
+
+# split fitted parameters from a batched engine back into each record
+def CudaCopyBatch(fits, gpu, itr = 0):
+    for (i, fit) in enumerate(fits):
+        fit.CudaCopyPeaks(gpu, itr, slice(i * fit.nrang, (i + 1) * fit.nrang))
+
+# run all lomb passes on a batch of records, then write the fits (unless hdf5file is None)
+def FitBatch(fits, gpu_lambda, gpu_sigma, hdf5file, calc_sigma):
+    try:
+        CudaProcessBatch(fits, gpu_lambda)
+        if calc_sigma:
+            CudaProcessBatch(fits, gpu_sigma)
+
+        CudaCopyBatch(fits, gpu_lambda)
+        if calc_sigma:
+            CudaCopyBatch(fits, gpu_sigma)
+        
+        if(LOMB_PASSES >= 1):
+            for i in xrange(1, LOMB_PASSES):
+                CudaProcessBatch(fits, gpu_lambda, copy_samples = False) 
+                if calc_sigma:
+                    CudaProcessBatch(fits, gpu_sigma, copy_samples = False) 
+
+                CudaCopyBatch(fits, gpu_lambda, i)
+                if calc_sigma:
+                    CudaCopyBatch(fits, gpu_sigma, i)
+
+        if hdf5file != None:
+            for fit in fits:
+                fit.WriteLSSFit(hdf5file, calc_sigma) # 4 %
+                #fit.CudaPlotFit(gpu_lambda)
+
+    except None:
+        print 'error fitting file, skipping records at ' + str(fits[0].recordtime) 
+
 # worker function to fitlomb process a block of time
 #@profile
 def generate_fitlomb(record):
     print 'starting generate fitlomb'
-    from cuda_bayes import BayesGPU
     # unpack record tuple (passing multiple arguements with map is awkward..)
-    stime, etime, radar, lock, overwrite, calc_sigma = record
+    # datadir is the base directory of the fitlomb files
+    # engine_args are extra keyword arguments for the fitting engine (search mode, streaming, separable tables), and the grid resolution
+    # prefetch is the number of records prepared ahead of the fit by a reader thread
+    # layout is the version of the output file layout (3 or 4), storage_args are LombTable options for version 4 files
+    # writedepth is the number of fitted records queued for a writer thread, 0 to write inline
+    # daily is the (queue, block) of the daily writer of the block's radar/day, or None to write a file for the block
+    stime, etime, radar, lock, overwrite, datadir, calc_sigma, backend, batchsize, batchmem, engine_args, prefetch, layout, storage_args, writedepth, daily = record
+    BayesEngine = get_engine(backend, cpu_only(engine_args))
 
     print 'worker computing from ' + str(stime) + ' to ' + str(etime)
-    outfilename = stime.strftime('%Y%m%d.%H%M.' + radar + '.fitlomb.hdf5') 
-    outfilepath = DATA_DIR + stime.strftime('%Y/%m.%d/') 
+    if daily != None:
+        hdf5file = DailyQueue(daily[0], daily[1])
+    else:
+        outfilepath, outfilename = fitlomb_path(datadir, stime, radar)
 
-    if not os.path.exists(outfilepath):
-        os.makedirs(outfilepath)
-    if not overwrite and os.path.exists(outfilepath + outfilename):
-        print outfilename + ' already exists, skipping... (overwrite files with --overwrite)'
-        return
+        if not os.path.exists(outfilepath):
+            os.makedirs(outfilepath)
+        if not overwrite and os.path.exists(outfilepath + outfilename):
+            print outfilename + ' already exists, skipping... (overwrite files with --overwrite)'
+            return
+
+        hdf5file = create_fitlomb(outfilepath + outfilename, layout, storage_args)
+
+    if writedepth > 0:
+        hdf5file = RecordWriter(hdf5file, writedepth)
+
+    # in daily mode the block is closed even if the fit fails, so the daily writer finishes its day
+    try:
+        myPtr = open_rawacf(stime, etime, radar, lock)
 
-    hdf5file = h5py.File(outfilepath + outfilename, 'w')
+        try: 
+            drec = sdio.radDataReadRec(myPtr)
 
-    # open records, lock so multiple processes don't step over eachother unpacking and copying rawacfs to /tmp 
+        except:
+            print 'error reading first rawacf record for ' + str(stime) + '... skipping to next record block'
+            hdf5file.close() 
+            return 
+    
+        engines = (None, None)
+        batch = []
+        records = RecordPrefetcher(myPtr, drec, prefetch)
+
+        for fit in records:
+            # records in a batch must share a pulse sequence, fit the pending batch if the sequence changes
+            if len(batch) and not same_sequence(batch[0], fit):
+                FitBatch(batch, engines[0], engines[1], hdf5file, calc_sigma)
+                batch = []
+
+            # engines are sized for a batch of nbatch records
+            nbatch = get_batchsize(batchsize, batchmem, fit.nrang, BayesEngine, calc_sigma, engine_args.get('stream', False), grid_resolution(engine_args))
+            engines = get_engines(engines, BayesEngine, fit, nbatch, calc_sigma, engine_args)
+            batch.append(fit)
+
+            if len(batch) == nbatch:
+                FitBatch(batch, engines[0], engines[1], hdf5file, calc_sigma)
+                batch = []
+
+        if len(batch):
+            FitBatch(batch, engines[0], engines[1], hdf5file, calc_sigma)
+
+        records.report()
+        print_mask_cache(engines[0])
+        cache = lagstate.sequence_cache
+        print 'pulse sequence cache: ' + str(len(cache.entries)) + ' sequences, ' + str(cache.hits) + ' hits, ' + str(cache.misses) + ' misses (' + str(round(100 * cache.hit_rate(), 1)) + '% reuse)'
+        cache = timecube.cube_cache
+        print 'cube cache: ' + str(len(cache.cubecache)) + ' cubes (' + str(round(cache.nbytes / 2. ** 20, 1)) + ' MB), ' + str(cache.hits) + ' hits, ' + str(cache.misses) + ' misses, ' + str(cache.evictions) + ' evictions, ' + str(cache.diskhits) + ' loaded from disk (' + str(round(100 * cache.hit_rate(), 1)) + '% reuse)'
+        hdf5file.close() 
+    finally:
+        if daily != None:
+            hdf5file.close()
+    if writedepth > 0:
+        hdf5file.report()
+    remove_tmp_rawacf(etime, radar)
+
+# directory and file name of the fitlomb file for a time block
+def fitlomb_path(datadir, stime, radar):
+    outfilename = stime.strftime('%Y%m%d.%H%M.' + radar + '.fitlomb.hdf5') 
+    outfilepath = datadir + stime.strftime('%Y/%m.%d/') 
+    return outfilepath, outfilename
+
+# directory and file name of the consolidated fitlomb file of a radar/day
+# the name matches the glob of fitlomb_tools.createMergefile, so daily files can still be merged over several days
+def daily_path(datadir, day, radar):
+    outfilename = day.strftime('%Y%m%d.day.' + radar + '.fitlomb.hdf5')
+    outfilepath = datadir + day.strftime('%Y/%m.%d/')
+    return outfilepath, outfilename
+
+# creates a fitlomb file, version 3 files are written through a GroupWriter which buffers record groups and writes them in bursts,
+# version 4 files are written through a LombTable which buffers records and appends them in bulk
+# storage_args are LombTable keyword arguments (compression, shuffle, reduced precision)
+def create_fitlomb(path, layout = 3, storage_args = {}):
+    hdf5file = h5py.File(path, 'w')
+    if layout == LAYOUT_VERSION:
+        return LombTable(hdf5file, **storage_args)
+    return GroupWriter(hdf5file)
+
+# open the rawacf records of a time block
+# lock so multiple processes don't step over eachother unpacking and copying rawacfs to /tmp 
+def open_rawacf(stime, etime, radar, lock):
     lock.acquire()
     if '.' in radar:
         channel = radar.split('.')[-1]
@@ -471,89 +895,440 @@ def generate_fitlomb(record):
 
     myPtr = sdio.radDataOpen(stime,radar,eTime=etime,channel=channel,bmnum=None,cp=None,fileType='rawacf',filtered=False, src='local')
     lock.release()
+    return myPtr
 
-    # set up frequency/alpha vectors 
+# remove the tmp rawacf file unpacked for a time block
+def remove_tmp_rawacf(etime, radar):
+    tmprawacf = glob.glob(etime.strftime('/tmp/sd/*.*.%Y%m%d.%H%M*.') + radar.split('.')[0] + '.rawacf')
+
+    if len(tmprawacf) == 1:
+        os.remove(tmprawacf[0])
+    else:
+        print 'error removing rawacf temp file'
+
+# velocity and spectral width space based on maximum transmit frequency, as frequency and alpha vectors
+# resolution is the (freq, alpha) size of the grid, defaulting to NFREQS x NALFS
+def bayes_grids(resolution = None):
+    nfreqs, nalfs = resolution or (NFREQS, NALFS)
     amax = np.ceil((np.pi * 2 * MAX_TFREQ * MAX_W) / C)
     fmax = np.ceil(MAX_V * 3 * MAX_TFREQ / C)
-    freqs = np.linspace(-fmax,fmax, NFREQS)
-    alfs = np.linspace(0, amax, NALFS)
-    
-    try: 
-        drec = sdio.radDataReadRec(myPtr)
-
-    except:
-        print 'error reading first rawacf record for ' + str(stime) + '... skipping to next record block'
-        hdf5file.close() 
-        return 
-    
-    txlag_cache = None
-    gpu_lambda = None
+    freqs = np.linspace(-fmax,fmax, nfreqs)
+    alfs = np.linspace(0, amax, nalfs)
+    return freqs, alfs
+
+# (freq, alpha) size of the grid for the engine options, from the resolution option if it is set
+def grid_resolution(engine_args):
+    return engine_args.get('resolution', (NFREQS, NALFS))
+
+# keyword arguments for the fitting engine, the engine options without the grid resolution
+def engine_kwargs(engine_args):
+    return dict((key, value) for (key, value) in engine_args.items() if key != 'resolution')
+
+# true if two records share a pulse sequence, so they can be fit in one batch
+def same_sequence(fit_a, fit_b):
+    return fit_a.nrang == fit_b.nrang and np.array_equal(fit_a.lags, fit_b.lags)
+
+# returns the (lambda, sigma) engines for a batch of nbatch records with the pulse sequence of fit
+# the current engines are kept unless the pulse sequence or batch size changed
+def get_engines(engines, BayesEngine, fit, nbatch, calc_sigma, engine_args):
+    gpu_lambda, gpu_sigma = engines
+    if gpu_lambda != None and gpu_lambda.npulses == nbatch * fit.nrang and np.array_equal(fit.lags, gpu_lambda.lags):
+        return engines
+
+    # generate new caches for the fit if the pulse sequence has changed 
+    if gpu_lambda != None:
+        print_mask_cache(gpu_lambda)
+        print 'the pulse sequence has changed'
+
+    freqs, alfs = bayes_grids(grid_resolution(engine_args))
+    gpu_lambda = BayesEngine(fit.lags, freqs, alfs, nbatch * fit.nrang, LAMBDA_FIT, **engine_kwargs(engine_args))
     if calc_sigma:
-        gpu_sigma = None
+        gpu_sigma = BayesEngine(fit.lags, freqs, alfs, nbatch * fit.nrang, SIGMA_FIT, **engine_kwargs(engine_args))
+
+    return gpu_lambda, gpu_sigma
+
+
+# daily mode sends the fitted records of every worker to a writer process for each radar,
+# which appends them to one consolidated file per day instead of a file per time block, starting a new file at midnight
+# a DailyQueue takes the place of the fitlomb file of a block in a worker, queue items are (block, attrs, params) for a record,
+# (block, None, None) once the block is finished, and None once every worker is finished
+# a block is identified by its start time, blocks are split at midnight so each belongs to one day
+class DailyQueue:
+    def __init__(self, queue, block):
+        self.queue = queue
+        self.block = block
+        self.origin_time = str(datetime.datetime.now()) # replaced by the daily writer
+        self.closed = False
+
+    def append(self, attrs, params):
+        self.queue.put((self.block, attrs, params))
+
+    # tells the daily writer the block is finished, only once
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put((self.block, None, None))
+
+# writes the records of a radar/day to one file
+# records of a block arrive in time order, but blocks are fit in parallel so records of different blocks are interleaved
+# a record is held in a reorder buffer until no unfinished block can send an earlier record, so the file is written mostly in time order
+# past reorder held records the earliest is written anyway, records that arrive earlier than one already written are counted as late
+# late records don't break the time order of the file, version 3 readers sort record groups by name (the epoch time),
+# and LombTable sorts the rows of version 4 files by epoch time when it is closed
+# the file is created with the first record, so days without records don't leave empty files
+# a record that fails to write (hdf5 error, disk full, duplicate epoch time) is logged and counted, and the writer keeps going
+class DailyWriter:
+    def __init__(self, path, blocks, layout = 3, storage_args = {}, reorder = REORDER_RECORDS):
+        self.path = path
+        self.layout = layout
+        self.storage_args = storage_args
+        self.reorder = reorder
+        self.hdf5file = None
+        self.latest = dict((block, calendar.timegm(block.timetuple())) for block in blocks) # unfinished block -> time of its latest record
+        self.heap = [] # held records as (epoch time, arrival, attrs, params)
+        self.narrived = 0
+        self.nrecords = 0 # records taken from the reorder buffer
+        self.failed = 0 # records dropped before the file writer took them (records it drops are counted in its nfailed)
+        self.late = 0
+        self.maxheld = 0
+        self.lasttime = None
+
+    def _write(self):
+        epoch, arrival, attrs, params = heapq.heappop(self.heap)
+        self.nrecords += 1
+        if self.lasttime != None and epoch < self.lasttime:
+            self.late += 1
+        self.lasttime = max(epoch, self.lasttime)
 
-    while drec != None:
         try:
-            fit = CULombFit(drec) # ~ 30% of the time is spent here
-        except None:
-            print 'error reading rawacf record, skipping'
+            if self.hdf5file == None:
+                if not os.path.exists(os.path.dirname(self.path)):
+                    os.makedirs(os.path.dirname(self.path))
+                self.hdf5file = create_fitlomb(self.path, self.layout, self.storage_args)
+        except Exception as e:
+            self.failed += 1
+            print 'daily writer: error creating ' + self.path + ' (' + str(e) + ')... dropping the record at ' + str(epoch)
+            return
+
+        nfailed = self.hdf5file.nfailed
+        try:
+            attrs['origin.time'] = self.hdf5file.origin_time
+            append_record(self.hdf5file, attrs, params)
+        except Exception as e:
+            print 'daily writer: error writing the record at ' + str(epoch) + ' to ' + self.path + ' (' + str(e) + ')'
+            if self.hdf5file.nfailed == nfailed:
+                self.failed += 1
+
+    def add(self, block, attrs, params):
+        if attrs == None:
+            self.latest.pop(block, None)
+        else:
+            self.latest[block] = attrs['epoch.time']
+            heapq.heappush(self.heap, (attrs['epoch.time'], self.narrived, attrs, params))
+            self.narrived += 1
+            self.maxheld = max(self.maxheld, len(self.heap))
+
+        while len(self.heap) and (not len(self.latest) or self.heap[0][0] <= min(self.latest.values())):
+            self._write()
+        while len(self.heap) > self.reorder:
+            self._write()
+
+    # true once every block of the day is finished
+    def finished(self):
+        return not len(self.latest)
+
+    def close(self):
+        while len(self.heap):
+            self._write()
+        failed = self.failed
+        if self.hdf5file != None:
+            try:
+                self.hdf5file.close()
+            except Exception as e:
+                print 'daily writer: error closing ' + self.path + ' (' + str(e) + ')'
+            failed += self.hdf5file.nfailed
+        print 'daily writer: ' + str(self.nrecords - failed) + ' records to ' + self.path + ', ' + str(failed) + ' failed, ' + str(self.late) + ' late, reorder buffer high-water mark ' + str(self.maxheld) + ' (reorder ' + str(self.reorder) + ')'
+
+# daily writer process of a radar, blocks are the start times of the radar's blocks
+# the DailyWriter of a day is started by the first item of one of its blocks and closed once its last block is finished,
+# so only the days being fit have open files
+# the queue is drained until the None sentinel even if items fail, so the workers never block on a full queue
+def daily_write(queue, datadir, radar, blocks, layout = 3, storage_args = {}, reorder = REORDER_RECORDS):
+    days = {} # day -> start times of its blocks
+    for block in blocks:
+        days.setdefault(block.date(), []).append(block)
+
+    writers = {} # day -> DailyWriter
+    for (block, attrs, params) in iter(queue.get, None):
+        try:
+            day = block.date()
+            if not day in writers:
+                outfilepath, outfilename = daily_path(datadir, day, radar)
+                writers[day] = DailyWriter(outfilepath + outfilename, days[day], layout, storage_args, reorder)
+
+            writers[day].add(block, attrs, params)
+            if writers[day].finished():
+                writers.pop(day).close()
+        except Exception as e:
+            print 'daily writer: error handling a ' + radar + ' record of the block at ' + str(block) + ' (' + str(e) + ')'
+
+    # days with blocks that never finished (e.g a worker failed)
+    for day in sorted(writers.keys()):
+        try:
+            writers[day].close()
+        except Exception as e:
+            print 'daily writer: error closing the ' + radar + ' file of ' + str(day) + ' (' + str(e) + ')'
+
+# starts a daily writer for each radar of a list of worker records, returns the records with their daily queues and the (queue, process) of the writers
+# days with an existing daily file are dropped unless overwrite is set
+def start_daily_writers(records, manager, overwrite, layout = 3, storage_args = {}, depth = PIPELINE_DEPTH, reorder = REORDER_RECORDS):
+    daily_records = []
+    skipped = set()
+    radars = collections.OrderedDict() # (radar, datadir) -> start times of its blocks
+    for record in records:
+        stime, radar, datadir = record[0], record[2], record[5]
+        outfilepath, outfilename = daily_path(datadir, stime.date(), radar)
+        if not overwrite and os.path.exists(outfilepath + outfilename):
+            if not outfilepath + outfilename in skipped:
+                print outfilename + ' already exists, skipping... (overwrite files with --overwrite)'
+                skipped.add(outfilepath + outfilename)
+            continue
+        radars.setdefault((radar, datadir), []).append(stime)
+        daily_records.append(record)
+
+    queues = {}
+    writers = []
+    for ((radar, datadir), blocks) in radars.items():
+        queues[(radar, datadir)] = manager.Queue(depth)
+        writer = Process(target = daily_write, args = (queues[(radar, datadir)], datadir, radar, blocks, layout, storage_args, reorder))
+        writer.start()
+        writers.append((queues[(radar, datadir)], writer))
+
+    daily_records = [record[:-1] + ((queues[(record[2], record[5])], record[0]),) for record in daily_records]
+    return daily_records, writers
+
+# closes the daily files once every worker is finished
+def stop_daily_writers(writers):
+    for (queue, writer) in writers:
+        queue.put(None)
+    for (queue, writer) in writers:
+        writer.join()
+
+# pipeline mode runs the stages of generate_fitlomb in separate groups of processes connected by bounded queues,
+# so slow record parsing doesn't leave the fitting engines idle
+# decode workers read time blocks and prepare records (bad lags, noise, and engine samples), then drop the raw records
+# fit workers batch records by pulse sequence and run the engines, write workers own the hdf5 files
+# a block is (index, stime, etime, radar), the file of a block is written by write worker index % nwriters
+# queue items are (block, fit) for a record, or (block, nrecords) once a block is decoded. None stops a worker
+# a record that fails to fit is passed to the writers as (block, None), and the file of its block is discarded
+# with a RecordRing, the samples of each record go from the decoders to the fit workers through shared memory
+def pipeline_decode(blocks, fit_queue, lock, overwrite, datadir, prefetch, ring = None):
+    for block in iter(blocks.get, None):
+        index, stime, etime, radar = block
+        outfilepath, outfilename = fitlomb_path(datadir, stime, radar)
+        if not overwrite and os.path.exists(outfilepath + outfilename):
+            print outfilename + ' already exists, skipping... (overwrite files with --overwrite)'
             continue
-        
-        # create velocity and spectral width space based on maximum transmit frequency
-        if gpu_lambda == None:
-            gpu_lambda = BayesGPU(fit.lags, freqs, alfs, fit.nrang, LAMBDA_FIT)
-            if calc_sigma:
-                gpu_sigma = BayesGPU(fit.lags, freqs, alfs, fit.nrang, SIGMA_FIT)
-            #txlag_cache = lagstate.good_lags_txsamples(fit)
-
-        # generate new caches on the GPU for the fit if the pulse sequence has changed 
-        elif gpu_lambda.npulses != fit.nrang or (not np.array_equal(fit.lags, gpu_lambda.lags)):
-            gpu_lambda = BayesGPU(fit.lags, freqs, alfs, fit.nrang, LAMBDA_FIT)
-
-            if calc_sigma:
-                gpu_sigma = BayesGPU(fit.lags, freqs, alfs, fit.nrang, SIGMA_FIT)
-
-            #txlag_cache = lagstate.good_lags_txsamples(fit)
-            print 'the pulse sequence has changed'
-        
-        fit.SetBadlags()
 
+        print 'decoding from ' + str(stime) + ' to ' + str(etime)
+        nrecords = 0
         try:
-            fit.CudaProcessPulse(gpu_lambda)
-            if calc_sigma:
-                fit.CudaProcessPulse(gpu_sigma)
-
-            fit.CudaCopyPeaks(gpu_lambda)
-            if calc_sigma:
-                fit.CudaCopyPeaks(gpu_sigma)
-            
-            if(LOMB_PASSES >= 1):
-                for i in xrange(1, LOMB_PASSES):
-                    fit.CudaProcessPulse(gpu_lambda, copy_samples = False) 
-                    if calc_sigma:
-                        fit.CudaProcessPulse(gpu_sigma, copy_samples = False) 
-
-                    fit.CudaCopyPeaks(gpu_lambda, i)
-                    if calc_sigma:
-                        fit.CudaCopyPeaks(gpu_sigma, i)
-   
-            fit.WriteLSSFit(hdf5file, calc_sigma) # 4 %
-            #fit.CudaPlotFit(gpu_lambda)
-
-        except None:
-            print 'error fitting file, skipping record at ' + str(fit.recordtime) 
-
-        drec = sdio.radDataReadRec(myPtr) # ~ 10% of the time is spent here
-
-    hdf5file.close() 
-    
-    # remove tmp rawacf file
-    tmprawacf = glob.glob(etime.strftime('/tmp/sd/*.*.%Y%m%d.%H%M*.') + radar + '.rawacf')
+            myPtr = open_rawacf(stime, etime, radar, lock)
+            drec = sdio.radDataReadRec(myPtr)
+            for fit in RecordPrefetcher(myPtr, drec, prefetch):
+                fit.CalcSamplesBlock(fit.lags)
+                fit.ReleaseRawacf()
+                if ring != None:
+                    fit.PackSamples(ring, RING_TIMEOUT)
+                fit_queue.put((block, fit))
+                nrecords += 1
+        except Exception as e:
+            print 'error reading rawacf records for ' + str(stime) + ' (' + str(e) + ')... skipping to next record block'
+
+        fit_queue.put((block, nrecords))
+        remove_tmp_rawacf(etime, radar)
+
+# tells the writers that the (block, fit) records of a batch were dropped
+def pipeline_drop(batch, write_queues):
+    for (block, fit) in batch:
+        write_queues[block[0] % len(write_queues)].put((block, None))
+
+# fits a batch of (block, fit) records, then hands the fits without their samples to the writers
+def pipeline_fit_batch(batch, engines, calc_sigma, write_queues, ring = None):
+    try:
+        FitBatch([fit for (block, fit) in batch], engines[0], engines[1], None, calc_sigma)
+    except Exception as e:
+        print 'error fitting ' + str(len(batch)) + ' records from ' + str(batch[0][1].recordtime) + ' (' + str(e) + ')... dropping them'
+        pipeline_drop(batch, write_queues)
+        return
+    finally:
+        # free the ring slots of the batch even if the fit failed, or the decoders run out of slots
+        for (block, fit) in batch:
+            if ring != None:
+                fit.ReleaseSamples(ring)
+            fit.isamples = None
+            fit.lagsmask = None
+
+    for (block, fit) in batch:
+        write_queues[block[0] % len(write_queues)].put((block, fit))
+
+# batches fill from records already waiting in the queue, a partial batch is fit rather than waiting on the decoders
+# starved is the time spent waiting on an empty queue, if it is large add decode workers
+def pipeline_fit(fit_queue, write_queues, backend, batchsize, batchmem, calc_sigma, engine_args, ring = None):
+    BayesEngine = get_engine(backend, cpu_only(engine_args))
+    engines = (None, None)
+    batch = []
+    nrecords = 0
+    starved = 0.
+
+    while True:
+        try:
+            item = fit_queue.get_nowait()
+        except Queue.Empty:
+            if len(batch):
+                pipeline_fit_batch(batch, engines, calc_sigma, write_queues, ring)
+                batch = []
+            t0 = time.time()
+            item = fit_queue.get()
+            starved += time.time() - t0
+
+        if item == None:
+            break
+
+        block, fit = item
+        if not isinstance(fit, CULombFit):
+            write_queues[block[0] % len(write_queues)].put(item)
+            continue
 
-    if len(tmprawacf) == 1:
-        os.remove(tmprawacf[0])
-    else:
-        print 'error removing rawacf temp file'
+        try:
+            if ring != None:
+                fit.UnpackSamples(ring)
+
+            if len(batch) and not same_sequence(batch[0][1], fit):
+                pipeline_fit_batch(batch, engines, calc_sigma, write_queues, ring)
+                batch = []
+
+            nbatch = get_batchsize(batchsize, batchmem, fit.nrang, BayesEngine, calc_sigma, engine_args.get('stream', False), grid_resolution(engine_args))
+            engines = get_engines(engines, BayesEngine, fit, nbatch, calc_sigma, engine_args)
+        except Exception as e:
+            print 'error preparing the fit of the record at ' + str(fit.recordtime) + ' (' + str(e) + ')... dropping it'
+            if ring != None:
+                fit.ReleaseSamples(ring)
+            pipeline_drop([item], write_queues)
+            continue
 
+        batch.append(item)
+        nrecords += 1
+
+        if len(batch) == nbatch:
+            pipeline_fit_batch(batch, engines, calc_sigma, write_queues, ring)
+            batch = []
+
+    if len(batch):
+        pipeline_fit_batch(batch, engines, calc_sigma, write_queues, ring)
+
+    print_mask_cache(engines[0])
+    print 'fit worker: ' + str(nrecords) + ' records, waited ' + str(round(starved, 1)) + ' s on the decoders'
+
+# closes and removes the file of a block that failed, later records of the block are counted but not written
+def pipeline_discard(entry, reason):
+    print 'error writing ' + entry[3] + ' (' + reason + ')... discarding the block'
+    try:
+        entry[0].close()
+    except Exception:
+        pass
+    if os.path.exists(entry[3]):
+        os.remove(entry[3])
+    entry[0] = None
+
+# a block's file is closed once all of its decoded records are written, records of a block may arrive in any order
+# a block is discarded if one of its records failed to fit or write, the writer keeps draining its queue
+def pipeline_write(write_queue, calc_sigma, datadir, layout = 3, storage_args = {}):
+    files = {} # block -> [hdf5file (None once discarded), records written or dropped, records decoded (None until the block is decoded), path]
+
+    for (block, item) in iter(write_queue.get, None):
+        if not block in files:
+            outfilepath, outfilename = fitlomb_path(datadir, block[1], block[3])
+            files[block] = [None, 0, None, outfilepath + outfilename]
+            try:
+                if not os.path.exists(outfilepath):
+                    os.makedirs(outfilepath)
+                files[block][0] = create_fitlomb(outfilepath + outfilename, layout, storage_args)
+            except Exception as e:
+                pipeline_discard(files[block], str(e))
+
+        entry = files[block]
+        if isinstance(item, CULombFit) or item is None:
+            if item is None and entry[0] != None:
+                pipeline_discard(entry, 'a record failed to fit')
+            elif entry[0] != None:
+                try:
+                    item.WriteLSSFit(entry[0], calc_sigma)
+                except Exception as e:
+                    pipeline_discard(entry, str(e))
+            entry[1] += 1
+        else:
+            entry[2] = item
+
+        if entry[1] == entry[2]:
+            if entry[0] != None:
+                try:
+                    entry[0].close()
+                except Exception as e:
+                    pipeline_discard(entry, str(e))
+            del files[block]
+
+# true while no pipeline worker has died, otherwise terminates the other workers
+def pipeline_alive(workers):
+    dead = [worker for worker in workers if worker.exitcode not in (None, 0)]
+    if not len(dead):
+        return True
+
+    print 'error: pipeline worker ' + dead[0].name + ' exited with code ' + str(dead[0].exitcode) + ', stopping the pipeline'
+    for worker in workers:
+        if worker.is_alive():
+            worker.terminate()
+    return False
+
+# runs the decode, fit, and write stages on a list of (stime, etime, radar) blocks, returns once every block is written
+# samples pass through a ring of ringslots shared memory slots, or are pickled with the records if ringslots is 0
+# layout is the version of the output file layout (3 or 4), storage_args are LombTable options for version 4 files
+def run_pipeline(blocks, lock, overwrite, calc_sigma, backend, batchsize, batchmem, engine_args, prefetch, datadir, ndecoders = 1, nfitters = 1, nwriters = 1, depth = PIPELINE_DEPTH, ringslots = RING_SLOTS, layout = 3, storage_args = {}):
+    ring = RecordRing(ringslots) if ringslots > 0 else None
+    block_queue = multiprocessing.Queue()
+    fit_queue = multiprocessing.Queue(depth)
+    write_queues = [multiprocessing.Queue(depth) for i in xrange(nwriters)]
+
+    for (index, (stime, etime, radar)) in enumerate(blocks):
+        block_queue.put((index, stime, etime, radar))
+
+    decoders = [Process(target = pipeline_decode, args = (block_queue, fit_queue, lock, overwrite, datadir, prefetch, ring)) for i in xrange(ndecoders)]
+    fitters = [Process(target = pipeline_fit, args = (fit_queue, write_queues, backend, batchsize, batchmem, calc_sigma, engine_args, ring)) for i in xrange(nfitters)]
+    writers = [Process(target = pipeline_write, args = (write_queue, calc_sigma, datadir, layout, storage_args)) for write_queue in write_queues]
+
+    for worker in decoders + fitters + writers:
+        worker.start()
+
+    # stop each stage once the stage feeding it has finished
+    # a dead worker would leave the stages around it blocked on full queues, so the pipeline is stopped if one dies
+    workers = decoders + fitters + writers
+    for stage, queues in [(decoders, [block_queue]), (fitters, [fit_queue]), (writers, write_queues)]:
+        for queue in queues:
+            for worker in xrange(len(stage) / len(queues)):
+                while True:
+                    try:
+                        queue.put(None, timeout = PIPELINE_POLL)
+                        break
+                    except Queue.Full:
+                        if not pipeline_alive(workers):
+                            return
+        for worker in stage:
+            while worker.is_alive():
+                worker.join(PIPELINE_POLL)
+                if not pipeline_alive(workers):
+                    return
+        if not pipeline_alive(workers):
+            return
 
 #@profile
 def main():
@@ -565,7 +1340,29 @@ def main():
     parser.add_argument("--recordlen", help="breaks the output into recordlen hour length files (max 24)", default=2) 
     parser.add_argument("--poolsize", help="maximum number of simultaneous subprocesses", default='auto') 
     parser.add_argument("--passes", help="number of lomb fit passes", default=LOMB_PASSES) 
-    parser.add_argument("--resolution", help="size of velocity/spectral width matrix for fits", default=None) 
+    parser.add_argument("--resolution", help="size of velocity/spectral width matrix for fits (the fine matrix with --search coarse), defaults to " + str(NFREQS) + " x " + str(NALFS), default=None) 
+    parser.add_argument("--search", help="full evaluates the entire velocity/spectral width matrix, coarse evaluates a coarse matrix and refines the best candidates (numba/numpy backends only)", choices=['full', 'coarse'], default='full') 
+    parser.add_argument("--coarse_resolution", help="size of the coarse velocity/spectral width matrix for --search coarse", type=int, default=64) 
+    parser.add_argument("--candidates", help="number of coarse candidates refined at full resolution for each range gate with --search coarse", type=int, default=4) 
+    parser.add_argument("--stream", help="find peaks without storing the full velocity/spectral width matrix for each range gate, reduces memory use so more workers fit on a machine", action='store_true', default=False) 
+    parser.add_argument("--separable", help="store cos/sin and decay envelope tables instead of full velocity/spectral width/lag cubes, makes large resolutions practical (numba/numpy backends only)", action='store_true', default=False) 
+    parser.add_argument("--backend", help="fitting engine: cuda (BayesGPU), numba (BayesNumba), numpy (BayesCPU), or auto to use the fastest available", choices=['numba', 'numpy', 'cuda', 'auto'], default='cuda') 
+    parser.add_argument("--batch", help="number of records with the same pulse sequence to fit in each engine call, or auto to size batches from --batchmem", default=1) 
+    parser.add_argument("--batchmem", help="memory budget in MB for auto batch sizing", type=float, default=1024) 
+    parser.add_argument("--cubemem", help="memory budget in MB for the velocity/spectral width/lag cubes cached by each worker", type=float, default=timecube.CUBE_CACHE_BYTES / 2 ** 20) 
+    parser.add_argument("--cubedir", help="directory for cubes shared between workers through memory mapped files, defaults to building cubes in each worker", default=None) 
+    parser.add_argument("--prefetch", help="number of records read and prepared ahead of the fit by a reader thread in each worker, 0 to read inline", type=int, default=PREFETCH_DEPTH) 
+    parser.add_argument("--writedepth", help="number of fitted records queued for a writer thread in each worker, so fitting doesn't wait on hdf5 writes, 0 to write inline (not used with --pipeline)", type=int, default=WRITE_DEPTH) 
+    parser.add_argument("--daily", help="write the records of each radar/day to one consolidated file from a writer process for each radar, instead of a file for each time block (blocks are split at midnight)", action='store_true', default=False) 
+    parser.add_argument("--reorder", help="number of records each --daily writer holds back to write records from parallel workers in time order (late records are sorted into place when a version 4 file is closed)", type=int, default=REORDER_RECORDS) 
+    parser.add_argument("--pipeline", help="run decoding, fitting, and writing in separate groups of processes connected by queues, instead of a pool of workers each processing whole time blocks", action='store_true', default=False) 
+    parser.add_argument("--decoders", help="number of decode processes (reading records, bad lags, noise) with --pipeline", type=int, default=1) 
+    parser.add_argument("--fitters", help="number of fit processes with --pipeline", type=int, default=1) 
+    parser.add_argument("--writers", help="number of hdf5 write processes with --pipeline", type=int, default=1) 
+    parser.add_argument("--queuedepth", help="number of records held between pipeline stages, or queued for each --daily writer", type=int, default=PIPELINE_DEPTH) 
+    parser.add_argument("--ringslots", help="number of shared memory slots for passing record samples between pipeline stages, 0 to pickle them with the records (bounds the fit batch size)", type=int, default=RING_SLOTS) 
+    parser.add_argument("--layout", help="output file layout, 3 writes a group for each record, 4 writes a chunked dataset for each parameter with a row for each record", type=int, choices=[3, LAYOUT_VERSION], default=3) 
+    add_storage_arguments(parser)
     parser.add_argument("--radars", help="radar(s) to process data on", nargs='+', default=['mcm.a'])#, 'mcm.b', 'kod.d', 'kod.c', 'ade.a', 'adw.a'])
     parser.add_argument("--datadir", help="base directory for .fitlomb files (defaults to /home/radar/fitlomb/)", default='/home/radar/fitlomb/') 
     parser.add_argument("--overwrite", help="overwrite existing .fitlomb files", action='store_true', default='True') 
@@ -574,15 +1371,12 @@ def main():
     
     # TODO: these probably shouldn't be global variables..
     calc_sigma = not args.disable_sigmafit
-    DATA_DIR = args.datadir
+    timecube.cube_cache.maxbytes = int(args.cubemem * 2 ** 20)
+    timecube.cube_cache.cubedir = args.cubedir
 
     OVERWRITE = args.overwrite
     print 'overwrite: ' + str(OVERWRITE)
 
-    if args.resolution != None:
-        NFREQS = int(args.resolution)
-        NALFS = int(args.resolution)
-
     # mount raid0 via sshfs on chiniak... (to get write access)
     mount_raid0()
 
@@ -603,6 +1397,28 @@ def main():
     if starttime > endtime:
         print 'error: start time is after end time..'
         return
+
+    engine_args = {}
+    if args.search == 'coarse':
+        engine_args = {'search' : 'coarse', 'coarse_res' : args.coarse_resolution, 'candidates' : args.candidates}
+    if args.stream:
+        engine_args['stream'] = True
+    if args.separable:
+        engine_args['separable'] = True
+    if args.resolution != None:
+        engine_args['resolution'] = (int(args.resolution), int(args.resolution))
+
+    if cpu_only(engine_args) and args.backend == 'cuda':
+        print 'error: --search coarse and --separable require the numba or numpy backend'
+        return
+
+    # compact datasets of version 3 files can't be filtered, and version 3 readers expect double/int32 parameters
+    if args.layout != LAYOUT_VERSION and (args.compression != 'none' or args.shuffle or args.single or args.packflags):
+        print 'error: --compression, --shuffle, --single, and --packflags require --layout ' + str(LAYOUT_VERSION)
+        return
+    if args.daily and args.pipeline:
+        print 'error: --daily is not used with --pipeline'
+        return
     
     # compile list of start time/end time/radar/lock tuples 
     manager = Manager()
@@ -618,12 +1434,25 @@ def main():
         stime = starttime
         while stime < endtime:
             etime = min(stime + datetime.timedelta(hours = args.recordlen), endtime)
-            records.append((stime, etime, radar, lock, OVERWRITE, calc_sigma))
+            if args.daily:
+                etime = min(etime, datetime.datetime.combine(stime.date() + datetime.timedelta(days = 1), datetime.time()))
+            records.append((stime, etime, radar, lock, OVERWRITE, args.datadir, calc_sigma, args.backend, args.batch, args.batchmem, engine_args, args.prefetch, args.layout, get_storage_args(args), args.writedepth, None))
             stime = etime
     
+    if args.pipeline:
+        print 'starting fitlomb pipeline'
+        blocks = [(record[0], record[1], record[2]) for record in records]
+        run_pipeline(blocks, lock, OVERWRITE, calc_sigma, args.backend, args.batch, args.batchmem, engine_args, args.prefetch, args.datadir, args.decoders, args.fitters, args.writers, args.queuedepth, args.ringslots, args.layout, get_storage_args(args))
+        print 'fitlomb pipeline finished...'
+        return
+
     # run pool of records in parallel
     # so, two workers on kodiak-devel
     # an i7 with a gtx970 could handle.. at least eight 
+    daily_writers = []
+    if args.daily:
+        records, daily_writers = start_daily_writers(records, manager, OVERWRITE, args.layout, get_storage_args(args), args.queuedepth, args.reorder)
+
     print 'starting fitlomb worker pool'
     fitlomb_pool = Pool(processes = poolsize)
 
@@ -635,6 +1464,7 @@ def main():
 
     fitlomb_pool.close()
     fitlomb_pool.join()
+    stop_daily_writers(daily_writers)
     print 'fitlomb workers finished...'
 
 def test_lags():
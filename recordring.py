@@ -0,0 +1,123 @@
+#/usr/bin/python2
+# jon klein, jtklein@alaska.edu
+# shared memory ring buffer for passing the numeric payload of records between processes
+# the ring is nslots fixed size slots in one shared array, allocated before the worker processes fork
+# a producer takes a free slot, copies its arrays in, and sends a small descriptor over a queue instead of the arrays
+# the consumer gets numpy views of the slot (no copying or unpickling) and releases the slot once it is done with them
+# payloads larger than a slot are carried inline in the descriptor
+# mit license
+
+import numpy as np
+import multiprocessing
+import time
+
+RING_SLOTS = 16 # default number of slots
+RING_SLOT_BYTES = 2 ** 20 # default slot size, holds the payload of a 225 gate record with room to spare
+RING_ALIGN = 64 # arrays start on cache line boundaries within a slot
+RING_TIMEOUT = 300 # seconds a producer waits for a free slot before giving up (the consumer may have died)
+
+class RecordRing:
+    def __init__(self, nslots = RING_SLOTS, slotbytes = RING_SLOT_BYTES):
+        self.nslots = nslots
+        self.slotbytes = slotbytes - slotbytes % RING_ALIGN
+        self.shared = multiprocessing.RawArray('b', self.nslots * self.slotbytes)
+        self.busy = multiprocessing.RawArray('b', self.nslots) # 1 while a slot holds a payload
+        self.nfree = multiprocessing.Semaphore(self.nslots)
+        self.lock = multiprocessing.Lock() # producers take slots one at a time
+        self.buf = None # uint8 view of the shared array, made in each process on first use
+
+    def _buffer(self):
+        if self.buf is None:
+            self.buf = np.frombuffer(self.shared, dtype=np.uint8)
+        return self.buf
+
+    # blocks until a slot is free, then marks it busy
+    # raises RuntimeError if no slot is freed within timeout seconds (None waits forever)
+    def _take_slot(self, timeout = None):
+        if not self.nfree.acquire(True, timeout):
+            raise RuntimeError('no ring slot was freed in ' + str(timeout) + ' s, the consumer may have died')
+        with self.lock:
+            slot = list(self.busy).index(0)
+            self.busy[slot] = 1
+        return slot
+
+    # copies a dict of name -> array into a free slot, blocking until a slot is free (for at most timeout seconds)
+    # returns the descriptor (slot, [(name, dtype, shape, offset, nbytes)]) to send to the consumer
+    def pack(self, arrays, timeout = None):
+        arrays = dict((name, np.ascontiguousarray(arrays[name])) for name in arrays)
+        layout = []
+        offset = 0
+        for name in sorted(arrays):
+            layout.append((name, arrays[name].dtype.str, arrays[name].shape, offset, arrays[name].nbytes))
+            offset += -(-arrays[name].nbytes // RING_ALIGN) * RING_ALIGN
+
+        if offset > self.slotbytes:
+            return (None, arrays)
+
+        slot = self._take_slot(timeout)
+        base = slot * self.slotbytes
+        buf = self._buffer()
+        for (name, dtype, shape, offset, nbytes) in layout:
+            buf[base + offset:base + offset + nbytes] = arrays[name].reshape(-1).view(np.uint8)
+
+        return (slot, layout)
+
+    # returns a dict of name -> view of the arrays in the slot of a descriptor, valid until the slot is released
+    def unpack(self, desc):
+        slot, layout = desc
+        if slot is None:
+            return layout
+
+        base = slot * self.slotbytes
+        buf = self._buffer()
+        arrays = {}
+        for (name, dtype, shape, offset, nbytes) in layout:
+            arrays[name] = np.ndarray(shape, dtype, buf, base + offset)
+
+        return arrays
+
+    def release(self, desc):
+        if desc[0] is not None:
+            self.busy[desc[0]] = 0
+            self.nfree.release()
+
+# payload of a record at nrang range gates, like the arrays of a CULombFit
+def _payload(nrang, mplgs = 23):
+    return {\
+        'acfd' : np.random.randn(nrang, mplgs, 2),\
+        'pwr0' : np.random.rand(nrang),\
+        'isamples' : np.float32(np.random.randn(nrang, 2 * mplgs)),\
+        'lagsmask' : np.int8(np.random.rand(nrang, mplgs) > .3)}
+
+def _produce(queue, ring, nrang, nrecords):
+    payload = _payload(nrang)
+    for i in xrange(nrecords):
+        if ring is None:
+            queue.put(payload)
+        else:
+            queue.put(ring.pack(payload))
+    queue.put(None)
+
+# benchmark records per second passed from a producer process to a consumer, by pickling through a queue or through the ring
+def main(nrecords = 2000):
+    for nrang in [75, 225]:
+        for transport in ['pickle', 'shared memory']:
+            ring = RecordRing() if transport == 'shared memory' else None
+            queue = multiprocessing.Queue(RING_SLOTS)
+            producer = multiprocessing.Process(target = _produce, args = (queue, ring, nrang, nrecords))
+
+            t0 = time.time()
+            producer.start()
+            total = 0.
+            for item in iter(queue.get, None):
+                payload = item if ring is None else ring.unpack(item)
+                total += payload['isamples'][0,0] # touch the payload like a consumer would
+                if ring is not None:
+                    ring.release(item)
+            producer.join()
+            dt = time.time() - t0
+
+            print str(nrang) + ' gates, ' + transport + ': ' + str(int(nrecords / dt)) + ' records/s'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#/usr/bin/python2
+# jon klein, jtklein@alaska.edu
+# compares file size and write throughput of fitlomb storage options over a synthetic day of records
+# records are shaped like CULombFit.FitAttrs and FitParams (one lomb pass, sigma fits enabled) from a radar scanning nbeams beams a minute
+# fitted parameters vary smoothly in range with fitting noise, with patches of quality scatter
+# with --daily, checks that a daily writer keeps the records of parallel workers in time order instead
+# mit license
+
+import argparse
+import calendar
+import datetime
+import h5py
+import numpy as np
+import os
+import sys
+import time
+from lombtable import LombTable, GroupWriter
+
+RECORD_POOL = 256 # distinct synthetic records, reused with new times to make up the day
+
+# storage options compared, (name, layout version, LombTable or GroupWriter keyword arguments)
+# the first configuration writes a group at a time and is the reference for the others
+CONFIGS = [\
+    ('v3 compact', 3, None),\
+    ('v3 compact buffered', 3, {}),\
+    ('v4', 4, {}),\
+    ('v4 gzip', 4, {'compression' : 'gzip'}),\
+    ('v4 gzip shuffle', 4, {'compression' : 'gzip', 'shuffle' : True}),\
+    ('v4 lzf shuffle', 4, {'compression' : 'lzf', 'shuffle' : True}),\
+    ('v4 gzip shuffle single packflags', 4, {'compression' : 'gzip', 'shuffle' : True, 'single' : True, 'packflags' : True}),\
+    ('v4 lzf shuffle single packflags', 4, {'compression' : 'lzf', 'shuffle' : True, 'single' : True, 'packflags' : True})]
+
+# returns the scalars and (name, data, hdf5 type) vectors of a synthetic record
+def synth_record(nrang, bmnum, epoch):
+    gates = np.arange(nrang)[:,np.newaxis]
+    scatter = np.abs(np.sin(gates / 9. + np.random.uniform(0, 2 * np.pi))) > .6
+    noise = lambda scale: scale * np.random.randn(nrang, 1)
+
+    attrs = dict([(name, np.int16(0)) for name in ['txpow', 'nave', 'atten', 'lagfr', 'smsep', 'ercod', 'scan', 'offset', 'rxrise', 'txpl', 'mpinc', 'mplgs', 'frang', 'rsep', 'ifmode', 'channel', 'stid', 'cp']])
+    attrs.update({'nrang' : np.int16(nrang), 'bmnum' : np.int16(bmnum), 'mppul' : np.int16(8), 'tfreq' : np.int16(12000), 'noise.search' : np.float32(10), 'noise.mean' : np.float32(10), 'combf' : 'synthetic', 'epoch.time' : epoch, 'noise.lag0' : np.random.rand()})
+    attrs.update({'readme' : 'synthetic', 'fitlomb.revision.major' : np.int8(3), 'fitlomb.revision.minor' : np.int8(8), 'fitlomb.bayes.iterations' : np.int16(1), 'origin.code' : 'storage_benchmark.py', 'origin.time' : time.ctime()})
+
+    params = [\
+        ('ptab', np.int16([0, 14, 22, 24, 27, 31, 42, 43]), h5py.h5t.STD_I16BE),\
+        ('ltab', np.int16(np.random.randint(0, 44, (24, 2))), h5py.h5t.STD_I16BE),\
+        ('pwr0', np.int32(np.random.randint(0, 5000, nrang)), h5py.h5t.STD_I32BE),\
+        ('qflg', np.int32(scatter), h5py.h5t.STD_I32BE),\
+        ('gflg', np.int8(scatter * (np.random.rand(nrang, 1) > .8)), h5py.h5t.STD_I8BE),\
+        ('iflg', np.int8(scatter * (np.random.rand(nrang, 1) > .2)), h5py.h5t.STD_I8BE),\
+        ('nlag', np.int16(np.random.randint(0, 24, (nrang, 1))), h5py.h5t.STD_I16BE)]
+
+    for name in ['v', 'v_s']:
+        params.append((name, 300 * np.sin(gates / 20. + bmnum) + noise(50), h5py.h5t.NATIVE_DOUBLE))
+    for name in ['w_l', 'w_s']:
+        params.append((name, np.abs(150 + noise(80)), h5py.h5t.NATIVE_DOUBLE))
+    for name in ['p_l', 'p_s']:
+        params.append((name, 5 + 20 * scatter + noise(3), h5py.h5t.NATIVE_DOUBLE))
+    for name in ['p_l_e', 'w_l_e', 'w_l_std', 'v_e', 'v_l_std', 'fit_snr_l', 'fit_snr_l_peak', 'v_sigma_l', 'phi_sigma_l', 'slope_sigma_l', 'w_s_e', 'w_s_std', 'v_s_e', 'v_s_std', 'fit_snr_s', 'v_sigma_s', 'phi_sigma_s', 'slope_sigma_s']:
+        params.append((name, np.abs(noise(20)), h5py.h5t.NATIVE_DOUBLE))
+
+    return attrs, params
+
+# write a record as a group of attributes and compact datasets, like CULombFit.WriteLSSFit
+def write_group(hdf5file, attrs, params):
+    groupname = str(attrs['epoch.time'])
+    grp = hdf5file.create_group(groupname)
+    for name in attrs:
+        grp.attrs[name] = attrs[name]
+
+    for (name, data, dtype) in params:
+        space_id = h5py.h5s.create_simple(data.shape)
+        dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+        dcpl.set_layout(h5py.h5d.COMPACT)
+        dset = h5py.h5d.create(hdf5file.id, (groupname + '/' + name).encode(), dtype, space_id, dcpl)
+        dset.write(h5py.h5s.ALL, h5py.h5s.ALL, data)
+
+# feeds a day of synthetic records to the DailyWriter of pydarncuda_fitlomb the way a pool of nworkers workers does,
+# blocks of blocklen hours are handed to workers in time order and every worker sends one record in turn,
+# then checks that the daily file has every record and that the rows of version 4 files are in time order
+def daily_check(path, layout, pool, nrecords, beams, blocklen, nworkers, reorder):
+    from pydarncuda_fitlomb import DailyWriter
+    day = datetime.datetime(2014, 8, 27)
+    dt = 60. / beams
+    nblock = int(blocklen * 3600 / dt)
+    blocks = [day + datetime.timedelta(seconds = i * dt) for i in xrange(0, nrecords, nblock)]
+    writer = DailyWriter(path, blocks, layout, {}, reorder)
+
+    # record i of the day, with a copy of the pool scalars so the writer can hold them
+    def record(i):
+        attrs, params = pool[i % RECORD_POOL]
+        attrs = dict(attrs)
+        attrs['epoch.time'] = calendar.timegm(day.timetuple()) + int(i * dt)
+        attrs['bmnum'] = np.int16(i % beams)
+        return attrs, params
+
+    t0 = time.time()
+    pending = range(len(blocks)) # blocks not yet handed to a worker
+    active = [] # [block, next record] of each busy worker
+    while len(pending) or len(active):
+        while len(active) < nworkers and len(pending):
+            b = pending.pop(0)
+            active.append([b, b * nblock])
+        for work in list(active):
+            b, i = work
+            if i == min((b + 1) * nblock, nrecords):
+                writer.add(blocks[b], None, None)
+                active.remove(work)
+                continue
+            attrs, params = record(i)
+            writer.add(blocks[b], attrs, params)
+            work[1] += 1
+    writer.close()
+    dt = time.time() - t0
+
+    hdf5file = h5py.File(path, 'r')
+    if layout == 4:
+        times = hdf5file['prm']['epoch.time']
+        ok = len(times) == nrecords and np.all(np.diff(times) > 0)
+    else:
+        ok = len(hdf5file) == nrecords
+    hdf5file.close()
+    os.remove(path)
+    print 'v' + str(layout) + ' daily file: ' + str(nrecords) + ' records from ' + str(len(blocks)) + ' blocks on ' + str(nworkers) + ' workers, ' + str(writer.late) + ' late, ' + str(int(nrecords / dt)) + ' records/s, ' + ('all records in time order' if ok else 'ERROR: records missing or out of order')
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the size and write throughput of fitlomb file layouts and storage options over a synthetic day.')
+    parser.add_argument("--hours", help="hours of synthetic records", type=float, default=24)
+    parser.add_argument("--beams", help="beams in each one minute scan", type=int, default=16)
+    parser.add_argument("--nrang", help="range gates in each record", type=int, default=75)
+    parser.add_argument("--dir", help="directory for the benchmark files", default='/tmp/')
+    parser.add_argument("--daily", help="check the time order of daily files written from parallel workers (needs the pydarncuda_fitlomb dependencies) instead of comparing storage options", action='store_true', default=False)
+    parser.add_argument("--workers", help="workers fitting blocks in parallel with --daily", type=int, default=8)
+    parser.add_argument("--blocklen", help="hours in each block with --daily", type=float, default=2)
+    parser.add_argument("--reorder", help="records held back by the daily writer with --daily", type=int, default=2048)
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    nrecords = int(args.hours * 60 * args.beams)
+    pool = [synth_record(args.nrang, i % args.beams, i) for i in xrange(RECORD_POOL)]
+    print str(nrecords) + ' records of ' + str(args.nrang) + ' range gates'
+
+    if args.daily:
+        path = os.path.join(args.dir, 'storage_benchmark.hdf5')
+        ok = [daily_check(path, layout, pool, nrecords, args.beams, args.blocklen, args.workers, args.reorder) for layout in [3, 4]]
+        if not all(ok):
+            sys.exit(1)
+        return
+
+    v3size = None
+    for (name, layout, storage_args) in CONFIGS:
+        path = os.path.join(args.dir, 'storage_benchmark.hdf5')
+        t0 = time.time()
+        hdf5file = h5py.File(path, 'w')
+        if layout == 4:
+            hdf5file = LombTable(hdf5file, **storage_args)
+        elif storage_args != None:
+            hdf5file = GroupWriter(hdf5file, **storage_args)
+
+        for i in xrange(nrecords):
+            attrs, params = pool[i % RECORD_POOL]
+            attrs['epoch.time'] = i
+            if layout == 4:
+                hdf5file.append(attrs, dict((pname, data) for (pname, data, dtype) in params))
+            elif storage_args != None:
+                hdf5file.append(attrs, params)
+            else:
+                write_group(hdf5file, attrs, params)
+
+        hdf5file.close()
+        dt = time.time() - t0
+        size = os.path.getsize(path)
+        os.remove(path)
+
+        if v3size == None:
+            v3size = size
+        print name.ljust(36) + str(round(size / 2. ** 20, 1)).rjust(8) + ' MB ' + str(round(100. * size / v3size, 1)).rjust(6) + '% of v3 ' + str(int(nrecords / dt)).rjust(8) + ' records/s'
+
+if __name__ == '__main__':
+    main()
@@ -6,76 +6,160 @@
 # recomputing these takes up ~80% of runtime if not cached
 
 import numpy as np
-import datetime
+import hashlib
+import tempfile
+import os
+from collections import OrderedDict
+
+SYMMETRY_TOL = 1e-9 # relative tolerance for treating a frequency grid as symmetric about zero
+CUBE_CACHE_BYTES = 512 * 2 ** 20 # default memory budget of the cube cache
 
 # TimeCube is a class of cached cubes of amplitude(time, frequency, decay)
 # creating these is expensive and RAM is cheap, so...
-# TODO: create generalized timecube with given function and inputs
 # TODO: create fine resolution timecube, then provide masked timecubes..
-# input: t, f, alfs, env_model
-
-
+# get(fn, *args) returns fn(*args), cached under a sha1 of the function name and the contents of the inputs
+# the cache is least recently used, evicting cubes once the cached arrays take more than maxbytes
+# cached arrays are shared by everything using the cache, so they are made read-only
+# with a cubedir, cubes are also stored as .npy files named by their key and memory mapped from there,
+# so worker processes on a node share one copy in the page cache instead of each building their own
 class TimeCube:
-    def __init__(self, maxsize = 20):
-        self.cubecache = {}
-        self.cubetimes = {}
-        self.maxsize = maxsize
-       
-    def _cubeparam_key(self, t, f, alfs, env_model):
-        # there must be better ways of doing this...
-        return str(t) + self._listhash(f) + self._listhash(alfs) + str(env_model)
-
-    def _listhash(self,l):
-        return ','.join([str(l[0]), str(l[-1]), str(len(l))])
-
-    def get_spacecube(self, t, f, alfs, env_model):
-        key = self._cubeparam_key(t,f,alfs,env_model) 
-
-        if not key in self.cubecache:
-            self.cubecache[key] = make_spacecube(t, f, alfs, env_model)
-            
-            # check to see if cube cache is too big. it is, delete the least recently used cube
-            self.cubetimes[datetime.datetime.now()] = key 
-            if len(self.cubecache) > self.maxsize:
-                del self.cubecache[self.cubetimes[min(self.cubetimes.keys())]]
-                del self.cubetimes[min(self.cubetimes.keys())]
+    def __init__(self, maxbytes = CUBE_CACHE_BYTES, cubedir = None):
+        self.cubecache = OrderedDict()
+        self.maxbytes = maxbytes
+        self.cubedir = cubedir
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.diskhits = 0
+
+    # exact key, hashes the dtype, shape, and contents of each input
+    def _cubeparam_key(self, fn, *args):
+        key = hashlib.sha1((fn.__module__ + '.' + fn.__name__).encode())
+        for arg in args:
+            arg = np.ascontiguousarray(np.array(arg))
+            key.update((arg.dtype.str + str(arg.shape)).encode())
+            key.update(arg.tobytes())
+        return key.hexdigest()
+
+    def get(self, fn, *args):
+        key = self._cubeparam_key(fn, *args)
+
+        if key in self.cubecache:
+            self.hits += 1
+            cubes = self.cubecache.pop(key)
+            self.cubecache[key] = cubes
+            return cubes
+
+        self.misses += 1
+        cubes = None
+        if self.cubedir:
+            cubes = self._load_cubes(key)
+
+        if cubes is None:
+            cubes = fn(*args)
+            if self.cubedir:
+                cubes = self._save_cubes(key, cubes)
         else:
-            self.cubetimes
-
-        return self.cubecache[key] 
-
-def make_spacecube(t, f, alfs, env_model):
-    # create ce_matrix and se_matrix..
-    # sin and cos(w * t) * exp(-alf * t) cubes 
+            self.diskhits += 1
+
+        arrays = [cube for cube in cubes if isinstance(cube, np.ndarray)]
+        nbytes = sum(cube.nbytes for cube in arrays)
+
+        # cubes larger than the whole budget are returned without caching them
+        if nbytes > self.maxbytes:
+            return cubes
+
+        for cube in arrays:
+            cube.flags.writeable = False
+
+        # evict the least recently used cubes until the new cubes fit
+        while self.nbytes + nbytes > self.maxbytes:
+            oldkey, oldcubes = self.cubecache.popitem(last = False)
+            self.nbytes -= sum(cube.nbytes for cube in oldcubes if isinstance(cube, np.ndarray))
+            self.evictions += 1
+
+        self.cubecache[key] = cubes
+        self.nbytes += nbytes
+        return cubes
+
+    def _cube_path(self, key, i):
+        return os.path.join(self.cubedir, key + '.' + str(i) + '.npy')
+
+    # memory maps the cubes stored under key, returns None if they aren't on disk
+    def _load_cubes(self, key):
+        cubes = []
+        while os.path.exists(self._cube_path(key, len(cubes))):
+            cube = np.load(self._cube_path(key, len(cubes)), mmap_mode = 'r')
+            cubes.append(cube.view(np.ndarray))
+
+        return tuple(cubes) if len(cubes) else None
+
+    # writes each cube to a temporary file and renames it into place, so other workers never map a partial cube
+    # the first cube is renamed last, so _load_cubes only sees complete sets
+    # returns the memory mapped cubes, or the cubes unchanged if they can't be stored
+    def _save_cubes(self, key, cubes):
+        if not all([isinstance(cube, np.ndarray) for cube in cubes]):
+            return cubes
+
+        try:
+            if not os.path.isdir(self.cubedir):
+                os.makedirs(self.cubedir)
+
+            for i in reversed(range(len(cubes))):
+                fd, tmppath = tempfile.mkstemp(dir = self.cubedir, suffix = '.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, np.ascontiguousarray(cubes[i]))
+                os.rename(tmppath, self._cube_path(key, i))
+        except (IOError, OSError) as e:
+            print 'unable to store cube in ' + self.cubedir + ' (' + str(e) + '), keeping it in memory'
+            return cubes
+
+        return self._load_cubes(key)
+
+    def get_spacecube(self, t, f, alfs, env_model, half = False):
+        return self.get(make_spacecube, t, f, alfs, env_model, half)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.
+
+# cubes for the fitting engines of each worker process, shared by engines built with the same lags/freqs/alfs/env_model
+cube_cache = TimeCube()
+
+# true if the frequencies are symmetric about zero, e.g. np.linspace(-fmax, fmax, n)
+# cos is even and sin is odd, so the cubes for the negative half of the grid mirror the positive half
+def symmetric_freqs(f):
+    f = np.float64(np.array(f))
+    return len(f) > 1 and np.max(np.abs(f + f[::-1])) <= SYMMETRY_TOL * np.max(np.abs(f))
+
+# half only returns the cubes for the upper half of a symmetric grid, f[len(f) / 2:]
+# ce/se are returned [freq][time][alf] by default, layout='atf' returns them [alf][time][freq] like the fitting engines use
+# ce/se are built directly in the output arrays by broadcasting the cos/sin tables against the envelope,
+# products are calculated in float64 and rounded once to dtype
+def make_spacecube(t, f, alfs, env_model, half = False, dtype = np.float64, layout = 'fta'):
+    if half:
+        f = np.array(f)[len(f) // 2:]
+
+    # sin and cos(w * t) [freq][time], and the envelope exp(-alf * t) [alf][time]
     omegas = 2 * np.pi * f
     c_matrix = np.cos(np.outer(omegas, t))
     s_matrix = np.sin(np.outer(omegas, t))
-    #print "space cube c_matrix:",c_matrix.shape,len(c_matrix)
-    # create cube of time by frequency with no decay
-    c_cube = np.tile(c_matrix, (len(alfs),1,1))
-    s_cube = np.tile(s_matrix, (len(alfs),1,1))
-
-    # about 80% of execution time spent here..
-    # ~ 400000
-    # kernprof.py -l iterative_bayes.py
-    # python -m line_profiler iterative_bayes.py.lprof
-
-    # so... create cube of alpha by time at dc 
     envelope = np.exp(np.outer(-(alfs ** env_model), t))
-    envelope_cube = np.tile(envelope, (len(c_matrix), 1,1))
-
-    # rearrange cubes to match format of ce_matrix and se_matrix
-    envelope_cube = np.swapaxes(envelope_cube, 1, 2)
-    c_cube = np.swapaxes(c_cube, 0, 1)
-    c_cube = np.swapaxes(c_cube, 1, 2)
-    s_cube = np.swapaxes(s_cube, 0, 1)
-    s_cube = np.swapaxes(s_cube, 1, 2)
-    #print "space cube c_cube:",c_cube.shape
-    #print "space cube envelope:",envelope.shape
-    #print "space cube envelope_cube:",envelope_cube.shape
-    
-    ce_matrix = c_cube * envelope_cube
-    se_matrix = s_cube * envelope_cube
+
+    # ce_matrix[f][t][a] = c_matrix[f][t] * envelope[a][t] (and the same for se_matrix)
+    if layout == 'fta':
+        ce_matrix = np.empty([len(omegas), len(t), len(alfs)], dtype = dtype)
+        se_matrix = np.empty_like(ce_matrix)
+        np.multiply(c_matrix[:,:,np.newaxis], envelope.T[np.newaxis,:,:], out = ce_matrix)
+        np.multiply(s_matrix[:,:,np.newaxis], envelope.T[np.newaxis,:,:], out = se_matrix)
+    elif layout == 'atf':
+        ce_matrix = np.empty([len(alfs), len(t), len(omegas)], dtype = dtype)
+        se_matrix = np.empty_like(ce_matrix)
+        np.multiply(envelope[:,:,np.newaxis], c_matrix.T[np.newaxis,:,:], out = ce_matrix)
+        np.multiply(envelope[:,:,np.newaxis], s_matrix.T[np.newaxis,:,:], out = se_matrix)
+    else:
+        raise ValueError('unknown space cube layout: ' + str(layout))
 
     # C_f and S_f don't vary with the samples, only the envelopes
     # also.. C_f = S_f for simultaenous samples
@@ -91,54 +175,63 @@ def make_spacecube(t, f, alfs, env_model):
 
     return ce_matrix, se_matrix, CS_f
 
+# separable form of the space cube, ce_matrix[f][t][a] = c_matrix[f][t] * envelope[a][t] (same for se_matrix)
+# returns cos and sin(w * t) [freq][time] and the envelope exp(-alf * t) [alf][time] instead of full cubes
+def make_spacetables(t, f, alfs, env_model, half = False):
+    if half:
+        f = np.array(f)[len(f) // 2:]
+
+    omegas = 2 * np.pi * f
+    c_matrix = np.cos(np.outer(omegas, t))
+    s_matrix = np.sin(np.outer(omegas, t))
+    envelope = np.exp(np.outer(-(alfs ** env_model), t))
+
+    return c_matrix, s_matrix, envelope
+
+# space cube in the layout of the fitting engines, float32 ce and se [alf][time][freq]
+def make_enginecube(t, f, alfs, env_model, half = False):
+    ce_matrix, se_matrix, CS_f = make_spacecube(t, f, alfs, env_model, half, np.float32, 'atf')
+    return ce_matrix, se_matrix
+
+# space tables in the layout of the fitting engines, float32 cos and sin [time][freq] and envelope [alf][time]
+def make_enginetables(t, f, alfs, env_model, half = False):
+    c_matrix, s_matrix, envelope = make_spacetables(t, f, alfs, env_model, half)
+    c_matrix = np.ascontiguousarray(c_matrix.T, dtype=np.float32)
+    s_matrix = np.ascontiguousarray(s_matrix.T, dtype=np.float32)
+    return c_matrix, s_matrix, np.float32(envelope)
+
+# cos and sin(theta) tiles of the hyperspace cube [Vlos][fcrit][times], built for any chunk of velocities
+# theta is the phase at each time of a return at Vlos seen through a plasma with critical frequency fcrit,
+# where the refractive index depends on the transmit frequency of that sample
+def make_hypertables(tfreqs_hz, times_secs, fcrit_hz, Vlos_mps):
+    C_mps = 299792458.
+    tfreqs_hz = np.array(tfreqs_hz, dtype=np.float64)
+    times_secs = np.array(times_secs, dtype=np.float64)
+    fcrit_hz = np.array(fcrit_hz, dtype=np.float64)
+    Vlos_mps = np.array(Vlos_mps, dtype=np.float64)
+
+    # nan where fcrit is above the tfreq, the wave doesn't propagate
+    with np.errstate(invalid='ignore'):
+        ns = np.sqrt(1. - ((fcrit_hz[:,np.newaxis] ** 2) / (tfreqs_hz ** 2))) # [fcrit][times]
+    vm = ns * Vlos_mps[:,np.newaxis,np.newaxis]
+    theta_matrix = (2. * np.pi) * (2 * tfreqs_hz * vm / C_mps) * times_secs
+
+    return np.cos(theta_matrix), np.sin(theta_matrix)
+
+# envelope of the hyperspace cube, exp(-(alf * t) ** env_model) [alpha][times]
+def make_hyperenvelope(times_secs, alfs, env_model):
+    return np.exp(np.outer(-(alfs ** env_model), np.array(times_secs) ** env_model))
+
+# full 4-D cubes for multi-frequency fitting, ce_matrix[Vlos][fcrit][times][alpha]
+# only practical for small grids, hyper_bayes.BayesHyper evaluates the posterior from the tiles a chunk of Vlos at a time
 def make_hyperspacecube(tfreqs_hz,times_secs,fcrit_hz,Vlos_mps,alfs, env_model):
     # tfreqs_hz and times_secs are equal length.
     # fcrit_hz vlos_mps and alfs are parameters to be found.
-    C_mps=299792458.
-    
-    # generate theta_matrix
-    fcritcube = np.tile(fcrit_hz, (len(Vlos_mps), len(times_secs), 1))
-    vloscube = np.tile(Vlos_mps, (len(fcrit_hz), len(times_secs),  1))
-    tseccube = np.tile(times_secs, (len(Vlos_mps), len(fcrit_hz), 1))
-    tfreqcube = np.tile(tfreqs_hz, (len(Vlos_mps), len(fcrit_hz), 1))
-
-    vloscube = np.swapaxes(vloscube, 1, 2)
-    vloscube = np.swapaxes(vloscube, 0, 1)
-    fcritcube = np.swapaxes(fcritcube, 1, 2)
-
-    ns = np.sqrt(1. -((fcritcube **2)/(tfreqcube ** 2)))
-    vm = ns * vloscube
-    theta_matrix = (2. * np.pi) * (2 * tfreqcube * vm / C_mps) * tseccube
-   
-    # create ce_matrix and se_matrix..
-    # sin and cos(w * t) * exp(-alf * t) cubes 
-    c_matrix = np.cos(theta_matrix)
-    s_matrix = np.sin(theta_matrix)
-    # C_matrix should have dims of : Vlos,fcrit, times
-    #print "hypertimecube: c_matrix:",c_matrix.shape,len(c_matrix)
-
-    # create cube of time by frequency with no decay
-    c_cube = np.tile(c_matrix, (len(alfs),1,1,1))
-    s_cube = np.tile(s_matrix, (len(alfs),1,1,1))
-    # kernprof.py -l iterative_bayes.py
-    # python -m line_profiler iterative_bayes.py.lprof
-
-    # so... create cube of alpha by time at dc 
-    envelope = np.exp(np.outer(-(alfs ** env_model), times_secs**env_model))
-    envelope_cube = np.tile(envelope, (len(Vlos_mps),len(fcrit_hz),1,1))
-
-    # rearrange cubes to match format of ce_matrix and se_matrix
-    envelope_cube = np.swapaxes(envelope_cube, 2, 3)
-
-    c_cube = np.swapaxes(c_cube, 0, 1)
-    c_cube = np.swapaxes(c_cube, 1, 2)
-    c_cube = np.swapaxes(c_cube, 2, 3)
-    s_cube = np.swapaxes(s_cube, 0, 1)
-    s_cube = np.swapaxes(s_cube, 1, 2)
-    s_cube = np.swapaxes(s_cube, 2, 3)
-    
-    ce_matrix = c_cube * envelope_cube
-    se_matrix = s_cube * envelope_cube
+    c_matrix, s_matrix = make_hypertables(tfreqs_hz, times_secs, fcrit_hz, Vlos_mps)
+    envelope = make_hyperenvelope(times_secs, alfs, env_model)
+
+    ce_matrix = c_matrix[:,:,:,np.newaxis] * envelope.T
+    se_matrix = s_matrix[:,:,:,np.newaxis] * envelope.T
     # ce_matrix should have dims: Vlos,fcrit,times,alpha
 
     # C_f and S_f don't vary with the samples, only the envelopes